@@ -0,0 +1,198 @@
+import argparse
+import itertools
+import json
+import numpy as np
+from benchmark import measure_build, benchmark_tree
+from data_loader import load_data
+from utils import euclidean_distance, edit_distance
+
+# 默认的候选参数
+DEFAULT_TREE_WAYS = (2, 3, 4, 8)
+DEFAULT_LEAF_CAPACITIES = (1, 8, 32, 128)
+DEFAULT_SELECTING_VP_MODES = ('random', 'max_std')
+# 自动选择查询半径时，希望每个查询平均找到的近邻占数据的比例
+DEFAULT_NEIGHBOR_RATIOS = (0.001, 0.01)
+# 自动选择查询半径时使用的查询个数，以及每个查询采样的数据点个数
+RADIUS_QUERY_COUNT = 20
+RADIUS_SAMPLE_COUNT = 1000
+# 可以优化的目标与对应的测量结果字段
+OBJECTIVES = {'latency': 'latency_mean', 'distance': 'average_cal_dis_times'}
+
+
+def auto_tune(data, distance_fun, data_type, queries=None, query_ranges=None, sample_size=10000, query_count=50,
+              tree_ways_list=DEFAULT_TREE_WAYS, leaf_capacities=DEFAULT_LEAF_CAPACITIES,
+              selecting_vp_modes=DEFAULT_SELECTING_VP_MODES, objective='latency', memory_budget=None, seed=0):
+    """
+    自动选择VP树的tree_ways、leaf_capacity与selecting_vp_mode
+    在数据的一个随机样本上为每一组候选参数建树，回放一组查询，
+    选出在内存预算内、所有查询半径下平均延迟（或平均距离计算次数）最小的参数
+    :param data: 数据集，数值数据为二维数组，字符串数据为一维数组
+    :param distance_fun: 距离计算函数或Metric
+    :param data_type: 数据类型，string or num
+    :param queries: 查询数据，为None时优先从样本以外的数据中随机抽取query_count个点
+    :param query_ranges: 查询半径列表，为None时根据样本中的距离分布选择，使查询平均找到DEFAULT_NEIGHBOR_RATIOS比例的数据
+    :param sample_size: 建树使用的样本大小
+    :param query_count: 自动抽取的查询个数
+    :param tree_ways_list: 候选的划分数
+    :param leaf_capacities: 候选的叶子容量
+    :param selecting_vp_modes: 候选的支撑点选择模式
+    :param objective: 优化目标，latency（平均延迟）或distance（平均距离计算次数）
+    :param memory_budget: 整个数据集的VP树占用的字节数上限，根据样本上的树结构数组大小按数据个数线性估计，为None时不限制
+    :param seed: 样本、查询与查询半径使用的局部随机数生成器的种子，不改变全局的随机状态
+    :return: 选出的参数params、每一组候选参数的测量结果candidates（按目标从小到大排列，超出内存预算的over_budget为True）、
+             使用的查询半径query_ranges与样本大小sample_size
+    """
+    if data_type != 'string' and data_type != 'num':
+        raise ValueError('data type should be string or num')
+    if objective not in OBJECTIVES:
+        raise ValueError('objective should be one of %s' % ', '.join(OBJECTIVES))
+    if not isinstance(sample_size, int) or sample_size < 1:
+        raise ValueError('sample_size should be a positive integer')
+    data = np.asarray(data)
+    if data_type == 'string':
+        data = data.reshape(-1)
+    if len(data) == 0:
+        raise ValueError('data should not be empty')
+
+    rng = np.random.RandomState(seed)
+    # 按行号顺序读取样本，数据是内存映射数组时顺序访问磁盘
+    sample_indexes = np.sort(rng.choice(len(data), min(sample_size, len(data)), replace=False))
+    sample = data[sample_indexes]
+    query_indexes = None  # 查询在样本中的位置，查询不是从样本中抽取时为None
+    if queries is None:
+        outside_count = len(data) - len(sample)
+        if outside_count > 0:
+            # 从样本以外的行中抽取查询，查询不会与建树的样本重合
+            # 第k个样本以外的行号为k加上sample_indexes[j] - j <= k的样本个数
+            picks = np.sort(rng.choice(outside_count, min(query_count, outside_count), replace=False))
+            rows = picks + np.searchsorted(sample_indexes - np.arange(len(sample_indexes)), picks, side='right')
+            queries = list(data[rows])
+        else:
+            query_indexes = np.sort(rng.choice(len(sample), min(query_count, len(sample)), replace=False))
+            queries = list(sample[query_indexes])
+    if query_ranges is None:
+        query_ranges = choose_query_ranges(sample, queries, distance_fun, rng, query_indexes=query_indexes)
+    # 样本上的树结构数组大小按数据个数线性放大，估计整个数据集的VP树的大小
+    scale = len(data) / len(sample)
+
+    candidates = []
+    for tree_ways, leaf_capacity, selecting_vp_mode in itertools.product(tree_ways_list, leaf_capacities,
+                                                                         selecting_vp_modes):
+        params = {'tree_ways': tree_ways, 'leaf_capacity': leaf_capacity, 'selecting_vp_mode': selecting_vp_mode}
+        vp_tree, build_record = measure_build(sample, distance_fun, data_type, measure_memory=False, **params)
+        record = dict(params)
+        record.update(build_record)
+        record['estimated_memory'] = int(sum(_array_bytes(array) for array in vp_tree.get_tree_arrays().values())
+                                         * scale)
+        record['over_budget'] = memory_budget is not None and record['estimated_memory'] > memory_budget
+        record['tree_height'] = vp_tree.get_tree_height()
+        record['ranges'] = [benchmark_tree(vp_tree, queries, query_range, brute_force_count=0)
+                            for query_range in query_ranges]
+        record['latency_mean'] = float(np.mean([item['latency_mean'] for item in record['ranges']]))
+        record['average_cal_dis_times'] = float(np.mean([item['average_cal_dis_times']
+                                                         for item in record['ranges']]))
+        candidates.append(record)
+
+    candidates.sort(key=lambda item: (item['over_budget'], item[OBJECTIVES[objective]]))
+    if len(candidates) == 0:
+        raise ValueError('there should be at least one candidate')
+    if candidates[0]['over_budget']:
+        raise ValueError('no candidate fits in the memory budget, the smallest tree needs about %d bytes' %
+                         min(record['estimated_memory'] for record in candidates))
+    best = candidates[0]
+    return {'params': {name: best[name] for name in ('tree_ways', 'leaf_capacity', 'selecting_vp_mode')},
+            'objective': objective, 'memory_budget': memory_budget, 'query_ranges': [float(r) for r in query_ranges],
+            'sample_size': len(sample), 'query_count': len(queries), 'candidates': candidates}
+
+
+def choose_query_ranges(sample, queries, distance_fun, rng, neighbor_ratios=DEFAULT_NEIGHBOR_RATIOS,
+                        query_indexes=None):
+    """
+    根据查询到样本点的距离分布选择查询半径，使查询平均找到neighbor_ratios比例的数据
+    查询本身在样本中时不计入它到自己的距离，否则距离为0的自身匹配会占据较小的百分位数，选出半径为0的查询
+    :param sample: 数据样本
+    :param queries: 查询数据
+    :param distance_fun: 距离计算函数或Metric
+    :param rng: 随机数生成器
+    :param neighbor_ratios: 希望找到的近邻占数据的比例
+    :param query_indexes: 每个查询在样本中的位置，查询不是从样本中抽取时为None
+    :return: 查询半径列表
+    """
+    point_indexes = rng.choice(len(sample), min(RADIUS_SAMPLE_COUNT, len(sample)), replace=False)
+    distances = []
+    for i, query in enumerate(queries[:RADIUS_QUERY_COUNT]):
+        for j in point_indexes:
+            if query_indexes is None or query_indexes[i] != j:
+                distances.append(distance_fun(query, sample[j]))
+    if len(distances) == 0:
+        raise ValueError('there should be at least two data points to choose query ranges')
+    return [float(np.percentile(distances, ratio * 100)) for ratio in neighbor_ratios]
+
+
+def format_report(report):
+    """
+    将auto_tune的结果整理为可以打印的文本
+    :param report: auto_tune的结果
+    :return:
+    """
+    lines = ['chosen params: %s (objective: %s, sample size: %d, %d queries, query ranges: %s)' %
+             (report['params'], report['objective'], report['sample_size'], report['query_count'],
+              ', '.join('%g' % r for r in report['query_ranges']))]
+    for record in report['candidates']:
+        lines.append('  ways=%-3d leaf=%-4d %-7s latency %.3fms, %.1f distances, build %.3fs, memory %.1fMB%s' %
+                     (record['tree_ways'], record['leaf_capacity'], record['selecting_vp_mode'],
+                      record['latency_mean'] * 1000, record['average_cal_dis_times'], record['build_time'],
+                      record['estimated_memory'] / 2 ** 20, ' (over budget)' if record['over_budget'] else ''))
+    return '\n'.join(lines)
+
+
+def _array_bytes(array):
+    """
+    估计数组占用的字节数，object类型的字符串数组计入每个字符串的长度
+    :param array: 数组
+    :return:
+    """
+    if array.dtype == object:
+        return array.nbytes + sum(len(item) for item in array)
+    return array.nbytes
+
+
+def main(argv=None):
+    """
+    命令行入口，例如：
+    python auto_tuner.py --data-file data.csv --data-type num --objective distance --memory-budget-mb 512
+    :param argv: 命令行参数，为None时使用sys.argv
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='choose VP tree parameters on a sample of the data')
+    parser.add_argument('--data-file', required=True, help='.csv, .npy, .bin or .raw data file')
+    parser.add_argument('--data-type', choices=('num', 'string'), default='num')
+    parser.add_argument('--data-dim', type=int, help='dimension of raw binary files')
+    parser.add_argument('--query-ranges', type=float, nargs='+', help='default: chosen from the data')
+    parser.add_argument('--sample-size', type=int, default=10000)
+    parser.add_argument('--query-count', type=int, default=50)
+    parser.add_argument('--tree-ways', type=int, nargs='+', default=list(DEFAULT_TREE_WAYS))
+    parser.add_argument('--leaf-capacities', type=int, nargs='+', default=list(DEFAULT_LEAF_CAPACITIES))
+    parser.add_argument('--selecting-vp-modes', choices=('random', 'max_std'), nargs='+',
+                        default=list(DEFAULT_SELECTING_VP_MODES))
+    parser.add_argument('--objective', choices=tuple(OBJECTIVES), default='latency')
+    parser.add_argument('--memory-budget-mb', type=float, help='estimated size limit of the full tree')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save the report as json')
+    args = parser.parse_args(argv)
+
+    data = load_data(args.data_file, args.data_type, args.data_dim)
+    distance_fun = edit_distance if args.data_type == 'string' else euclidean_distance
+    memory_budget = None if args.memory_budget_mb is None else args.memory_budget_mb * 2 ** 20
+    report = auto_tune(data, distance_fun, args.data_type, None, args.query_ranges, args.sample_size,
+                       args.query_count, args.tree_ways, args.leaf_capacities, args.selecting_vp_modes,
+                       args.objective, memory_budget, args.seed)
+    print(format_report(report))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('save file:', args.output)
+
+
+if __name__ == '__main__':
+    main()
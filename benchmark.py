@@ -0,0 +1,249 @@
+import argparse
+import itertools
+import json
+import platform
+import random
+import time
+import tracemalloc
+import numpy as np
+from vp_tree import VPTree
+from mvp_tree import MVPTree
+from utils import euclidean_distance, edit_distance, create_float_data, create_string_data
+
+# 记录的查询延迟百分位数
+LATENCY_PERCENTILES = (50, 90, 99)
+# 可以测试的树的类型
+TREE_CLASSES = {'vp': VPTree, 'mvp': MVPTree}
+
+
+def create_queries(data_type, query_count, data_dim=0, min_length=1, max_length=1, min_value=0.0, max_value=1.0,
+                   rng=None):
+    """
+    生成随机查询数据，与生成数据集的方式相同，数值数据的每一维均匀分布在min_value与max_value之间
+    :param data_type: 数据类型，string or num
+    :param query_count: 查询个数
+    :param data_dim: 数值数据的维度
+    :param min_length: 字符串的最小长度
+    :param max_length: 字符串的最大长度
+    :param min_value: 数值数据的最小值
+    :param max_value: 数值数据的最大值
+    :param rng: 随机数生成器，字符串数据为random.Random，数值数据为np.random.RandomState，为None时使用全局的随机状态
+    :return:
+    """
+    if data_type == 'string':
+        return create_string_data(query_count, min_length, max_length, rng).tolist()
+    return list(create_float_data(query_count, data_dim, rng) * (max_value - min_value) + min_value)
+
+
+def measure_build(data, distance_fun, data_type, measure_memory=True, tree_class=VPTree, **params):
+    """
+    创建VP树，记录建树时间与建树过程中的峰值内存
+    峰值内存使用tracemalloc在另一次建树中单独测量，避免内存跟踪影响建树时间
+    :param data: 数据集
+    :param distance_fun: 距离计算函数
+    :param data_type: 数据类型，string or num
+    :param measure_memory: 是否测量峰值内存
+    :param tree_class: 树的类型，VPTree或MVPTree
+    :param params: 树的其余参数
+    :return: 树，以及包含build_time、build_peak_memory的字典
+    """
+    start = time.perf_counter()
+    vp_tree = tree_class(data, distance_fun, data_type, **params)
+    record = {'build_time': time.perf_counter() - start, 'build_peak_memory': None}
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            tree_class(data, distance_fun, data_type, **params)
+            record['build_peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return vp_tree, record
+
+
+def benchmark_tree(vp_tree, queries, query_range, brute_force_count=None, max_distance_times=None, epsilon=0):
+    """
+    在VP树上执行一组范围查询，记录查询延迟、距离计算次数以及相对暴力搜索的加速比
+    设置max_distance_times或epsilon时进行近似搜索，并以暴力搜索的结果为准计算召回率
+    :param vp_tree: 已经建好的VP树，也可以是MVP树（不支持近似搜索）
+    :param queries: 查询数据
+    :param query_range: 查询半径
+    :param brute_force_count: 用来测量暴力搜索与召回率的查询个数，为None时使用所有查询，为0时不测量
+    :param max_distance_times: 近似搜索最多计算距离的次数，为None时不限制
+    :param epsilon: 近似搜索剪枝半径的缩小比例
+    :return: 测量结果字典
+    """
+    latencies = []
+    cal_distance_times = []
+    neighbor_counts = []
+    exact_count = 0
+    found_ids = []
+    # 只在需要时传入近似搜索的参数，MVP树没有这些参数
+    approximate_params = dict()
+    if max_distance_times is not None or epsilon > 0:
+        approximate_params = {'max_distance_times': max_distance_times, 'epsilon': epsilon}
+    for query in queries:
+        start = time.perf_counter()
+        result = vp_tree.range_search(query, query_range, return_ids=True, **approximate_params)
+        latencies.append(time.perf_counter() - start)
+        cal_distance_times.append(result['cal_distance_times'])
+        neighbor_counts.append(len(result['ids']))
+        exact_count += result['exact']
+        found_ids.append(result['ids'])
+    latencies = np.array(latencies)
+    record = {'query_range': query_range, 'query_count': len(queries),
+              'max_distance_times': max_distance_times, 'epsilon': epsilon,
+              'latency_mean': float(latencies.mean()),
+              'average_cal_dis_times': float(np.mean(cal_distance_times)),
+              'average_neighbor_count': float(np.mean(neighbor_counts)),
+              'exact_ratio': exact_count / len(queries),
+              'brute_force_latency_mean': None, 'speedup': None, 'distance_speedup': None, 'recall': None}
+    for percentile in LATENCY_PERCENTILES:
+        record['latency_p%d' % percentile] = float(np.percentile(latencies, percentile))
+
+    brute_force_queries = queries if brute_force_count is None else queries[:brute_force_count]
+    if len(brute_force_queries) > 0:
+        brute_force_latencies = []
+        recalls = []
+        for query, ids in zip(brute_force_queries, found_ids):
+            start = time.perf_counter()
+            truth = vp_tree.brute_force_search(query, query_range, return_ids=True)['ids']
+            brute_force_latencies.append(time.perf_counter() - start)
+            # 没有近邻的查询召回率为1
+            recalls.append(len(np.intersect1d(ids, truth)) / len(truth) if len(truth) > 0 else 1.0)
+        record['brute_force_latency_mean'] = float(np.mean(brute_force_latencies))
+        record['recall'] = float(np.mean(recalls))
+        # 暴力搜索计算所有点的距离，距离计算次数等于树中的数据个数
+        record['speedup'] = record['brute_force_latency_mean'] / record['latency_mean']
+        record['distance_speedup'] = vp_tree.get_data_count_of_tree() / max(record['average_cal_dis_times'], 1)
+    return record
+
+
+def run_benchmark(data_type, data_counts, query_ranges, tree_ways_list=(2,), leaf_capacities=(1,),
+                  selecting_vp_modes=('random',), data_dim=10, min_length=5, max_length=15, query_count=100,
+                  brute_force_count=10, measure_memory=True, seed=0, max_distance_times_list=(None,),
+                  epsilons=(0,), tree_types=('vp',)):
+    """
+    对数据集大小与VP树参数的所有组合创建VP树，并在每个查询半径下进行测试
+    :param data_type: 数据类型，string or num
+    :param data_counts: 数据集大小列表
+    :param query_ranges: 查询半径列表
+    :param tree_ways_list: 划分数列表
+    :param leaf_capacities: 叶子容量列表
+    :param selecting_vp_modes: 支撑点选择模式列表
+    :param data_dim: 数值数据的维度
+    :param min_length: 字符串的最小长度
+    :param max_length: 字符串的最大长度
+    :param query_count: 每个查询半径的查询个数
+    :param brute_force_count: 每个查询半径用来测量暴力搜索的查询个数
+    :param measure_memory: 是否测量建树的峰值内存
+    :param seed: 随机种子，相同的种子生成相同的数据集与查询
+    :param max_distance_times_list: 近似搜索最多计算距离的次数列表，None表示不限制
+    :param epsilons: 近似搜索剪枝半径的缩小比例列表
+    :param tree_types: 树的类型列表，vp or mvp，MVP树不使用支撑点选择模式，也不测试近似搜索的参数组合
+    :return: 每一组参数与查询半径的测量结果列表
+    """
+    if data_type != 'string' and data_type != 'num':
+        raise ValueError('data type should be string or num')
+    distance_fun = edit_distance if data_type == 'string' else euclidean_distance
+    results = []
+    for data_count in data_counts:
+        # 使用局部的随机数生成器，不改变调用者的全局随机状态
+        rng = random.Random(seed) if data_type == 'string' else np.random.RandomState(seed)
+        if data_type == 'string':
+            data = create_string_data(data_count, min_length, max_length, rng)
+        else:
+            data = create_float_data(data_count, data_dim, rng)
+        queries = create_queries(data_type, query_count, data_dim, min_length, max_length, rng=rng)
+        tree_configs = []
+        for tree_type, tree_ways, leaf_capacity, selecting_vp_mode in itertools.product(
+                tree_types, tree_ways_list, leaf_capacities, selecting_vp_modes):
+            params = {'tree_ways': tree_ways, 'leaf_capacity': leaf_capacity}
+            if tree_type == 'vp':
+                params['selecting_vp_mode'] = selecting_vp_mode
+            if (tree_type, params) not in tree_configs:
+                tree_configs.append((tree_type, params))
+        for tree_type, params in tree_configs:
+            vp_tree, build_record = measure_build(data, distance_fun, data_type, measure_memory,
+                                                  TREE_CLASSES[tree_type], **params)
+            for query_range, max_distance_times, epsilon in itertools.product(query_ranges, max_distance_times_list,
+                                                                              epsilons):
+                # MVP树不支持近似搜索，只测试精确搜索
+                if tree_type == 'mvp' and (max_distance_times is not None or epsilon > 0):
+                    continue
+                record = {'tree_type': tree_type, 'data_type': data_type, 'data_count': data_count,
+                          'data_dim': data_dim if data_type == 'num' else 0, 'selecting_vp_mode': None}
+                record.update(params)
+                record.update(build_record)
+                record['tree_height'] = vp_tree.get_tree_height()
+                record['node_count'] = vp_tree.get_node_count()
+                record.update(benchmark_tree(vp_tree, queries, query_range, brute_force_count, max_distance_times,
+                                             epsilon))
+                results.append(record)
+    return results
+
+
+def save_results(results, file_path, config=None):
+    """
+    将测量结果与运行环境保存为json文件
+    :param results: 测量结果列表
+    :param file_path: json文件路径
+    :param config: 生成结果使用的配置
+    :return:
+    """
+    output = {'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                              'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'config': config, 'results': results}
+    with open(file_path, 'w') as f:
+        json.dump(output, f, indent=2)
+
+
+def main(argv=None):
+    """
+    命令行入口，例如：
+    python benchmark.py --data-type num --data-counts 10000 100000 --tree-ways 2 3 --query-ranges 0.1 0.2
+    :param argv: 命令行参数，为None时使用sys.argv
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='benchmark VP tree (or MVP tree) building and range search')
+    parser.add_argument('--data-type', choices=('num', 'string'), default='num')
+    parser.add_argument('--data-counts', type=int, nargs='+', default=[10000])
+    parser.add_argument('--data-dim', type=int, default=10)
+    parser.add_argument('--min-length', type=int, default=5)
+    parser.add_argument('--max-length', type=int, default=15)
+    parser.add_argument('--tree-types', choices=tuple(TREE_CLASSES), nargs='+', default=['vp'])
+    parser.add_argument('--tree-ways', type=int, nargs='+', default=[2])
+    parser.add_argument('--leaf-capacities', type=int, nargs='+', default=[1])
+    parser.add_argument('--selecting-vp-modes', choices=('random', 'max_std'), nargs='+', default=['random'])
+    parser.add_argument('--query-ranges', type=float, nargs='+', default=[0.5])
+    parser.add_argument('--query-count', type=int, default=100)
+    parser.add_argument('--brute-force-count', type=int, default=10,
+                        help='queries per radius also run with brute_force_search, 0 to skip')
+    parser.add_argument('--max-distance-times', type=int, nargs='+', default=[0],
+                        help='distance budgets of approximate search, 0 for no limit')
+    parser.add_argument('--epsilons', type=float, nargs='+', default=[0.0],
+                        help='pruning radius shrink ratios of approximate search')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure peak memory of building')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.data_type, args.data_counts, args.query_ranges, args.tree_ways,
+                            args.leaf_capacities, args.selecting_vp_modes, args.data_dim, args.min_length,
+                            args.max_length, args.query_count, args.brute_force_count, not args.no_memory,
+                            args.seed, [budget if budget > 0 else None for budget in args.max_distance_times],
+                            args.epsilons, args.tree_types)
+    save_results(results, args.output, vars(args))
+    for record in results:
+        print('%s n=%d ways=%d leaf=%d %s r=%g budget=%s eps=%g: build %.3fs, p50 %.2fms, %.1f distances, '
+              'speedup %s, recall %s' %
+              (record['tree_type'], record['data_count'], record['tree_ways'], record['leaf_capacity'],
+               record['selecting_vp_mode'] or '-',
+               record['query_range'], record['max_distance_times'] or '-', record['epsilon'], record['build_time'],
+               record['latency_p50'] * 1000, record['average_cal_dis_times'],
+               '-' if record['speedup'] is None else '%.1fx' % record['speedup'],
+               '-' if record['recall'] is None else '%.3f' % record['recall']))
+    print('save file:', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,10 @@
 from vp_tree import VPTree
 from utils import euclidean_distance, edit_distance
+from data_loader import load_data, RAW_EXTENSIONS
+from benchmark import benchmark_tree, create_queries, save_results
+from auto_tuner import auto_tune, format_report, OBJECTIVES
 import os
-import pandas as pd
 import numpy as np
-import random
-import string
 import math
 
 
@@ -167,31 +167,75 @@ class ConsoleApp:
                     success, query_range_interval = ConsoleApp._input_a_num('interval of query range', float, 0)
                     if not success:
                         continue
-                    # 迭代生成多组数据进行测试
+                    # 每个查询半径使用同一组随机查询，由benchmark模块测量延迟、距离计算次数与相对暴力搜索的加速比
+                    queries = create_queries(self._data_type, testing_times, self._data_dim, min_length, max_length,
+                                             min_value, max_value)
                     query_range = query_range_start
                     testing_result = []
                     print('calculating.....')
                     while query_range <= query_range_end:
                         if math.floor((query_range/query_range_end)*100) % 10 == 0:
                             print('rate of progress : %d percent' % math.floor((query_range/query_range_end)*100))
-                        cal_dis_time = 0
-                        # 生成随机的字符串或随机向量作为测试数据
-                        for i in range(testing_times):
-                            if self._data_type == 'string':
-                                length = random.randint(min_length, max_length)
-                                query_data = ''.join(random.sample(string.ascii_letters + string.digits, length))
-                            else:
-                                query_data = np.random.random(self._data_dim)
-                                query_data = query_data * max_value + min_value
-                            # 在树中进行范围查询
-                            res = self._vp_tree.range_search(query_data, query_range)
-                            cal_dis_time += res['cal_distance_times']
-                        average_time = cal_dis_time / testing_times
-                        testing_result.append({'query_range': query_range, 'average_cal_dis_times': average_time})
-                        # query_range
+                        testing_result.append(benchmark_tree(self._vp_tree, queries, query_range,
+                                                             min(testing_times, 10)))
                         query_range += query_range_interval
                     print('done')
-                    self._save_average_distance_calculating_times_to_csv(testing_result)
+                    self._save_benchmark_results(testing_result)
+            # 将创建好的vp tree保存为索引文件
+            elif selection == 6:
+                if self._vp_tree is None:
+                    print('please create a vp tree first')
+                    continue
+                file_path = input('please input the path of index file:')
+                try:
+                    self._vp_tree.save(file_path)
+                except Exception as e:
+                    print(e)
+                    continue
+                print('save vp tree successfully:', file_path)
+            # 从索引文件中加载vp tree
+            elif selection == 7:
+                file_path = input('please input the path of index file:')
+                if not os.path.exists(file_path):
+                    print('the file does not exist')
+                    continue
+                try:
+                    self._vp_tree = VPTree.load(file_path)
+                except Exception as e:
+                    print(e)
+                    continue
+                self._data_type = self._vp_tree.get_params()['data_type']
+                leaf_data = self._vp_tree.get_tree_arrays()['data']
+                self._data_dim = leaf_data.shape[1] if self._data_type == 'num' else 0
+                print('load vp tree successfully, tree height: %d' % self._vp_tree.get_tree_height())
+                print('data_count:', self._vp_tree.get_data_count_of_tree())
+            # 从文件中读取数据，自动选择参数后创建vp tree
+            elif selection == 8:
+                result = self._get_data_from_file()
+                if not result['success']:
+                    continue
+                objective = input('please input the objective(%s):' % ' or '.join(OBJECTIVES))
+                if objective not in OBJECTIVES:
+                    print('wrong objective:', objective)
+                    continue
+                # 输入内存预算，0表示不限制
+                success, memory_budget = ConsoleApp._input_a_num('memory budget in MB(0 for no limit)', float, -1)
+                if not success:
+                    continue
+                distance_fun = edit_distance if result['data_type'] == 'string' else euclidean_distance
+                print('tuning.....')
+                try:
+                    report = auto_tune(result['data'], distance_fun, result['data_type'], objective=objective,
+                                       memory_budget=memory_budget * 2 ** 20 if memory_budget > 0 else None)
+                except ValueError as e:
+                    print(e)
+                    continue
+                print(format_report(report))
+                self._data_type = result['data_type']
+                self._data_dim = result['data_dim']
+                self._vp_tree = VPTree(result['data'], distance_fun, data_type=self._data_type, **report['params'])
+                print('create vp tree successfully, tree height: %d' % self._vp_tree.get_tree_height())
+                print('data_count:', self._vp_tree.get_data_count_of_tree())
             # 清空console
             elif selection == 5:
                 print("\n"*30)
@@ -210,8 +254,11 @@ class ConsoleApp:
               "type 1 to input data from keyboard and create a VP tree\n"
               "type 2 to input data from file and create a VP tree\n"
               "type 3 to search in VP tree\n"
-              "type 4 to test performance of VP tree\n"
+              "type 4 to test performance of VP tree (python benchmark.py for scripted sweeps)\n"
               "type 5 to clean the console\n"
+              "type 6 to save VP tree to an index file\n"
+              "type 7 to load VP tree from an index file\n"
+              "type 8 to input data from file and create a VP tree with auto-tuned parameters\n"
               "type 0 to exit\n"
               "-----------------------------------------------------\n")
 
@@ -288,24 +335,23 @@ class ConsoleApp:
         if data_type != "string" and data_type != "num":
             print("wrong data type")
             return result
-        # 输入csv文件路径
-        file_path = input('please input the path of csv data file:')
+        # 输入数据文件路径，支持csv文件、.npy文件与原始二进制文件
+        file_path = input('please input the path of data file(.csv, .npy, .bin or .raw):')
         if not os.path.exists(file_path):
             print('the file does not exist')
             return result
         else:
+            raw_dim = None
+            # 原始二进制文件中没有维度信息，需要输入数据的维度
+            if os.path.splitext(file_path)[1].lower() in RAW_EXTENSIONS:
+                success, raw_dim = ConsoleApp._input_a_num('dimension of point', int, 0)
+                if not success:
+                    return result
             try:
-                # 从文件中读取数据
+                # 从文件中分块读取数据
+                data = load_data(file_path, data_type, data_dim=raw_dim)
                 if data_type == 'num':
-                    data = pd.read_csv(file_path, dtype=float)
-                    data = data.values[:, 1:]
                     data_dim = data.shape[1]
-                else:
-                    data = pd.read_csv(file_path, dtype=str)
-                    data = data.values[:, 1:]
-                    data = np.squeeze(data)
-                    if len(data.shape) > 1:
-                        raise ValueError('wrong data type in file')
             except Exception as e:
                 print(e)
                 return result
@@ -351,33 +397,22 @@ class ConsoleApp:
         for neig in neighbors:
             print('neighbor:', neig['object'], '\tdistance: %0.3f' % neig['distance'])
 
-    def _save_average_distance_calculating_times_to_csv(self, result):
+    def _save_benchmark_results(self, result):
         """
-        将自动测试得到的每一轮的平均搜索次数存放到csv文件中
+        将自动测试得到的每一轮的测量结果与VP树的参数存放到json文件中
         :param result:
         :return:
         """
-        data = []
-        for res in result:
-            data.append([res['query_range'], res['average_cal_dis_times']])
-        # 获取VP树的各种参数，以便命名文件
-        tree_way = self._vp_tree.get_tree_way()
-        leaf_capacity = self._vp_tree.get_leaf_capacity()
-        selecting_vp_mode = self._vp_tree.get_selecting_vp_mode()
-        tree_height = self._vp_tree.get_tree_height()
-        # 创建csv文件路径
-        file_name = 'ave_dis_cal_times#data_type_%s#tree_ways_%s#leaf_capacity_%s#tree_height_%s#selecting_vp_mode_%s' % \
-                    (self._data_type, str(tree_way), str(leaf_capacity), str(tree_height), str(selecting_vp_mode))
+        config = self._vp_tree.get_params()
+        config['tree_height'] = self._vp_tree.get_tree_height()
+        config['data_count'] = self._vp_tree.get_data_count_of_tree()
         ind = 1
-        file_path = os.path.join('./', file_name + '.csv')
+        file_path = os.path.join('./', 'benchmark.json')
         # 检查文件路径是否已存在
         while os.path.exists(file_path):
-            file_path = os.path.join('./', file_name + str(ind)+'.csv')
+            file_path = os.path.join('./', 'benchmark' + str(ind) + '.json')
             ind += 1
-
-        # 使用pandas将数据存放到csv文件中
-        data_frame = pd.DataFrame(result, columns=['query_range', 'average_cal_dis_times'])
-        data_frame.to_csv(file_path, index=True, sep=',')
+        save_results(result, file_path, config)
         print('save file:', file_path)
 
     @staticmethod
@@ -0,0 +1,138 @@
+import csv
+import itertools
+import os
+import numpy as np
+
+# 分块读取csv文件时每块的行数
+CSV_CHUNK_ROWS = 65536
+# 可以直接内存映射的原始二进制文件的扩展名
+RAW_EXTENSIONS = ('.bin', '.raw')
+
+
+def load_data(file_path, data_type, data_dim=None, dtype='float64', out_path=None, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    根据文件扩展名读取数据，结果可以直接传给VPTree
+    .npy文件与原始二进制文件直接内存映射，不进行解析；其余文件作为csv文件分块读取
+    :param file_path: 数据文件路径
+    :param data_type: 数据类型，string or num
+    :param data_dim: 原始二进制文件中每个点的维度
+    :param dtype: 原始二进制文件中数据的类型
+    :param out_path: 数值csv文件的读取结果存放的.npy文件路径，为None时存放在内存中
+    :param chunk_rows: 读取csv文件时每块的行数
+    :return:
+    """
+    if data_type != 'string' and data_type != 'num':
+        raise ValueError('data type should be string or num')
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == '.npy':
+        return load_npy_data(file_path, data_type)
+    if extension in RAW_EXTENSIONS:
+        if data_type != 'num':
+            raise ValueError('raw binary file only supports num data')
+        return load_raw_data(file_path, data_dim, dtype)
+    if data_type == 'num':
+        return load_num_csv(file_path, out_path, chunk_rows)
+    return load_string_csv(file_path)
+
+
+def load_npy_data(file_path, data_type='num'):
+    """
+    以只读内存映射的方式加载.npy文件
+    :param file_path: 文件路径
+    :param data_type: 数据类型，数值数据为二维数组，字符串数据为一维数组
+    :return:
+    """
+    if data_type == 'string':
+        data = np.load(file_path)
+        if data.ndim != 1 or data.dtype.kind != 'U':
+            raise ValueError('string data should be a 1-D str array')
+        return data
+    data = np.load(file_path, mmap_mode='r')
+    if data.ndim != 2:
+        raise ValueError('num data should be a 2-D array')
+    return data
+
+
+def load_raw_data(file_path, data_dim, dtype='float64'):
+    """
+    以只读内存映射的方式加载没有文件头的原始二进制文件，每个点连续存放data_dim个dtype类型的数
+    :param file_path: 文件路径
+    :param data_dim: 每个点的维度
+    :param dtype: 数据的类型
+    :return:
+    """
+    if not isinstance(data_dim, int) or data_dim < 1:
+        raise ValueError('data_dim should be a positive integer')
+    dtype = np.dtype(dtype)
+    row_bytes = data_dim * dtype.itemsize
+    file_size = os.path.getsize(file_path)
+    if file_size % row_bytes != 0:
+        raise ValueError('file size is not a multiple of %d bytes' % row_bytes)
+    return np.memmap(file_path, dtype=dtype, mode='r', shape=(file_size // row_bytes, data_dim))
+
+
+def load_num_csv(file_path, out_path=None, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    分块读取数值csv文件，第一行为表头，第一列为行号，其余各列为点的坐标
+    先统计行数并预先分配结果数组，再逐块解析写入，不创建DataFrame，也不复制整个文件的数据
+    :param file_path: 文件路径
+    :param out_path: 结果存放的.npy文件路径，为None时存放在内存中
+    :param chunk_rows: 每块的行数
+    :return:
+    """
+    if not isinstance(chunk_rows, int) or chunk_rows < 1:
+        raise ValueError('chunk_rows should be a positive integer')
+    row_count = count_lines(file_path) - 1
+    with open(file_path, 'r', newline='') as f:
+        header = next(csv.reader([f.readline()]), [])
+        data_dim = len(header) - 1
+        if data_dim < 1:
+            raise ValueError('csv file should have an index column and at least one data column')
+        shape = (max(row_count, 0), data_dim)
+        if out_path is None:
+            data = np.empty(shape, dtype=np.float64)
+        else:
+            data = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float64, shape=shape)
+        filled = 0
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if len(lines) == 0:
+                break
+            chunk = np.loadtxt(lines, delimiter=',', dtype=np.float64, usecols=range(1, data_dim + 1), ndmin=2)
+            data[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+    # 空行不计入数据，结果只保留实际读取的行
+    return data[:filled]
+
+
+def load_string_csv(file_path):
+    """
+    读取字符串csv文件，第一行为表头，第一列为行号，第二列为字符串
+    结果为object类型的一维数组，每个字符串只占用自身长度的空间，不会因为个别很长的字符串按最长长度填充每一行
+    :param file_path: 文件路径
+    :return:
+    """
+    strings = []
+    with open(file_path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            if len(row) == 0:
+                continue
+            if len(row) != 2:
+                raise ValueError('wrong data type in file')
+            strings.append(row[1])
+    data = np.empty(len(strings), dtype=object)
+    data[:] = strings
+    return data
+
+
+def count_lines(file_path):
+    """
+    统计文件的行数，最后一行没有换行符时也计入
+    与解析时一样以newline=''的文本模式逐行读取，\r、\n与\r\n都作为换行符，统计的行数与解析时读到的行数一致
+    :param file_path: 文件路径
+    :return:
+    """
+    with open(file_path, 'r', newline='') as f:
+        return sum(1 for _ in f)
@@ -1,6 +1,22 @@
+import argparse
 from console_app import ConsoleApp
+from query_server import serve, DEFAULT_BATCH_SIZE, DEFAULT_MAX_WAIT
 
 if __name__ == "__main__":
-    # 创建console app在终端中接受用户输入，创建vp tree
-    console_app = ConsoleApp()
-    console_app.main()
+    parser = argparse.ArgumentParser(description='VP tree console app, or a local query server with --serve')
+    parser.add_argument('--serve', metavar='INDEX', help='load an index saved by VPTree.save and serve queries')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', metavar='PATH', help='listen on a unix socket instead of tcp')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--max-wait', type=float, default=DEFAULT_MAX_WAIT,
+                        help='seconds to wait for more queries before running a batch')
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        # 加载索引文件，通过socket接受查询
+        serve(args.serve, args.host, args.port, args.unix, args.batch_size, args.max_wait)
+    else:
+        # 创建console app在终端中接受用户输入，创建vp tree
+        console_app = ConsoleApp()
+        console_app.main()
@@ -0,0 +1,157 @@
+import numpy as np
+from metrics import get_metric
+
+# 建树时批量计算距离的分块大小，限制临时复制的数据量
+BUILD_CHUNK_SIZE = 65536
+# 待计算的点不少于该个数时，才使用预先计算的距离下界表一次过滤所有点，
+# 只有一个点时批量计算下界的开销（约为两次有界编辑距离）超过能节省的距离计算
+FILTER_MIN_BLOCK_SIZE = 2
+
+
+class MetricTree:
+    """
+    VPTree与MVPTree共用的距离计算、叶子顺序搜索与搜索结果的创建
+    子类在建树后设置self._data（按树的布局重新排列后的数据）、self._ids（每个点在原始数据中的行号）
+    与self._filter_table（_make_filter_table计算的距离下界表）
+    """
+    def _set_metric(self, distance_fun, data_type):
+        """
+        检查并设置距离函数与数据类型，根据Metric提供的函数选择叶子中的距离计算方式
+        :param distance_fun: 距离计算函数或Metric
+        :param data_type: 数据类型，string or num
+        :return:
+        """
+        if data_type != 'string' and data_type != 'num':
+            raise ValueError('data type should be string or num')
+        self._distance_fun = distance_fun  # 距离计算函数或Metric
+        self._metric = get_metric(distance_fun)  # 实际用来计算距离的Metric
+        if not self._metric.triangle_inequality:
+            raise ValueError('%s needs a distance satisfying the triangle inequality' % type(self).__name__)
+        self._data_type = data_type
+        # 数值数据的批量距离函数，一次计算一个叶子中所有点到查询点的距离，Metric没有提供批量函数时为None
+        self._block_distance_fun = self._metric.distances \
+            if data_type == 'num' and self._metric.vectorized else None
+        # 字符串数据的有界距离函数，Metric没有提供时为None
+        self._bounded_distance_fun = self._metric.bounded_distance \
+            if data_type == 'string' and self._metric.bounded else None
+
+    def get_distance_fun(self):
+        """
+        返回树的距离计算函数
+        :return:
+        """
+        return self._distance_fun
+
+    def _make_filter_table(self, data):
+        """
+        为data中的每个点计算距离下界表，只有字符串数据并且Metric提供有界距离函数时才计算，否则为0列的数组
+        :param data: 多个数据点
+        :return:
+        """
+        if self._bounded_distance_fun is None:
+            return np.zeros((len(data), 0), dtype=np.uint16)
+        return self._metric.filter_table(data)
+
+    def _distances_to_point(self, data, indexes, point):
+        """
+        计算data中下标为indexes的每个点到point的距离
+        数值数据分块批量计算，避免一次复制整个数据子集
+        :param data: 数据集
+        :param indexes: 数据点的下标
+        :param point: 支撑点
+        :return:
+        """
+        if self._block_distance_fun is not None:
+            distances = np.empty(len(indexes), dtype=np.float64)
+            for i in range(0, len(indexes), BUILD_CHUNK_SIZE):
+                distances[i:i + BUILD_CHUNK_SIZE] = self._block_distance_fun(data[indexes[i:i + BUILD_CHUNK_SIZE]], point)
+            return distances
+        return np.array([self._metric.distance(point, data[i]) for i in indexes], dtype=np.float64)
+
+    def _sequential_scan(self, data, query_point, query_range, use_filters=True, filter_table=None,
+                         stop_at_first=False):
+        """
+        VPTree.sequential_search使用的顺序搜索，返回近邻在data中的下标与距离，不创建结果字典
+        :param data: 多个数据点
+        :param query_point: 查询数据
+        :param query_range: 与查询数据之间的最大距离
+        :param use_filters: 是否使用距离下界过滤与有界距离函数
+        :param filter_table: 与data对应的距离下界表，为None时只用长度差过滤
+        :param stop_at_first: 是否在找到第一个近邻后立即返回，逐点计算距离时剩余的点不再计算
+        :return: 近邻在data中的下标，近邻的距离，距离计算次数，被过滤的点数
+        """
+        if data is None or len(data) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), 0, 0
+        # 数值数据将整个叶子作为一个数据块，一次计算所有点到query_point的距离
+        if self._block_distance_fun is not None:
+            # Metric提供代理值时先用代理值筛选候选点，只对候选点计算真实距离
+            if self._metric.has_surrogate:
+                values = self._metric.surrogate_distances(data, query_point)
+                indexes = np.flatnonzero(values <= self._metric.surrogate_bound(query_range))
+                distances = self._metric.from_surrogate(values[indexes])
+                hits = distances <= query_range
+                return indexes[hits], distances[hits], len(data), 0
+            distances = self._block_distance_fun(data, query_point)
+            indexes = np.flatnonzero(distances <= query_range)
+            return indexes, distances[indexes], len(data), 0
+        indexes = []
+        distances = []
+        cal_distance_times = 0
+        filtered_times = 0
+        if use_filters and self._bounded_distance_fun is not None:
+            candidates = range(len(data))
+            # 用预先计算的表一次计算所有点的直方图下界，逐点计算直方图的开销与计算距离相当
+            if filter_table is not None and filter_table.shape[1] > 0 and len(data) >= FILTER_MIN_BLOCK_SIZE:
+                candidates = np.flatnonzero(self._metric.lower_bounds(filter_table, query_point) <= query_range)
+                filtered_times += len(data) - len(candidates)
+            query_length = len(query_point)
+            for i in candidates:
+                point = data[i]
+                if abs(len(point) - query_length) > query_range:
+                    filtered_times += 1
+                    continue
+                dis = self._bounded_distance_fun(point, query_point, query_range)
+                cal_distance_times += 1
+                if dis <= query_range:
+                    indexes.append(i)
+                    distances.append(dis)
+                    if stop_at_first:
+                        break
+        else:
+            # 按顺序比较data中的每一个点到query_point的距离
+            for i, point in enumerate(data):
+                dis = self._metric.distance(point, query_point)
+                cal_distance_times += 1
+                if dis <= query_range:
+                    indexes.append(i)
+                    distances.append(dis)
+                    if stop_at_first:
+                        break
+        return np.array(indexes, dtype=np.int64), np.array(distances, dtype=np.float64), cal_distance_times, \
+            filtered_times
+
+    def _make_result(self, positions, distances, cal_distance_times, filtered_times, return_ids, exact=True):
+        """
+        根据近邻在self._data中的位置与距离创建搜索结果
+        :param positions: 近邻位置数组的列表
+        :param distances: 与positions对应的近邻距离数组的列表
+        :param cal_distance_times: 距离计算次数
+        :param filtered_times: 被过滤的点数
+        :param return_ids: 为True时结果中的ids与distances为NumPy数组，ids为近邻的原始行号；
+                           否则neighbors为{'object': 数据点, 'distance': 距离}的列表
+        :param exact: 结果是否与精确搜索相同
+        :return:
+        """
+        positions = np.concatenate(positions) if len(positions) > 0 else np.empty(0, dtype=np.int64)
+        distances = np.concatenate(distances) if len(distances) > 0 else np.empty(0, dtype=np.float64)
+        result = dict()
+        if return_ids:
+            result['ids'] = self._ids[positions]
+            result['distances'] = distances
+        else:
+            result['neighbors'] = [{'object': self._data[position], 'distance': dis}
+                                   for position, dis in zip(positions, distances)]
+        result['cal_distance_times'] = int(cal_distance_times)
+        result['filtered_times'] = int(filtered_times)
+        result['exact'] = exact
+        return result
@@ -0,0 +1,258 @@
+import numpy as np
+from utils import euclidean_distance, edit_distance, edit_distance_bounded, edit_distance_filter_table, \
+    edit_distance_lower_bounds
+
+# 用代理值筛选候选点时放宽的相对误差，筛选后的候选点再用真实距离判断，避免舍入误差漏掉边界上的点
+SURROGATE_TOLERANCE = 1e-9
+
+
+class Metric:
+    """
+    VP树使用的距离度量接口，数值数据可能以float32或整数编码存放，距离应当以float64累加
+    子类必须实现distance(a, b)，并可以选择性地提供：
+    distances(points, b): 一次计算多个点到b的距离的一对多批量函数，此时将vectorized设为True
+    surrogate_distances(points, b): 与距离单调一致、计算代价更低的代理值（例如平方L2距离），此时将has_surrogate设为True，
+                                    并实现surrogate_bound与from_surrogate，只需要比较大小时使用代理值
+    bounded_distance(a, b, max_distance): 只需要判断距离是否在范围内时使用，此时将bounded设为True
+    filter_table(points)与lower_bounds(table, b): 建树时为每个点预先计算的表，搜索时用它一次计算多个点的距离下界，
+                                                   默认的表为0列，不进行过滤
+    name为模块中该度量实例的变量名，VPTree.save根据它记录距离函数
+    """
+    name = None
+    vectorized = False  # 是否提供一对多批量函数
+    has_surrogate = False  # 是否提供单调一致的代理值
+    bounded = False  # 是否提供有界距离函数
+    symmetric = True  # d(a, b) == d(b, a)
+    triangle_inequality = True  # 满足三角不等式，VP树的剪枝依赖于此
+    # 由单调的范数诱导的度量 d(a, b) = ||a - b||，满足 d(s * a + t, s * b + t) == s * d(a, b)，
+    # 可以直接在缩放平移后的整数编码上计算距离
+    homogeneous = False
+
+    def __call__(self, a, b):
+        return self.distance(a, b)
+
+    def distance(self, a, b):
+        """
+        计算a,b之间的距离
+        :param a: 点a
+        :param b: 点b
+        :return:
+        """
+        raise NotImplementedError
+
+    def distances(self, points, b):
+        """
+        计算points中每一个点到b之间的距离，默认逐点调用distance
+        :param points: 多个点
+        :param b: 点b
+        :return: 距离组成的一维数组
+        """
+        return np.array([self.distance(point, b) for point in points], dtype=np.float64)
+
+    def surrogate_distances(self, points, b):
+        """
+        计算points中每一个点到b之间距离的代理值，默认就是距离本身
+        :param points: 多个点
+        :param b: 点b
+        :return:
+        """
+        return self.distances(points, b)
+
+    def surrogate_bound(self, max_distance):
+        """
+        距离不超过max_distance的点的代理值上界，可以略微放宽
+        :param max_distance: 最大距离
+        :return:
+        """
+        return max_distance
+
+    def from_surrogate(self, values):
+        """
+        由代理值计算真实距离
+        :param values: 代理值数组
+        :return:
+        """
+        return values
+
+    def filter_table(self, points):
+        """
+        为每个点预先计算用于lower_bounds的表，默认为0列的数组
+        :param points: 多个点
+        :return: 第一维与points对应的二维数组
+        """
+        return np.zeros((len(points), 0), dtype=np.uint16)
+
+    def lower_bounds(self, table, b):
+        """
+        根据filter_table计算的表，一次计算多个点到b之间距离的下界，默认为0
+        :param table: filter_table计算的表
+        :param b: 点b
+        :return: 距离下界组成的一维数组
+        """
+        return np.zeros(len(table), dtype=np.float64)
+
+
+class FunctionMetric(Metric):
+    """
+    包装普通的距离函数distance_fun(a, b)，逐点调用
+    """
+    def __init__(self, distance_fun):
+        """
+        构造函数
+        :param distance_fun: 距离计算函数
+        """
+        if not callable(distance_fun):
+            raise ValueError('distance_fun should be callable or a Metric')
+        # 直接作为实例属性，调用时不经过额外的一层函数
+        self.distance = distance_fun
+
+
+class L1Metric(Metric):
+    """
+    曼哈顿距离
+    """
+    name = 'L1'
+    vectorized = True
+    homogeneous = True
+
+    def distance(self, a, b):
+        return np.sum(np.abs(np.subtract(a, b, dtype=np.float64)))
+
+    def distances(self, points, b):
+        _check_points(points, b)
+        return np.sum(np.abs(np.subtract(points, b, dtype=np.float64)), axis=1)
+
+
+class L2Metric(Metric):
+    """
+    欧几里得距离，结果与utils.euclidean_distance相同，比较大小时使用平方距离，只对候选点开方
+    """
+    name = 'L2'
+    vectorized = True
+    has_surrogate = True
+    homogeneous = True
+
+    def distance(self, a, b):
+        diff = np.subtract(a, b, dtype=np.float64)
+        return np.sqrt(np.sum(diff * diff))
+
+    def distances(self, points, b):
+        return np.sqrt(self.surrogate_distances(points, b))
+
+    def surrogate_distances(self, points, b):
+        _check_points(points, b)
+        diff = np.subtract(points, b, dtype=np.float64)
+        return np.sum(diff * diff, axis=1)
+
+    def surrogate_bound(self, max_distance):
+        return max_distance * max_distance * (1 + SURROGATE_TOLERANCE)
+
+    def from_surrogate(self, values):
+        return np.sqrt(values)
+
+
+class LinfMetric(Metric):
+    """
+    切比雪夫距离
+    """
+    name = 'LINF'
+    vectorized = True
+    homogeneous = True
+
+    def distance(self, a, b):
+        return np.max(np.abs(np.subtract(a, b, dtype=np.float64)))
+
+    def distances(self, points, b):
+        _check_points(points, b)
+        return np.max(np.abs(np.subtract(points, b, dtype=np.float64)), axis=1)
+
+
+class CosineAngleMetric(Metric):
+    """
+    两个向量之间的夹角（弧度），与余弦相似度单调一致且满足三角不等式
+    零向量与任意向量的夹角记为pi/2
+    比较大小时使用负的余弦相似度作为代理值，只对候选点计算arccos
+    """
+    name = 'COSINE_ANGLE'
+    vectorized = True
+    has_surrogate = True
+
+    def distance(self, a, b):
+        a = np.asarray(a, dtype=np.float64)
+        b = np.asarray(b, dtype=np.float64)
+        norm = np.linalg.norm(a) * np.linalg.norm(b)
+        cosine = np.dot(a, b) / norm if norm > 0 else 0.0
+        return np.arccos(np.clip(cosine, -1.0, 1.0))
+
+    def distances(self, points, b):
+        return self.from_surrogate(self.surrogate_distances(points, b))
+
+    def surrogate_distances(self, points, b):
+        _check_points(points, b)
+        points = np.asarray(points, dtype=np.float64)
+        b = np.asarray(b, dtype=np.float64)
+        norms = np.linalg.norm(points, axis=1) * np.linalg.norm(b)
+        dots = points @ b
+        cosines = np.divide(dots, norms, out=np.zeros(len(points), dtype=np.float64), where=norms > 0)
+        return -np.clip(cosines, -1.0, 1.0)
+
+    def surrogate_bound(self, max_distance):
+        if max_distance >= np.pi:
+            return np.inf
+        return -np.cos(max_distance) + SURROGATE_TOLERANCE
+
+    def from_surrogate(self, values):
+        return np.arccos(-values)
+
+
+class EditMetric(Metric):
+    """
+    字符串的编辑距离，提供有界距离函数，预先计算的表为每个字符串的长度与字符直方图
+    """
+    name = 'EDIT'
+    bounded = True
+
+    def distance(self, a, b):
+        return edit_distance(a, b)
+
+    def bounded_distance(self, a, b, max_distance):
+        return edit_distance_bounded(a, b, max_distance)
+
+    def filter_table(self, points):
+        return edit_distance_filter_table(points)
+
+    def lower_bounds(self, table, b):
+        return edit_distance_lower_bounds(table, b)
+
+
+L1 = L1Metric()
+L2 = L2Metric()
+LINF = LinfMetric()
+COSINE_ANGLE = CosineAngleMetric()
+EDIT = EditMetric()
+# utils中的距离函数对应的内置度量
+BUILTIN_METRICS = {euclidean_distance: L2, edit_distance: EDIT}
+
+
+def get_metric(distance_fun):
+    """
+    将距离函数转换为Metric，Metric直接返回，utils中的距离函数使用对应的内置度量，其余函数逐点调用
+    :param distance_fun: Metric或距离计算函数
+    :return:
+    """
+    if isinstance(distance_fun, Metric):
+        return distance_fun
+    if distance_fun in BUILTIN_METRICS:
+        return BUILTIN_METRICS[distance_fun]
+    return FunctionMetric(distance_fun)
+
+
+def _check_points(points, b):
+    """
+    检查批量函数的参数
+    :param points: 多个点组成的二维数组
+    :param b: 点b
+    :return:
+    """
+    if points.ndim != 2 or points.shape[1] != len(b):
+        raise ValueError('dimension of points and length of b should be equal')
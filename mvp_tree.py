@@ -0,0 +1,240 @@
+import random
+import numpy as np
+from metric_tree import MetricTree
+
+# 每个内部节点的支撑点个数
+NODE_VP_COUNT = 2
+
+
+class MVPTree(MetricTree):
+    """
+    多支撑点树（MVP树）
+    每个内部节点有两个支撑点：先按到第一个支撑点的距离把节点中的其余数据划分为tree_ways个壳层，
+    每个壳层再按到第二个支撑点的距离划分为tree_ways个壳层，共tree_ways * tree_ways个孩子
+    每个点保存到路径上最近path_levels个祖先支撑点的距离，叶子中的点先用这些距离按三角不等式过滤，再计算距离
+    与VPTree一样扁平存放：每个节点占据self._data中一段连续的区间，支撑点存放在区间开头
+    range_search的接口与cal_distance_times的统计方式与VPTree相同，可以直接比较两者的距离计算次数
+    """
+    def __init__(self, data, distance_fun, data_type, tree_ways=2, leaf_capacity=1, path_levels=4):
+        """
+        构造函数
+        :param data: 数据集
+        :param distance_fun: 距离计算函数或Metric
+        :param data_type: 数据类型，string or num
+        :param tree_ways: 每个支撑点划分的壳层数，每个内部节点有tree_ways * tree_ways个孩子
+        :param leaf_capacity: 叶子容量
+        :param path_levels: 每个点保存的路径上的支撑点距离个数
+        """
+        if not isinstance(tree_ways, int) or tree_ways < 2:
+            raise ValueError('tree_ways should be a integer and must bigger than 1')
+        if not isinstance(leaf_capacity, int) or leaf_capacity < 1:
+            raise ValueError('leaf_capacity should be a positive integer')
+        if not isinstance(path_levels, int) or path_levels < 0:
+            raise ValueError('path_levels should be a non-negative integer')
+
+        self._set_metric(distance_fun, data_type)
+        self._tree_ways = tree_ways
+        self._leaf_capacity = leaf_capacity
+        self._path_levels = path_levels
+        self._data = None  # 按树的布局重新排列后的数据
+        self._ids = None  # self._data中每个点在原始数据中的行号
+        self._filter_table = None  # 与VPTree相同的每个点的距离下界表
+        self._node_start = None  # 节点在self._data中的起始位置，内部节点的支撑点存放在起始位置
+        self._node_end = None  # 节点在self._data中的结束位置（不包含）
+        self._node_vp_count = None  # 节点的支撑点个数，叶子节点为0
+        self._node_first_child = None  # 第一个孩子的节点编号，同一节点的孩子编号连续，没有孩子时为-1
+        self._node_child_count = None  # 孩子个数
+        self._node_lower = None  # 形状为(节点个数, 2)，节点中的点到父节点两个支撑点的最小距离
+        self._node_upper = None  # 形状为(节点个数, 2)，节点中的点到父节点两个支撑点的最大距离
+        self._path_table = None  # 形状为(数据个数, path_levels)，每个点到路径上的支撑点的距离
+        self._height = 0
+        self.build_tree(data)
+
+    def get_params(self):
+        """
+        返回创建MVP树使用的参数（不包括数据与距离函数）
+        :return:
+        """
+        return {'data_type': self._data_type, 'tree_ways': self._tree_ways, 'leaf_capacity': self._leaf_capacity,
+                'path_levels': self._path_levels}
+
+    def get_node_count(self):
+        """
+        返回节点个数
+        :return:
+        """
+        return len(self._node_start)
+
+    def get_tree_height(self):
+        """
+        返回MVP树的高度
+        :return:
+        """
+        return self._height
+
+    def get_data_count_of_tree(self):
+        """
+        返回MVP树中存放的元素个数
+        :return:
+        """
+        return len(self._data)
+
+    def build_tree(self, data):
+        """
+        根据data创建扁平数组形式的MVP树
+        与VPTree一样只在行号数组上原地置换，每个节点占据其中一段连续的区间
+        :param data: 数据集
+        :return:
+        """
+        data = np.asarray(data)
+        if self._data_type == 'string':
+            data = data.reshape(-1)
+        if len(data) == 0:
+            raise ValueError('data should not be empty')
+
+        perm = np.arange(len(data), dtype=np.int64)
+        path_table = np.zeros((len(data), self._path_levels), dtype=np.float64)
+        nodes = {'start': [0], 'end': [len(data)], 'vp_count': [0], 'first_child': [-1], 'child_count': [0],
+                 'lower': [(0.0, 0.0)], 'upper': [(float('inf'), float('inf'))]}
+        # nodes_to_build 待划分的节点栈，元素为(节点编号, 深度)
+        nodes_to_build = [(0, 0)]
+        self._height = 1
+        while len(nodes_to_build) > 0:
+            node, depth = nodes_to_build.pop()
+            self._height = max(self._height, depth + 1)
+            start = nodes['start'][node]
+            end = nodes['end'][node]
+            if end - start <= self._leaf_capacity:
+                continue
+
+            # 随机选择第一个支撑点，交换到区间开头
+            i = random.randrange(start, end)
+            perm[[start, i]] = perm[[i, start]]
+            path_table[[start, i]] = path_table[[i, start]]
+            first_distances = self._distances_to_point(data, perm[start + 1:end], data[perm[start]])
+            # 第二个支撑点为离第一个支撑点最远的点，交换到第一个支撑点之后
+            j = int(np.argmax(first_distances))
+            perm[[start + 1, start + 1 + j]] = perm[[start + 1 + j, start + 1]]
+            path_table[[start + 1, start + 1 + j]] = path_table[[start + 1 + j, start + 1]]
+            first_distances[[0, j]] = first_distances[[j, 0]]
+            first_distances = first_distances[1:]
+            second_distances = self._distances_to_point(data, perm[start + 2:end], data[perm[start + 1]])
+            nodes['vp_count'][node] = NODE_VP_COUNT
+
+            # 记录其余点到两个支撑点的距离，作为路径距离
+            for k, distances in enumerate((first_distances, second_distances)):
+                column = NODE_VP_COUNT * depth + k
+                if column < self._path_levels:
+                    path_table[start + 2:end, column] = distances
+            if end - start == NODE_VP_COUNT:
+                continue
+
+            # 先按到第一个支撑点的距离划分壳层，每个壳层再按到第二个支撑点的距离划分壳层
+            groups = []
+            for shell in np.array_split(np.argsort(first_distances, kind='stable'), self._tree_ways):
+                shell = shell[np.argsort(second_distances[shell], kind='stable')]
+                groups.extend(group for group in np.array_split(shell, self._tree_ways) if len(group) > 0)
+            order = np.concatenate(groups)
+            perm[start + 2:end] = perm[start + 2:end][order]
+            path_table[start + 2:end] = path_table[start + 2:end][order]
+
+            nodes['first_child'][node] = len(nodes['start'])
+            nodes['child_count'][node] = len(groups)
+            child_start = start + 2
+            for group in groups:
+                child = len(nodes['start'])
+                nodes['start'].append(child_start)
+                nodes['end'].append(child_start + len(group))
+                nodes['vp_count'].append(0)
+                nodes['first_child'].append(-1)
+                nodes['child_count'].append(0)
+                nodes['lower'].append((first_distances[group].min(), second_distances[group].min()))
+                nodes['upper'].append((first_distances[group].max(), second_distances[group].max()))
+                nodes_to_build.append((child, depth + 1))
+                child_start += len(group)
+
+        self._data = data[perm]
+        self._ids = perm
+        self._filter_table = self._make_filter_table(self._data)
+        self._path_table = path_table
+        self._node_start = np.array(nodes['start'], dtype=np.int64)
+        self._node_end = np.array(nodes['end'], dtype=np.int64)
+        self._node_vp_count = np.array(nodes['vp_count'], dtype=np.int64)
+        self._node_first_child = np.array(nodes['first_child'], dtype=np.int64)
+        self._node_child_count = np.array(nodes['child_count'], dtype=np.int64)
+        self._node_lower = np.array(nodes['lower'], dtype=np.float64)
+        self._node_upper = np.array(nodes['upper'], dtype=np.float64)
+        return self
+
+    def range_search(self, query_point, query_range, return_ids=False):
+        """
+        在MVP树中进行范围搜索
+        :param query_point: 查询数据
+        :param query_range: 与查询数据之间的最大距离
+        :param return_ids: 为True时返回近邻原始行号与距离的NumPy数组(ids, distances)，而不是neighbors列表
+        :return: 格式与VPTree.range_search相同
+        """
+        positions = []
+        distances = []
+        cal_distance_times = 0
+        filtered_times = 0
+        # nodes_to_list 待搜索节点栈，元素为(节点编号, 深度, 查询点到路径上的支撑点的距离)
+        nodes_to_list = [(0, 0, np.zeros(self._path_levels, dtype=np.float64))]
+
+        while len(nodes_to_list) > 0:
+            node, depth, path = nodes_to_list.pop()
+            start = self._node_start[node]
+            vp_count = self._node_vp_count[node]
+
+            # 如果是叶子节点，先用路径距离过滤，再进行顺序搜索
+            if vp_count == 0:
+                leaf_positions = np.arange(start, self._node_end[node])
+                if self._path_levels > 0:
+                    lower_bounds = np.max(np.abs(self._path_table[start:self._node_end[node]] - path), axis=1)
+                    leaf_positions = leaf_positions[lower_bounds <= query_range]
+                    filtered_times += self._node_end[node] - start - len(leaf_positions)
+                indexes, leaf_distances, leaf_cal_times, leaf_filtered_times = \
+                    self._sequential_scan(self._data[leaf_positions], query_point, query_range,
+                                          filter_table=self._filter_table[leaf_positions])
+                positions.append(leaf_positions[indexes])
+                distances.append(leaf_distances)
+                cal_distance_times += leaf_cal_times
+                filtered_times += leaf_filtered_times
+                continue
+
+            # 如果不是叶子节点，计算到两个支撑点的距离
+            vp_distances = []
+            child_path = path.copy()
+            for k in range(vp_count):
+                dis = self._metric.distance(query_point, self._data[start + k])
+                cal_distance_times += 1
+                vp_distances.append(dis)
+                if dis <= query_range:
+                    positions.append(np.array([start + k], dtype=np.int64))
+                    distances.append(np.array([dis], dtype=np.float64))
+                column = NODE_VP_COUNT * depth + k
+                if column < self._path_levels:
+                    child_path[column] = dis
+
+            # 孩子中的点到两个支撑点的距离都可能在查询范围内时才访问该孩子
+            first_dis, second_dis = vp_distances
+            first_child = self._node_first_child[node]
+            for child in range(first_child, first_child + self._node_child_count[node]):
+                lower = self._node_lower[child]
+                upper = self._node_upper[child]
+                if lower[0] - query_range <= first_dis <= upper[0] + query_range and \
+                        lower[1] - query_range <= second_dis <= upper[1] + query_range:
+                    nodes_to_list.append((child, depth + 1, child_path))
+        return self._make_result(positions, distances, cal_distance_times, filtered_times, return_ids)
+
+    def brute_force_search(self, query_point, query_range, return_ids=False):
+        """
+        使用暴力法进行范围搜索
+        :param query_point: 查询数据
+        :param query_range: 与查询数据之间的最大距离
+        :param return_ids: 与range_search相同
+        :return:
+        """
+        indexes, distances, cal_distance_times, _ = \
+            self._sequential_scan(self._data, query_point, query_range, use_filters=False)
+        return self._make_result([indexes], [distances], cal_distance_times, 0, return_ids)
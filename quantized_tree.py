@@ -0,0 +1,249 @@
+import numpy as np
+from metrics import get_metric
+from metric_tree import BUILD_CHUNK_SIZE
+from vp_tree import VPTree
+
+# 支持的降低精度的存放类型
+STORAGE_DTYPES = ('float32', 'int8', 'uint8')
+# 8位整数编码的取值个数减1
+QUANTIZATION_LEVELS = 255
+# 放大搜索半径时额外加上的相对误差，覆盖编码查询时的舍入误差
+ERROR_TOLERANCE = 1e-9
+
+
+class QuantizedVPTree:
+    """
+    以降低精度的方式存放数值数据的VP树
+    float32存放时直接转换类型；int8/uint8存放时进行标量量化：所有维度共用一个缩放系数scale，每一维有各自的偏移offset，
+    x ≈ code * scale + offset，在编码上计算的距离乘以scale即为近似距离，
+    因此int8/uint8只支持由范数诱导的度量（Metric.homogeneous为True，例如L1、L2、LINF）
+    记录每个点编码前后的最大距离误差，由三角不等式，存放的点到查询点的距离与真实距离相差不超过该误差
+    搜索时将半径放大该误差得到候选点，再用原始数据重新计算候选点的距离，结果与在原始数据上的精确搜索相同；
+    不保留原始数据时，结果中的距离为近似距离，误差不为0时exact为False
+    原始数据只在重新计算候选点的距离时按行号读取，传入load_data得到的内存映射数组时原始数据可以留在磁盘上
+    """
+    def __init__(self, data, distance_fun, storage_dtype='float32', rerank=True, **params):
+        """
+        构造函数
+        :param data: 数值数据，二维数组，每一行为一个点
+        :param distance_fun: 距离计算函数或Metric
+        :param storage_dtype: 存放类型，float32、int8或uint8
+        :param rerank: 是否保留原始数据的引用，用来重新计算候选点的距离
+        :param params: VPTree的其余参数
+        """
+        if storage_dtype not in STORAGE_DTYPES:
+            raise ValueError('storage_dtype should be one of %s' % ', '.join(STORAGE_DTYPES))
+        data = np.asarray(data)
+        if data.ndim != 2 or len(data) == 0:
+            raise ValueError('data should be a non-empty 2-D array')
+        self._metric = get_metric(distance_fun)
+        if storage_dtype != 'float32' and not self._metric.homogeneous:
+            raise ValueError('%s storage needs a norm induced metric such as L1, L2 or LINF' % storage_dtype)
+
+        self._storage_dtype = np.dtype(storage_dtype)
+        self._scale = 1.0
+        self._offset = None  # int8/uint8编码每一维的偏移，float32存放时为None
+        if self._storage_dtype.kind in 'iu':
+            low = np.min(data, axis=0).astype(np.float64)
+            high = np.max(data, axis=0).astype(np.float64)
+            self._scale = float(np.max(high - low)) / QUANTIZATION_LEVELS
+            if self._scale == 0:
+                self._scale = 1.0
+            # 编码的最小值对应每一维的最小值
+            self._offset = low - np.iinfo(self._storage_dtype).min * self._scale
+        codes, self._error = self._encode_data(data)
+        self._original = data if rerank else None
+        self._tree = VPTree(codes, distance_fun, 'num', **params)
+        self._positions = None  # 每个原始行号的点在VP树数据数组中的位置，需要时才计算
+
+    def get_tree(self):
+        """
+        返回存放编码数据的VP树
+        :return:
+        """
+        return self._tree
+
+    def get_storage_dtype(self):
+        """
+        返回存放类型
+        :return:
+        """
+        return self._storage_dtype.name
+
+    def get_quantization_error(self):
+        """
+        返回编码前后的最大距离误差
+        :return:
+        """
+        return self._error
+
+    def _encode_data(self, data):
+        """
+        分块将数据编码为存放类型，同时计算编码前后的最大距离误差
+        :param data: 原始数据
+        :return: 编码后的数据，最大距离误差
+        """
+        codes = np.empty(data.shape, dtype=self._storage_dtype)
+        max_abs_errors = np.zeros(data.shape[1], dtype=np.float64)
+        error = 0.0
+        for i in range(0, len(data), BUILD_CHUNK_SIZE):
+            chunk = np.asarray(data[i:i + BUILD_CHUNK_SIZE], dtype=np.float64)
+            if self._offset is None:
+                codes[i:i + BUILD_CHUNK_SIZE] = chunk
+            else:
+                info = np.iinfo(self._storage_dtype)
+                codes[i:i + BUILD_CHUNK_SIZE] = np.clip(np.rint((chunk - self._offset) / self._scale), info.min,
+                                                        info.max)
+            decoded = self._decode(codes[i:i + BUILD_CHUNK_SIZE])
+            if self._metric.homogeneous:
+                max_abs_errors = np.maximum(max_abs_errors, np.max(np.abs(decoded - chunk), axis=0))
+            else:
+                for original, stored in zip(chunk, decoded):
+                    error = max(error, self._metric.distance(original, stored))
+        if self._metric.homogeneous:
+            # 范数是单调的，每一维的最大绝对误差组成的向量的范数不小于任何一个点的误差
+            error = float(self._metric.distance(np.zeros(len(max_abs_errors)), max_abs_errors))
+        return codes, float(error)
+
+    def _decode(self, codes):
+        """
+        将编码还原为float64的近似数据
+        :param codes: 编码后的数据
+        :return:
+        """
+        if self._offset is None:
+            return np.asarray(codes, dtype=np.float64)
+        return codes * self._scale + self._offset
+
+    def _encode_query(self, query_point):
+        """
+        将查询数据转换到编码所在的空间，编码空间中的距离乘以scale即为近似距离
+        :param query_point: 查询数据
+        :return:
+        """
+        query_point = np.asarray(query_point, dtype=np.float64)
+        if self._offset is None:
+            return query_point
+        return (query_point - self._offset) / self._scale
+
+    def _expanded_range(self, query_range):
+        """
+        编码空间中的搜索半径，放大了最大距离误差，保证不漏掉真实距离在query_range内的点
+        :param query_range: 与查询数据之间的最大距离
+        :return:
+        """
+        return (query_range * (1 + ERROR_TOLERANCE) + self._error) / self._scale
+
+    def range_search(self, query_point, query_range, return_ids=False):
+        """
+        范围搜索，保留原始数据时结果与在原始数据上的精确搜索相同
+        :param query_point: 查询数据
+        :param query_range: 与查询数据之间的最大距离
+        :param return_ids: 与VPTree.range_search相同
+        :return: 格式与VPTree.range_search相同，cal_distance_times包括重新计算候选点距离的次数
+        """
+        query_point = np.asarray(query_point, dtype=np.float64)
+        result = self._tree.range_search(self._encode_query(query_point), self._expanded_range(query_range),
+                                          return_ids=True)
+        return self._rerank(query_point, query_range, result, return_ids)
+
+    def range_search_batch(self, queries, radii, return_ids=False):
+        """
+        对多个查询同时进行范围搜索
+        :param queries: 多个查询数据，二维数组，每一行为一个查询
+        :param radii: 每个查询的查询半径，也可以是所有查询共用的一个数
+        :param return_ids: 与VPTree.range_search相同
+        :return: 与queries一一对应的搜索结果列表
+        """
+        queries = np.asarray(queries, dtype=np.float64)
+        radii = np.broadcast_to(np.asarray(radii, dtype=np.float64), (len(queries),))
+        results = self._tree.range_search_batch(self._encode_query(queries), self._expanded_range(radii),
+                                                return_ids=True)
+        return [self._rerank(query_point, radius, result, return_ids)
+                for query_point, radius, result in zip(queries, radii, results)]
+
+    def brute_force_search(self, query_point, query_range, return_ids=False):
+        """
+        在所有编码数据上进行暴力搜索，再重新计算候选点的距离
+        :param query_point: 查询数据
+        :param query_range: 与查询数据之间的最大距离
+        :param return_ids: 与VPTree.range_search相同
+        :return:
+        """
+        query_point = np.asarray(query_point, dtype=np.float64)
+        result = self._tree.brute_force_search(self._encode_query(query_point), self._expanded_range(query_range),
+                                               return_ids=True)
+        return self._rerank(query_point, query_range, result, return_ids)
+
+    def knn_search(self, query_point, k, return_ids=False):
+        """
+        k近邻搜索
+        先在编码数据上找到k个近邻，第k近的真实距离不超过其近似距离加上最大误差，
+        因此真实的k近邻到查询点的近似距离都不超过第k近的近似距离加上两倍的最大误差，
+        在该半径内进行范围搜索并重新计算距离后取最近的k个
+        :param query_point: 查询数据
+        :param k: 返回的近邻个数
+        :param return_ids: 与VPTree.range_search相同
+        :return: 格式与VPTree.knn_search相同
+        """
+        query_point = np.asarray(query_point, dtype=np.float64)
+        encoded_query = self._encode_query(query_point)
+        result = self._tree.knn_search(encoded_query, k, return_ids=True)
+        if self._original is None or len(result['ids']) == 0:
+            return self._rerank(query_point, float('inf'), result, return_ids)
+        kth_distance = result['distances'][-1] * self._scale + self._error
+        candidates = self._tree.range_search(encoded_query, self._expanded_range(kth_distance), return_ids=True)
+        candidates['cal_distance_times'] += result['cal_distance_times']
+        candidates['filtered_times'] += result['filtered_times']
+        return self._rerank(query_point, kth_distance, candidates, return_ids, k)
+
+    def _rerank(self, query_point, query_range, result, return_ids, k=None):
+        """
+        用原始数据重新计算候选点的距离，只保留距离在query_range内的点
+        没有原始数据时使用近似距离，编码有误差时结果标记为不精确
+        :param query_point: 查询数据
+        :param query_range: 与查询数据之间的最大距离
+        :param result: 在编码数据上搜索得到的return_ids格式的结果
+        :param return_ids: 与VPTree.range_search相同
+        :param k: 不为None时只保留最近的k个点，并按距离从小到大排列
+        :return:
+        """
+        ids = result['ids']
+        cal_distance_times = result['cal_distance_times']
+        exact = result['exact']
+        if self._original is None:
+            points = None
+            distances = result['distances'] * self._scale
+            exact = exact and self._error == 0
+        else:
+            # 按行号顺序读取原始数据，原始数据是内存映射数组时顺序访问磁盘
+            ids = np.sort(ids)
+            points = np.asarray(self._original[ids], dtype=np.float64)
+            distances = self._metric.distances(points, query_point)
+            cal_distance_times += len(ids)
+        hits = np.flatnonzero(distances <= query_range)
+        if k is not None:
+            hits = hits[np.argsort(distances[hits], kind='stable')[:k]]
+        output = dict()
+        if return_ids:
+            output['ids'] = ids[hits]
+            output['distances'] = distances[hits]
+        else:
+            if points is None:
+                points = self._decode(self._tree.get_tree_arrays()['data'][self._get_positions()[ids]])
+            output['neighbors'] = [{'object': points[i], 'distance': distances[i]} for i in hits]
+        output['cal_distance_times'] = int(cal_distance_times)
+        output['filtered_times'] = int(result['filtered_times'])
+        output['exact'] = exact
+        return output
+
+    def _get_positions(self):
+        """
+        返回每个原始行号的点在VP树数据数组中的位置
+        :return:
+        """
+        if self._positions is None:
+            ids = self._tree.get_tree_arrays()['ids']
+            self._positions = np.empty(len(ids), dtype=np.int64)
+            self._positions[ids] = np.arange(len(ids))
+        return self._positions
@@ -0,0 +1,148 @@
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+from vp_tree import VPTree
+
+
+class QueryExecutor:
+    """
+    多进程查询执行器
+    VP树的结构数组与数据只复制一次到共享内存中，worker进程直接在共享内存上创建只读的VP树，
+    不需要把整棵树pickle给每一个worker
+    """
+    def __init__(self, vp_tree, n_jobs=-1, chunk_size=64):
+        """
+        构造函数
+        :param vp_tree: 已经建好的VP树，插入或删除过数据时需要先调用compact
+        :param n_jobs: 执行查询的进程数，-1表示使用所有cpu
+        :param chunk_size: 每次交给一个worker的查询个数
+        """
+        if not isinstance(vp_tree, VPTree):
+            raise ValueError('vp_tree should be a VPTree')
+        if not isinstance(n_jobs, int) or (n_jobs < 1 and n_jobs != -1):
+            raise ValueError('n_jobs should be a positive integer or -1')
+        if not isinstance(chunk_size, int) or chunk_size < 1:
+            raise ValueError('chunk_size should be a positive integer')
+
+        self._chunk_size = chunk_size
+        self._data_type = vp_tree.get_params()['data_type']
+        self._shms = []  # 存放树结构数组的共享内存
+        self._pool = None
+        array_specs = dict()
+        try:
+            for name, array in vp_tree.get_tree_arrays().items():
+                # object类型的字符串数组不能放在共享内存中，转换为定长的字符串数组
+                if array.dtype == object:
+                    array = array.astype(str)
+                shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                self._shms.append(shm)
+                shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+                shared_array[...] = array
+                array_specs[name] = (shm.name, array.shape, array.dtype.str)
+            self._pool = multiprocessing.Pool(None if n_jobs == -1 else n_jobs, initializer=_init_query_worker,
+                                              initargs=(array_specs, vp_tree.get_distance_fun(),
+                                                        vp_tree.get_params()))
+        except Exception:
+            self.close()
+            raise
+
+    def range_search(self, queries, radii, return_ids=False):
+        """
+        使用多个进程对多个查询进行范围搜索
+        :param queries: 多个查询数据，数值数据为二维数组，每一行为一个查询
+        :param radii: 每个查询的查询半径，也可以是所有查询共用的一个数
+        :param return_ids: 为True时每个结果为原始行号与距离的NumPy数组，传回主进程的数据更少
+        :return: 与queries一一对应的搜索结果列表，每个结果的格式与VPTree.range_search相同
+        """
+        return self._run('range_search', queries, radii, return_ids)
+
+    def brute_force_search(self, queries, radii, return_ids=False):
+        """
+        使用多个进程对多个查询进行暴力搜索
+        :param queries: 多个查询数据，数值数据为二维数组，每一行为一个查询
+        :param radii: 每个查询的查询半径，也可以是所有查询共用的一个数
+        :param return_ids: 与range_search相同
+        :return: 与queries一一对应的搜索结果列表，每个结果的格式与VPTree.brute_force_search相同
+        """
+        return self._run('brute_force_search', queries, radii, return_ids)
+
+    def _run(self, method, queries, radii, return_ids):
+        """
+        将查询分块交给进程池执行，并按查询的顺序合并结果
+        :param method: 查询方法名称
+        :param queries: 多个查询数据
+        :param radii: 查询半径
+        :param return_ids: 是否返回原始行号与距离的NumPy数组
+        :return:
+        """
+        if self._pool is None:
+            raise ValueError('query executor has been closed')
+        queries = np.asarray(queries)
+        if self._data_type == 'string':
+            queries = queries.reshape(-1)
+        radii = np.asarray(radii, dtype=np.float64)
+        if radii.ndim == 0:
+            radii = np.full(len(queries), float(radii))
+        elif len(radii) != len(queries):
+            raise ValueError('radii should be a number or have the same length as queries')
+
+        chunks = [(method, queries[i:i + self._chunk_size], radii[i:i + self._chunk_size], return_ids)
+                  for i in range(0, len(queries), self._chunk_size)]
+        results = []
+        for chunk_results in self._pool.imap(_run_query_chunk, chunks):
+            results.extend(chunk_results)
+        return results
+
+    def close(self):
+        """
+        关闭进程池并释放共享内存
+        :return:
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# worker进程中的只读VP树及其使用的共享内存，由_init_query_worker设置
+_worker_tree = None
+_worker_shms = []
+
+
+def _init_query_worker(array_specs, distance_fun, params):
+    """
+    查询worker进程的初始化函数，连接共享内存并在其上创建VP树
+    :param array_specs: 每个树结构数组的(共享内存名称, 形状, 类型)
+    :param distance_fun: 距离计算函数
+    :param params: VP树的参数
+    :return:
+    """
+    global _worker_tree
+    arrays = dict()
+    for name, (shm_name, shape, dtype) in array_specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker_shms.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    _worker_tree = VPTree.from_tree_arrays(arrays, distance_fun, **params)
+
+
+def _run_query_chunk(chunk):
+    """
+    在worker进程中执行一块查询
+    :param chunk: (查询方法名称, 查询数据, 查询半径, 是否返回原始行号与距离的NumPy数组)
+    :return: 每个查询的结果
+    """
+    method, queries, radii, return_ids = chunk
+    if method == 'range_search':
+        return _worker_tree.range_search_batch(queries, radii, return_ids)
+    return [_worker_tree.brute_force_search(query, radius, return_ids) for query, radius in zip(queries, radii)]
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import math
+import os
+import numpy as np
+from vp_tree import VPTree
+
+# 每个微批最多包含的查询个数
+DEFAULT_BATCH_SIZE = 64
+# 收到微批的第一个查询后，最多等待多少秒再开始执行
+DEFAULT_MAX_WAIT = 0.002
+# 一行请求的最大字节数
+MAX_LINE_BYTES = 1 << 24
+
+
+class QueryServer:
+    """
+    本地查询服务
+    VP树只加载一次，通过Unix socket或TCP接受JSON lines格式的请求，每行一个json对象：
+    {"id": 任意值, "op": "range", "query": 查询数据, "radius": 查询半径}
+    {"id": 任意值, "op": "knn", "query": 查询数据, "k": 近邻个数}
+    每个请求返回一行：{"id": 请求的id, "ids": 原始行号列表, "distances": 距离列表, "cal_distance_times": 距离计算次数}，
+    出错时返回{"id": 请求的id, "error": 错误信息}
+    同一个连接上可以连续发送多个请求，响应按完成的顺序返回，用id对应请求
+    并发到达的请求先攒成微批，范围查询用range_search_batch一次遍历树，微批在线程中执行，不阻塞事件循环
+    """
+    def __init__(self, vp_tree, batch_size=DEFAULT_BATCH_SIZE, max_wait=DEFAULT_MAX_WAIT):
+        """
+        构造函数
+        :param vp_tree: 已经建好的VP树
+        :param batch_size: 每个微批最多包含的查询个数
+        :param max_wait: 收到微批的第一个查询后最多等待的秒数，为0时只合并已经到达的查询
+        """
+        if not isinstance(vp_tree, VPTree):
+            raise ValueError('vp_tree should be a VPTree')
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError('batch_size should be a positive integer')
+        if max_wait < 0:
+            raise ValueError('max_wait should be non-negative')
+
+        self._vp_tree = vp_tree
+        self._data_type = vp_tree.get_params()['data_type']
+        self._batch_size = batch_size
+        self._max_wait = max_wait
+        self._pending = None  # 等待执行的(请求, future)队列
+        self._batch_task = None
+        self._server = None
+        self._unix_path = None
+
+    async def start(self, host='127.0.0.1', port=8765, unix_path=None):
+        """
+        开始监听，unix_path不为None时使用Unix socket，否则使用TCP
+        :param host: TCP监听地址，默认只接受本机连接
+        :param port: TCP端口，为0时由系统分配
+        :param unix_path: Unix socket文件路径
+        :return: 实际监听的地址
+        """
+        self._pending = asyncio.Queue()
+        self._batch_task = asyncio.ensure_future(self._run_batches())
+        if unix_path is not None:
+            # 删除上次运行遗留的socket文件
+            if os.path.exists(unix_path):
+                os.remove(unix_path)
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=unix_path,
+                                                          limit=MAX_LINE_BYTES)
+            self._unix_path = unix_path
+            return unix_path
+        self._server = await asyncio.start_server(self._handle_connection, host, port, limit=MAX_LINE_BYTES)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        """
+        持续处理请求，直到被取消
+        :return:
+        """
+        if self._server is None:
+            raise ValueError('query server has not been started')
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """
+        停止监听并结束微批任务
+        :return:
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._batch_task is not None:
+            self._batch_task.cancel()
+            try:
+                await self._batch_task
+            except asyncio.CancelledError:
+                pass
+            self._batch_task = None
+        if self._unix_path is not None and os.path.exists(self._unix_path):
+            os.remove(self._unix_path)
+        self._unix_path = None
+
+    async def _handle_connection(self, reader, writer):
+        """
+        处理一个连接，每读到一行请求就放入微批队列，结果返回后写回
+        :param reader: 连接的StreamReader
+        :param writer: 连接的StreamWriter
+        :return:
+        """
+        tasks = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # 一行请求超过MAX_LINE_BYTES时readline抛出ValueError，无法找到下一行的开头，返回错误后关闭连接
+                    if len(tasks) > 0:
+                        await asyncio.gather(*tasks)
+                    response = {'error': 'request line should not be longer than %d bytes' % MAX_LINE_BYTES, 'id': None}
+                    writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                    await writer.drain()
+                    break
+                if len(line) == 0:
+                    break
+                if len(line.strip()) == 0:
+                    continue
+                task = asyncio.ensure_future(self._answer(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if len(tasks) > 0:
+                await asyncio.gather(*tasks)
+        except ConnectionError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _answer(self, line, writer):
+        """
+        解析一行请求，等待所在微批执行完毕后写回响应
+        :param line: 请求的一行
+        :param writer: 连接的StreamWriter
+        :return:
+        """
+        request_id = None
+        try:
+            message = json.loads(line)
+            if isinstance(message, dict):
+                request_id = message.get('id')
+            request = self._parse_request(message)
+            future = asyncio.get_running_loop().create_future()
+            await self._pending.put((request, future))
+            response = await future
+        except ValueError as e:
+            response = {'error': str(e)}
+        response['id'] = request_id
+        writer.write(json.dumps(response).encode('utf-8') + b'\n')
+        await writer.drain()
+
+    def _parse_request(self, message):
+        """
+        检查请求并转换为(op, 查询数据, 半径或k)
+        :param message: json解析后的请求
+        :return:
+        """
+        if not isinstance(message, dict):
+            raise ValueError('request should be a json object')
+        op = message.get('op')
+        if op != 'range' and op != 'knn':
+            raise ValueError('op should be range or knn')
+        if 'query' not in message:
+            raise ValueError('request should have a query')
+        query = message['query']
+        if self._data_type == 'string':
+            if not isinstance(query, str):
+                raise ValueError('query should be a string')
+        else:
+            try:
+                query = np.asarray(query, dtype=np.float64)
+            except (TypeError, ValueError):
+                raise ValueError('query should be a list of numbers')
+            if query.ndim != 1:
+                raise ValueError('query should be a list of numbers')
+        if op == 'range':
+            radius = message.get('radius')
+            if isinstance(radius, bool) or not isinstance(radius, (int, float)):
+                raise ValueError('radius should be a non-negative number')
+            try:
+                radius = float(radius)
+            except OverflowError:
+                radius = float('inf')
+            # json允许NaN与Infinity，NaN与任何距离比较都为False，同样作为错误的半径返回
+            if not math.isfinite(radius) or radius < 0:
+                raise ValueError('radius should be a non-negative number')
+            return op, query, radius
+        k = message.get('k')
+        if isinstance(k, bool) or not isinstance(k, int) or k < 1:
+            raise ValueError('k should be a positive integer')
+        return op, query, k
+
+    async def _run_batches(self):
+        """
+        不断从队列中取出请求组成微批，在线程中执行并把结果交给等待的请求
+        一次只执行一个微批，VP树不会被多个线程同时访问
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._pending.get()]
+            deadline = loop.time() + self._max_wait
+            while len(batch) < self._batch_size:
+                if not self._pending.empty():
+                    batch.append(self._pending.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._pending.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            responses = await loop.run_in_executor(None, self._execute_batch, [request for request, _ in batch])
+            for (_, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+
+    def _execute_batch(self, requests):
+        """
+        执行一个微批，范围查询合并为一次range_search_batch，k近邻查询逐个执行
+        :param requests: (op, 查询数据, 半径或k)的列表
+        :return: 与requests一一对应的响应
+        """
+        responses = [None] * len(requests)
+        range_indexes = [i for i, request in enumerate(requests) if request[0] == 'range']
+        if len(range_indexes) > 0:
+            try:
+                queries = [requests[i][1] for i in range_indexes]
+                if self._data_type == 'string':
+                    queries = np.array(queries, dtype=object)
+                results = self._vp_tree.range_search_batch(queries, [requests[i][2] for i in range_indexes],
+                                                           return_ids=True)
+                for i, result in zip(range_indexes, results):
+                    responses[i] = QueryServer._make_response(result)
+            except Exception:
+                # 批量执行失败时（例如查询的维度不一致）逐个执行，只让出错的请求返回错误
+                pass
+        for i, (op, query, arg) in enumerate(requests):
+            if responses[i] is not None:
+                continue
+            try:
+                if op == 'range':
+                    result = self._vp_tree.range_search(query, arg, return_ids=True)
+                else:
+                    result = self._vp_tree.knn_search(query, arg, return_ids=True)
+                responses[i] = QueryServer._make_response(result)
+            except Exception as e:
+                responses[i] = {'error': str(e)}
+        return responses
+
+    @staticmethod
+    def _make_response(result):
+        """
+        将return_ids模式的搜索结果转换为可以json序列化的响应
+        :param result: 搜索结果
+        :return:
+        """
+        return {'ids': result['ids'].tolist(), 'distances': result['distances'].tolist(),
+                'cal_distance_times': result['cal_distance_times']}
+
+
+def serve(index_path, host='127.0.0.1', port=8765, unix_path=None, batch_size=DEFAULT_BATCH_SIZE,
+          max_wait=DEFAULT_MAX_WAIT):
+    """
+    加载VPTree.save保存的索引文件并启动查询服务，直到按下Ctrl+C
+    :param index_path: 索引文件路径
+    :param host: TCP监听地址
+    :param port: TCP端口
+    :param unix_path: Unix socket文件路径，不为None时不监听TCP
+    :param batch_size: 每个微批最多包含的查询个数
+    :param max_wait: 收到微批的第一个查询后最多等待的秒数
+    :return:
+    """
+    vp_tree = VPTree.load(index_path)
+    server = QueryServer(vp_tree, batch_size, max_wait)
+
+    async def run():
+        address = await server.start(host, port, unix_path)
+        print('serving %s (%d points) on %s' % (index_path, vp_tree.get_data_count_of_tree(), address))
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,134 @@
+import time
+
+
+class SearchStats:
+    """
+    VP树搜索过程的统计信息
+    作为stats参数传给VPTree的搜索方法后，记录每一层访问与剪枝的节点数、叶子中扫描与过滤的点数、
+    计算距离的时间与总时间；同一个对象可以在多次查询之间累计
+    可以传入hook函数，或者继承本类并重写on_event，在每个事件发生时得到通知
+    不传stats时搜索方法不做任何统计
+    """
+    def __init__(self, hook=None):
+        """
+        构造函数
+        :param hook: 事件回调函数hook(event, info)，event为'node'、'prune'、'leaf'或'query'，info为事件信息字典
+        """
+        self.nodes_visited = []  # 每一层访问的节点数
+        self.nodes_pruned = []  # 每一层被剪枝而没有访问的节点数
+        self.leaf_points_scanned = 0  # 叶子中计算了距离的点数
+        self.leaf_points_filtered = 0  # 叶子中被距离下界过滤的点数
+        self.vp_distance_count = 0  # 计算到支撑点的距离的次数
+        self.distance_time = 0.0  # 计算距离的时间（秒），包括支撑点距离与叶子扫描
+        self.wall_time = 0.0  # 查询的总时间（秒）
+        self.query_count = 0  # 查询次数
+        self._hook = hook
+
+    def on_event(self, event, info):
+        """
+        事件发生时调用，默认调用构造时传入的hook
+        :param event: 事件名称
+        :param info: 事件信息
+        :return:
+        """
+        if self._hook is not None:
+            self._hook(event, info)
+
+    def visit_node(self, node, depth, is_leaf):
+        """
+        记录访问了深度为depth的节点
+        :param node: 节点编号
+        :param depth: 节点深度
+        :param is_leaf: 是否是叶子节点
+        :return:
+        """
+        SearchStats._add_at_depth(self.nodes_visited, depth, 1)
+        self.on_event('node', {'node': node, 'depth': depth, 'is_leaf': is_leaf})
+
+    def prune_node(self, node, depth):
+        """
+        记录深度为depth的节点被剪枝
+        :param node: 节点编号
+        :param depth: 节点深度
+        :return:
+        """
+        SearchStats._add_at_depth(self.nodes_pruned, depth, 1)
+        self.on_event('prune', {'node': node, 'depth': depth})
+
+    def distance(self, distance_fun, a, b):
+        """
+        计算并记录一次到支撑点的距离
+        :param distance_fun: 距离计算函数
+        :param a: 数据点a
+        :param b: 数据点b
+        :return: 距离
+        """
+        start = time.perf_counter()
+        dis = distance_fun(a, b)
+        self.distance_time += time.perf_counter() - start
+        self.vp_distance_count += 1
+        return dis
+
+    def distances(self, distance_fun, points, b):
+        """
+        一次计算并记录多个点到支撑点b的距离，多个查询同时访问一个节点时使用
+        :param distance_fun: 一对多的批量距离函数
+        :param points: 多个数据点
+        :param b: 支撑点
+        :return: 距离组成的一维数组
+        """
+        start = time.perf_counter()
+        distances = distance_fun(points, b)
+        self.distance_time += time.perf_counter() - start
+        self.vp_distance_count += len(points)
+        return distances
+
+    def scan_leaf(self, node, depth, scanned, filtered, seconds):
+        """
+        记录一次叶子扫描
+        :param node: 叶子节点编号
+        :param depth: 叶子深度
+        :param scanned: 计算了距离的点数
+        :param filtered: 被距离下界过滤的点数
+        :param seconds: 扫描叶子的时间
+        :return:
+        """
+        self.leaf_points_scanned += scanned
+        self.leaf_points_filtered += filtered
+        self.distance_time += seconds
+        self.on_event('leaf', {'node': node, 'depth': depth, 'scanned': scanned, 'filtered': filtered,
+                               'seconds': seconds})
+
+    def finish_query(self, seconds, query_count=1):
+        """
+        记录一次查询结束
+        :param seconds: 查询的总时间
+        :param query_count: 一起完成的查询个数，批量查询时为查询的个数
+        :return:
+        """
+        self.query_count += query_count
+        self.wall_time += seconds
+        self.on_event('query', {'seconds': seconds, 'query_count': query_count})
+
+    def as_dict(self):
+        """
+        以字典的形式返回统计信息
+        :return:
+        """
+        return {'nodes_visited': list(self.nodes_visited), 'nodes_pruned': list(self.nodes_pruned),
+                'leaf_points_scanned': self.leaf_points_scanned, 'leaf_points_filtered': self.leaf_points_filtered,
+                'vp_distance_count': self.vp_distance_count, 'distance_time': self.distance_time,
+                'wall_time': self.wall_time, 'query_count': self.query_count}
+
+    @staticmethod
+    def _add_at_depth(counts, depth, value):
+        """
+        在按深度统计的列表中累加，列表长度不够时补0
+        :param counts: 按深度统计的列表
+        :param depth: 深度
+        :param value: 累加的值
+        :return:
+        """
+        if len(counts) <= depth:
+            counts.extend([0] * (depth + 1 - len(counts)))
+        counts[depth] += value
@@ -0,0 +1,77 @@
+import random
+import pytest
+from utils import edit_distance, edit_distance_bounded, edit_distance_filter_table, edit_distance_lower_bounds
+
+
+def edit_distance_dp(a, b):
+    """
+    使用动态规划计算a,b字符串之间的编辑距离，插入删除代价为1，替换代价为2，作为位并行实现的参照
+    :param a: 字符串a
+    :param b: 字符串b
+    :return:
+    """
+    dis = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        # last记录a[0:i-1]与b[0:j-1]的编辑距离
+        last = dis[0]
+        dis[0] = i
+        for j in range(1, len(b) + 1):
+            temp = dis[j]
+            if a[i - 1] == b[j - 1]:
+                dis[j] = last
+            else:
+                dis[j] = min(dis[j] + 1, last + 2, dis[j - 1] + 1)
+            last = temp
+    return dis[len(b)]
+
+
+def random_pairs(alphabet, pair_count, max_length, seed=0):
+    """
+    从alphabet中随机生成字符串对，字符集很小时包含大量重复字符
+    :param alphabet: 字符集
+    :param pair_count: 字符串对个数
+    :param max_length: 字符串的最大长度
+    :param seed: 随机种子
+    :return:
+    """
+    rng = random.Random(seed)
+    return [tuple(''.join(rng.choice(alphabet) for _ in range(rng.randint(0, max_length))) for _ in range(2))
+            for _ in range(pair_count)]
+
+
+# 超过64个字符的字符串覆盖位向量超过一个机器字的情况
+ALPHABETS = {'ascii': 'abcd', 'unicode': 'aé中\U0001F600', 'letters': 'abcdefghijklmnopqrstuvwxyz'}
+
+
+@pytest.mark.parametrize('alphabet', ALPHABETS.values(), ids=ALPHABETS.keys())
+def test_edit_distance_matches_dp(alphabet):
+    for a, b in random_pairs(alphabet, 300, 100):
+        assert edit_distance(a, b) == edit_distance_dp(a, b)
+
+
+def test_edit_distance_edge_cases():
+    for a, b in [('', ''), ('', 'abc'), ('abc', ''), ('abc', 'abc'), ('ab', 'ba'), ('中文', '文中'), ('a' * 200, 'a')]:
+        assert edit_distance(a, b) == edit_distance_dp(a, b)
+        assert edit_distance(b, a) == edit_distance_dp(a, b)
+
+
+@pytest.mark.parametrize('alphabet', ALPHABETS.values(), ids=ALPHABETS.keys())
+def test_edit_distance_bounded_matches_dp(alphabet):
+    rng = random.Random(1)
+    for a, b in random_pairs(alphabet, 300, 100, seed=2):
+        expected = edit_distance_dp(a, b)
+        max_distance = rng.randint(0, len(a) + len(b))
+        result = edit_distance_bounded(a, b, max_distance)
+        if expected <= max_distance:
+            assert result == expected
+        else:
+            # 超过阈值时返回一个大于阈值且不超过真实距离的下界
+            assert max_distance < result <= expected
+
+
+@pytest.mark.parametrize('alphabet', ALPHABETS.values(), ids=ALPHABETS.keys())
+def test_edit_distance_lower_bounds(alphabet):
+    pairs = random_pairs(alphabet, 300, 100, seed=3)
+    table = edit_distance_filter_table([a for a, _ in pairs])
+    for i, (a, b) in enumerate(pairs):
+        assert edit_distance_lower_bounds(table[i:i + 1], b)[0] <= edit_distance_dp(a, b)
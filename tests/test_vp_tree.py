@@ -0,0 +1,190 @@
+import random
+import numpy as np
+import pytest
+from vp_tree import VPTree
+from search_stats import SearchStats
+from utils import euclidean_distance, edit_distance, create_float_data, create_string_data
+
+
+def brute_force_ids(points, distance_fun, query_point, query_range):
+    """
+    在编号到数据点的字典上用暴力法计算查询范围内的点的编号，作为树的搜索结果的参照
+    :param points: 编号到数据点的字典
+    :param distance_fun: 距离计算函数
+    :param query_point: 查询数据
+    :param query_range: 与查询数据之间的最大距离
+    :return: 排好序的编号列表
+    """
+    return sorted(i for i, point in points.items() if distance_fun(query_point, point) <= query_range)
+
+
+def search_ids(tree, query_point, query_range):
+    """
+    返回VP树范围搜索结果中排好序的编号列表
+    :param tree: VP树
+    :param query_point: 查询数据
+    :param query_range: 与查询数据之间的最大距离
+    :return:
+    """
+    return sorted(tree.range_search(query_point, query_range, return_ids=True)['ids'].tolist())
+
+
+def make_case(data_type, count, seed):
+    """
+    生成数据、距离函数、查询、查询半径与生成新数据点的函数
+    :param data_type: 数据类型，string or num
+    :param count: 数据个数
+    :param seed: 随机种子
+    :return:
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    if data_type == 'string':
+        data = create_string_data(count, 3, 10)
+        return data, edit_distance, list(create_string_data(20, 3, 10)), (4, 8), \
+            lambda: create_string_data(1, 3, 10)[0]
+    data = create_float_data(count, 4)
+    return data, euclidean_distance, list(create_float_data(20, 4)), (0.2, 0.4), lambda: np.random.random(4)
+
+
+@pytest.mark.parametrize('data_type', ['num', 'string'])
+@pytest.mark.parametrize('tree_ways, leaf_capacity, pivot_levels', [(2, 1, 0), (3, 8, 2)])
+def test_insert_delete_compact_match_brute_force(data_type, tree_ways, leaf_capacity, pivot_levels):
+    data, distance_fun, queries, query_ranges, new_point = make_case(data_type, 300, 0)
+    tree = VPTree(data, distance_fun, data_type, tree_ways=tree_ways, leaf_capacity=leaf_capacity,
+                  pivot_levels=pivot_levels)
+    points = dict(enumerate(data))
+    rng = random.Random(1)
+    for step in range(400):
+        if rng.random() < 0.5 or len(points) < 10:
+            point = new_point()
+            points[tree.insert(point)] = point
+        elif rng.random() < 0.5:
+            point_id = rng.choice(sorted(points))
+            assert tree.delete(point_id)
+            del points[point_id]
+            assert not tree.delete(point_id)
+        else:
+            # 按数据点删除时删除的是与之相同的任意一个点
+            point = points[rng.choice(sorted(points))]
+            before = search_ids(tree, point, 0)
+            assert tree.delete(point)
+            deleted = set(before) - set(search_ids(tree, point, 0))
+            assert len(deleted) == 1
+            del points[deleted.pop()]
+        if step % 50 == 0:
+            for query_point in queries[:5]:
+                assert search_ids(tree, query_point, query_ranges[0]) == \
+                    brute_force_ids(points, distance_fun, query_point, query_ranges[0])
+
+    assert tree.get_data_count_of_tree() == len(points)
+    for query_point in queries:
+        for query_range in query_ranges:
+            expected = brute_force_ids(points, distance_fun, query_point, query_range)
+            assert search_ids(tree, query_point, query_range) == expected
+            assert sorted(tree.brute_force_search(query_point, query_range, return_ids=True)['ids'].tolist()) == \
+                expected
+    with pytest.raises(ValueError):
+        tree.get_tree_arrays()
+
+    tree.compact()
+    arrays = tree.get_tree_arrays()
+    assert sorted(arrays['ids'].tolist()) == sorted(points)
+    assert tree.get_data_count_of_tree() == len(points)
+    for query_point in queries:
+        for query_range in query_ranges:
+            assert search_ids(tree, query_point, query_range) == \
+                brute_force_ids(points, distance_fun, query_point, query_range)
+        result = tree.knn_search(query_point, 5, return_ids=True)
+        expected = sorted(distance_fun(query_point, point) for point in points.values())[:5]
+        assert np.allclose(result['distances'], expected)
+
+
+def test_compact_without_updates_keeps_tree():
+    data, distance_fun, _, _, _ = make_case('num', 100, 2)
+    tree = VPTree(data, distance_fun, 'num')
+    arrays = tree.get_tree_arrays()
+    tree.compact()
+    assert tree.get_tree_arrays()['data'] is arrays['data']
+
+
+def test_delete_missing_point():
+    data, distance_fun, _, _, _ = make_case('num', 50, 3)
+    tree = VPTree(data, distance_fun, 'num')
+    assert not tree.delete(-1)
+    assert not tree.delete(len(data))
+    assert not tree.delete(np.full(4, 2.0))
+    assert tree.get_data_count_of_tree() == len(data)
+
+
+@pytest.mark.parametrize('data_type', ['num', 'string'])
+@pytest.mark.parametrize('mmap', [True, False])
+def test_save_load_round_trip(tmp_path, data_type, mmap):
+    data, distance_fun, queries, query_ranges, _ = make_case(data_type, 300, 4)
+    tree = VPTree(data, distance_fun, data_type, tree_ways=3, leaf_capacity=4, pivot_levels=2)
+    path = str(tmp_path / 'index.vpt')
+    tree.save(path)
+    loaded = VPTree.load(path, mmap=mmap)
+
+    assert loaded.get_params() == tree.get_params()
+    for name, array in tree.get_tree_arrays().items():
+        assert np.array_equal(loaded.get_tree_arrays()[name], array)
+    points = dict(enumerate(data))
+    for query_point in queries:
+        for query_range in query_ranges:
+            assert search_ids(loaded, query_point, query_range) == \
+                brute_force_ids(points, distance_fun, query_point, query_range)
+        assert np.allclose(loaded.knn_search(query_point, 3, return_ids=True)['distances'],
+                           tree.knn_search(query_point, 3, return_ids=True)['distances'])
+
+
+def test_loaded_tree_can_be_updated(tmp_path):
+    data, distance_fun, queries, query_ranges, new_point = make_case('num', 200, 5)
+    path = str(tmp_path / 'index.vpt')
+    VPTree(data, distance_fun, 'num', leaf_capacity=4).save(path)
+    # 插入删除时复制内存映射的只读数组，不修改索引文件
+    loaded = VPTree.load(path)
+    points = dict(enumerate(data))
+    for _ in range(20):
+        point = new_point()
+        points[loaded.insert(point)] = point
+    for point_id in range(0, 200, 7):
+        assert loaded.delete(point_id)
+        del points[point_id]
+    for query_point in queries:
+        assert search_ids(loaded, query_point, query_ranges[1]) == \
+            brute_force_ids(points, distance_fun, query_point, query_ranges[1])
+    assert VPTree.load(path).get_data_count_of_tree() == len(data)
+
+
+def test_load_rejects_other_files(tmp_path):
+    path = tmp_path / 'index.vpt'
+    path.write_bytes(b'not an index file')
+    with pytest.raises(ValueError):
+        VPTree.load(str(path))
+
+
+@pytest.mark.parametrize('data_type', ['num', 'string'])
+def test_stats_match_distance_counts(data_type):
+    data, distance_fun, queries, query_ranges, _ = make_case(data_type, 300, 6)
+    tree = VPTree(data, distance_fun, data_type, tree_ways=3, leaf_capacity=4, pivot_levels=2)
+    searches = {
+        'range': lambda q, r, stats: tree.range_search(q, r, stats=stats),
+        'budget': lambda q, r, stats: tree.range_search(q, r, stats=stats, max_distance_times=40),
+        'epsilon': lambda q, r, stats: tree.range_search(q, r, stats=stats, epsilon=0.5),
+        'count': lambda q, r, stats: tree.range_count(q, r, stats=stats),
+        'any': lambda q, r, stats: tree.range_any(q, r, stats=stats),
+        'knn': lambda q, r, stats: tree.knn_search(q, 5, stats=stats, epsilon=0.5),
+    }
+    for name, search in searches.items():
+        stats = SearchStats()
+        cal_distance_times = sum(search(query_point, query_ranges[1], stats)['cal_distance_times']
+                                 for query_point in queries)
+        assert stats.query_count == len(queries), name
+        assert stats.vp_distance_count + stats.leaf_points_scanned == cal_distance_times, name
+        assert sum(stats.nodes_visited) > 0, name
+
+    stats = SearchStats()
+    results = tree.range_search_batch(np.array(queries), query_ranges[1], stats=stats)
+    assert stats.query_count == len(queries)
+    assert stats.vp_distance_count + stats.leaf_points_scanned == sum(r['cal_distance_times'] for r in results)
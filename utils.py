@@ -3,6 +3,16 @@ import pandas as pd
 import random
 import string
 import csv
+import functools
+
+# edit_distance_bounded中每处理多少个字符检查一次是否可以提前结束
+EARLY_EXIT_CHECK_INTERVAL = 8
+# 字符直方图的桶数，字符按Unicode编码对桶数取余放入桶中
+HISTOGRAM_BINS = 64
+# 距离下界表中的长度与字符个数超过该值时饱和
+FILTER_TABLE_MAX = np.iinfo(np.uint16).max
+# 计算距离下界表时每块的字符串个数，限制临时数组的大小
+FILTER_TABLE_CHUNK_SIZE = 65536
 
 
 def euclidean_distance(a, b):
@@ -21,7 +31,9 @@ def euclidean_distance(a, b):
 
 def edit_distance(a, b):
     """
-    计算a,b字符串之间的编辑距离
+    计算a,b字符串之间的编辑距离，插入删除代价为1，替换代价为2
+    该代价下编辑距离等于len(a) + len(b) - 2*LCS(a, b)，使用位并行算法计算最长公共子序列LCS：
+    以Python整数作为长字符串的位向量，短字符串中的每个字符只需要常数次整数运算
     :param a: 字符串a
     :param b: 字符串b
     :return:
@@ -33,25 +45,116 @@ def edit_distance(a, b):
 
     len_a = len(a)
     len_b = len(b)
-    dis = np.zeros(len_b+1, dtype=np.int)
-    for i in range(1, len_b+1):
-        dis[i] = i
-
-    for i in range(1, len_a + 1):
-        # last记录a[0:i-1]与b[0:j-1]的编辑距离
-        last = i - 1
-        dis[0] = i
-        for j in range(1, len_b + 1):
-            temp = dis[j]
-            if a[i-1] == b[j-1]:
-                dis[j] = last
-            else:
-                # 插入删除代价为1，替换代价为2
-                # dis[j]+1为插入代价，last+2为替换代价，dis[j-1]+1为删除代价
-                dis[j] = min(dis[j] + 1, last + 2, dis[j-1] + 1)
-            last = temp
-
-    return dis[len_b]
+    # 用较长的字符串作为位向量，对较短的字符串进行循环
+    if len_a < len_b:
+        a, b = b, a
+    if len(b) == 0:
+        return len(a)
+    # masks[c]的第i位为1表示a[i] == c
+    masks = dict()
+    for i, c in enumerate(a):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    # v中为0的位的个数等于当前的LCS长度
+    v = full
+    for c in b:
+        u = v & masks.get(c, 0)
+        v = ((v + u) | (v - u)) & full
+    lcs = len(a) - bin(v).count('1')
+    return len_a + len_b - 2 * lcs
+
+
+def edit_distance_bounded(a, b, max_distance):
+    """
+    计算a,b字符串之间不超过max_distance的编辑距离，代价与edit_distance相同
+    当剩余字符全部匹配也无法使距离不超过max_distance时提前结束
+    :param a: 字符串a
+    :param b: 字符串b
+    :param max_distance: 距离阈值
+    :return: 距离不超过max_distance时返回准确的距离，否则返回一个大于max_distance的距离下界
+    """
+    if not isinstance(a, str):
+        raise ValueError('a should be a str')
+    if not isinstance(b, str):
+        raise ValueError('b should be a str')
+
+    len_a = len(a)
+    len_b = len(b)
+    # 长度差是编辑距离的下界
+    if abs(len_a - len_b) > max_distance:
+        return abs(len_a - len_b)
+    if len_a < len_b:
+        a, b = b, a
+    if len(b) == 0:
+        return len(a)
+    masks = dict()
+    for i, c in enumerate(a):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    v = full
+    # 当前LCS长度加上剩余字符数是最终LCS长度的上界，由此得到最终编辑距离的下界
+    # 每处理EARLY_EXIT_CHECK_INTERVAL个字符检查一次，减少统计位数的开销
+    max_lcs = (len_a + len_b - max_distance) / 2
+    for j, c in enumerate(b):
+        u = v & masks.get(c, 0)
+        v = ((v + u) | (v - u)) & full
+        if (j + 1) % EARLY_EXIT_CHECK_INTERVAL == 0:
+            lcs = len(a) - bin(v).count('1')
+            if lcs + len(b) - j - 1 < max_lcs:
+                return len_a + len_b - 2 * (lcs + len(b) - j - 1)
+    lcs = len(a) - bin(v).count('1')
+    return len_a + len_b - 2 * lcs
+
+
+def edit_distance_filter_table(strings):
+    """
+    预先计算一组字符串的长度与字符直方图，供edit_distance_lower_bounds一次计算多个字符串的距离下界
+    字符按Unicode编码对HISTOGRAM_BINS取余合并到桶中，合并后的直方图得到的下界更松，但仍然是编辑距离的下界
+    :param strings: 字符串数组或列表
+    :return: 形状为(字符串个数, 1 + HISTOGRAM_BINS)的uint16数组，第0列为长度，其余各列为每个桶中的字符个数，
+             超过FILTER_TABLE_MAX的值饱和
+    """
+    table = np.zeros((len(strings), 1 + HISTOGRAM_BINS), dtype=np.uint16)
+    for i in range(0, len(strings), FILTER_TABLE_CHUNK_SIZE):
+        chunk = strings[i:i + FILTER_TABLE_CHUNK_SIZE]
+        lengths = np.fromiter((len(item) for item in chunk), dtype=np.int64, count=len(chunk))
+        # 将整块字符串拼接为一个编码缓冲区，每个字符属于的行由长度得到，临时数组的大小与字符总数成正比
+        codes = np.frombuffer(''.join(chunk).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+        rows = np.repeat(np.arange(len(chunk), dtype=np.int64), lengths)
+        cells = rows * HISTOGRAM_BINS + codes % HISTOGRAM_BINS
+        histograms = np.bincount(cells, minlength=len(chunk) * HISTOGRAM_BINS).reshape(len(chunk), HISTOGRAM_BINS)
+        table[i:i + len(chunk), 0] = np.minimum(lengths, FILTER_TABLE_MAX)
+        table[i:i + len(chunk), 1:] = np.minimum(histograms, FILTER_TABLE_MAX)
+    return table
+
+
+def edit_distance_lower_bounds(table, b):
+    """
+    根据edit_distance_filter_table计算的表，一次计算多个字符串到b之间编辑距离的下界
+    LCS(a, b)不超过两个字符串中每个桶的字符个数的较小值之和，因此编辑距离不小于两个直方图之差的L1范数
+    表中饱和的值小于真实值：当b的长度小于FILTER_TABLE_MAX时，饱和的个数大于b中对应的个数，取较小值不受影响，
+    饱和的长度只会使下界变小，因此下界仍然成立；b的长度达到FILTER_TABLE_MAX时无法使用该表，所有下界返回0
+    :param table: edit_distance_filter_table计算的表
+    :param b: 字符串b
+    :return: 距离下界组成的一维数组
+    """
+    if len(b) >= FILTER_TABLE_MAX:
+        return np.zeros(len(table), dtype=np.int64)
+    common = np.minimum(table[:, 1:], _folded_histogram(b)).sum(axis=1)
+    return table[:, 0].astype(np.int64) + len(b) - 2 * common
+
+
+@functools.lru_cache(maxsize=256)
+def _folded_histogram(b):
+    """
+    计算字符串b按HISTOGRAM_BINS合并后的字符直方图，同一个查询会在每个叶子中使用，因此缓存最近的结果
+    :param b: 字符串b
+    :return: 只读的直方图数组
+    """
+    histogram = np.bincount(np.frombuffer(b.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32) % HISTOGRAM_BINS,
+                            minlength=HISTOGRAM_BINS)
+    histogram.flags.writeable = False
+    return histogram
 
 
 def create_float_data_to_csv(data_count, data_dim, file_path):
@@ -68,12 +171,28 @@ def create_float_data_to_csv(data_count, data_dim, file_path):
     if not isinstance(data_dim, int) or data_dim < 0:
         raise ValueError('data_dim should be positive integer')
 
-    # 使用np.random生成0-1之间的随机数
-    data = np.random.random((data_count, data_dim))
-    data_frame = pd.DataFrame(data)
+    data_frame = pd.DataFrame(create_float_data(data_count, data_dim))
     data_frame.to_csv(file_path, index=True, sep=',')
 
 
+def create_float_data(data_count, data_dim, rng=None):
+    """
+    创建0-1之间的随机浮点数二维数组，每一行表示一个点
+    :param data_count: 点的个数
+    :param data_dim: 点的维度
+    :param rng: np.random.RandomState随机数生成器，为None时使用全局的np.random
+    :return:
+    """
+    if not isinstance(data_count, int) or data_count < 0:
+        raise ValueError('data_count should be positive integer')
+    if not isinstance(data_dim, int) or data_dim < 0:
+        raise ValueError('data_dim should be positive integer')
+    # 使用np.random生成0-1之间的随机数
+    if rng is None:
+        rng = np.random
+    return rng.random_sample((data_count, data_dim))
+
+
 def create_string_data_to_csv(data_count, min_length, max_length, file_path):
     """
     创建字符串数据，并存放到csv文件中
@@ -96,8 +215,32 @@ def create_string_data_to_csv(data_count, min_length, max_length, file_path):
     with open(file_path, 'w') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(['index', 'string_data'])
-        for i in range(data_count):
-            length = random.randint(min_length, max_length)
-            # 从数字和ascii字符中随机生成长度为length的字符串
-            str_data = ''.join(random.sample(string.ascii_letters + string.digits, length))
+        for i, str_data in enumerate(create_string_data(data_count, min_length, max_length)):
             writer.writerow([i, str_data])
+
+
+def create_string_data(data_count, min_length, max_length, rng=None):
+    """
+    创建随机字符串数据
+    :param data_count: 字符串个数
+    :param min_length: 字符串的最小长度
+    :param max_length: 字符串的最大长度
+    :param rng: random.Random随机数生成器，为None时使用全局的random
+    :return: 字符串组成的一维数组
+    """
+    if not isinstance(data_count, int) or data_count < 0:
+        raise ValueError('data_count should be positive integer')
+    if not isinstance(min_length, int) or min_length < 0:
+        raise ValueError('min_length should be positive integer')
+    if not isinstance(max_length, int) or max_length < 0:
+        raise ValueError('max_length should be positive integer')
+    if min_length > max_length:
+        raise ValueError('min_length greater than max_length')
+    if rng is None:
+        rng = random
+    data = []
+    for i in range(data_count):
+        length = rng.randint(min_length, max_length)
+        # 从数字和ascii字符中随机生成长度为length的字符串
+        data.append(''.join(rng.sample(string.ascii_letters + string.digits, length)))
+    return np.array(data)
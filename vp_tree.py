@@ -1,75 +1,317 @@
 import numpy as np
+import os
 import random
+import heapq
+import importlib
+import itertools
+import json
+import struct
+import time
+import multiprocessing
+from collections import deque
+from multiprocessing import shared_memory
+from metrics import Metric
+from metric_tree import MetricTree
 
 
-class VPTree:
-    def __init__(self, data, distance_fun, data_type, tree_ways=2, leaf_capacity=1, selecting_vp_mode='random'):
+# 扁平存放的树结构与数据数组的名称，对应VPTree中以下划线开头的同名属性
+TREE_ARRAY_NAMES = ('data', 'ids', 'node_start', 'node_end', 'node_first_child', 'node_child_count',
+                    'node_lower', 'node_upper', 'pivot_table', 'filter_table')
+# 二进制索引文件的魔数、格式版本号与数组的对齐字节数
+INDEX_MAGIC = b'VPTREE\x00\x00'
+INDEX_VERSION = 1
+INDEX_ALIGNMENT = 64
+# 插入与删除时需要扩容的数组：与数据位置对应的数组，以及与节点编号对应的数组
+POSITION_ARRAY_NAMES = ('data', 'ids', 'pivot_table', 'filter_table', 'deleted', 'position_node')
+NODE_ARRAY_NAMES = ('node_start', 'node_end', 'node_first_child', 'node_child_count', 'node_lower', 'node_upper',
+                    'node_parent', 'node_size', 'node_tombstones', 'node_updates')
+# 子树中被删除的支撑点超过该比例时，局部重建该子树
+REBUILD_TOMBSTONE_RATIO = 0.25
+# 子树中最大的孩子超过最小的孩子的该倍数时，认为子树不平衡，局部重建该子树
+REBUILD_BALANCE_FACTOR = 3
+
+
+class VPTree(MetricTree):
+    def __init__(self, data, distance_fun, data_type, tree_ways=2, leaf_capacity=1, selecting_vp_mode='random',
+                 vp_candidate_count=50, vp_sample_count=100, n_jobs=1, parallel_min_size=100000, pivot_levels=0):
         """
         构造函数
+        树以扁平数组的形式存放：所有节点共享同一个数据缓冲区，节点的支撑点、距离上下界、
+        孩子和叶子数据都通过下标访问，节点编号0为根节点
         :param data:
         :param distance_fun:
+        :param vp_candidate_count: max_std模式下每个节点的候选支撑点个数
+        :param vp_sample_count: max_std模式下用来计算候选支撑点距离标准差的采样点个数
+        :param n_jobs: 建树使用的进程数，-1表示使用所有cpu
+        :param parallel_min_size: 数据个数不少于该值的子树才会交给worker进程创建
+        :param pivot_levels: 每个点保存到最近的多少层祖先支撑点的距离，用于在叶子中不计算距离地过滤数据点，
+                             每层每个点额外占用8字节，0表示不保存
         """
         if data is None or len(data) == 0:
             raise ValueError('Data can not be empty')
+        self._set_params(distance_fun, data_type, tree_ways=tree_ways, leaf_capacity=leaf_capacity,
+                         selecting_vp_mode=selecting_vp_mode, vp_candidate_count=vp_candidate_count,
+                         vp_sample_count=vp_sample_count, n_jobs=n_jobs, parallel_min_size=parallel_min_size,
+                         pivot_levels=pivot_levels)
+        # build tree 构造树结构
+        self.build_tree(data)
+
+    @classmethod
+    def from_tree_arrays(cls, arrays, distance_fun, data_type, **params):
+        """
+        直接使用已经建好的树结构数组创建VP树，不重新建树
+        数组可以是共享内存或内存映射上的只读数组
+        :param arrays: get_tree_arrays返回的数组
+        :param distance_fun: 距离计算函数
+        :param data_type: 数据类型，string or num
+        :param params: get_params返回的其余参数
+        :return:
+        """
+        tree = cls.__new__(cls)
+        tree._set_params(distance_fun, data_type, **params)
+        for name in TREE_ARRAY_NAMES:
+            setattr(tree, '_' + name, arrays[name])
+        return tree
+
+    def _set_params(self, distance_fun, data_type, tree_ways=2, leaf_capacity=1, selecting_vp_mode='random',
+                    vp_candidate_count=50, vp_sample_count=100, n_jobs=1, parallel_min_size=100000, pivot_levels=0):
+        """
+        检查并设置VP树的参数，参数含义与构造函数相同
+        :return:
+        """
         if not isinstance(tree_ways, int) or tree_ways < 2:
             raise ValueError('leaf_data should be a integer and must bigger than 1')
         if not isinstance(leaf_capacity, int) or leaf_capacity < 1:
             raise ValueError('leaf_capacity should be a positive integer')
-        if data_type != 'string' and data_type != 'num':
-            raise ValueError('data type should be string or num')
         if selecting_vp_mode != 'random' and selecting_vp_mode != 'max_std':
             raise ValueError('selecting_method should be random or max_std, instead of :', selecting_vp_mode)
+        if not isinstance(vp_candidate_count, int) or vp_candidate_count < 1:
+            raise ValueError('vp_candidate_count should be a positive integer')
+        if not isinstance(vp_sample_count, int) or vp_sample_count < 1:
+            raise ValueError('vp_sample_count should be a positive integer')
+        if not isinstance(n_jobs, int) or (n_jobs < 1 and n_jobs != -1):
+            raise ValueError('n_jobs should be a positive integer or -1')
+        if not isinstance(parallel_min_size, int) or parallel_min_size < 1:
+            raise ValueError('parallel_min_size should be a positive integer')
+        if not isinstance(pivot_levels, int) or pivot_levels < 0:
+            raise ValueError('pivot_levels should be a non-negative integer')
 
-        self._childes = []  # 孩子节点
-        self._vantage_point = None  # 优势点
-        self._distance_fun = distance_fun  # 距离计算函数
+        self._set_metric(distance_fun, data_type)
         self._tree_ways = tree_ways  # 划分数
-        self._cutoff_values = []  # 不同划分间的距离分隔值
         self._leaf_capacity = leaf_capacity  # 叶子容量
-        self._data_type = data_type
-        self._is_leaf = False
-        self._leaf_data = None
         self._selecting_vp_mode = selecting_vp_mode  # random or max_std
-        # build tree 构造树结构
-        self.build_tree(data)
+        self._vp_candidate_count = vp_candidate_count  # max_std模式的候选支撑点个数
+        self._vp_sample_count = vp_sample_count  # max_std模式的采样点个数
+        self._n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs  # 建树使用的进程数
+        self._parallel_min_size = parallel_min_size  # 交给worker创建的子树的最小数据个数
+        self._pivot_levels = pivot_levels  # 每个点保存的祖先支撑点距离的层数
+        self._data = None  # 按树的布局重新排列后的数据，每棵子树占据其中一段连续的区间
+        self._ids = None  # self._data中每个点在原始数据中的行号
+        self._node_start = None  # 节点在self._data中的起始位置，非叶子节点的支撑点存放在起始位置
+        self._node_end = None  # 节点在self._data中的结束位置（不包含）
+        self._node_first_child = None  # 第一个孩子的节点编号，同一节点的孩子编号连续，叶子节点为-1
+        self._node_child_count = None  # 孩子个数，叶子节点为0
+        self._node_lower = None  # 节点中的点到父节点支撑点的最小距离，根节点为0
+        self._node_upper = None  # 节点中的点到父节点支撑点的最大距离，根节点为inf
+        self._pivot_table = None  # 形状为(数据个数, pivot_levels)，每个点到最近pivot_levels层祖先支撑点的距离
+        # 每个点预先计算的距离下界表，字符串数据为长度与字符直方图，不使用时为0列的数组
+        self._filter_table = None
+        self._next_id = None  # 下一个插入的点的编号
+        self._reset_update_state()
 
-    def get_childes(self):
+    def _reset_update_state(self):
         """
-        返回vp树的所有孩子节点
+        清空插入与删除使用的状态，在第一次插入或删除时由_prepare_updates重新创建
         :return:
         """
-        return self._childes
+        self._buffers = None  # 可扩容数组的底层缓冲区，树的数组为其前面一段的视图
+        self._deleted = None  # 与self._data对应，支撑点是否已被删除（墓碑）
+        self._position_node = None  # 与self._data对应，每个位置所属的节点
+        self._id_positions = None  # 每个编号的点在self._data中的位置，已删除的点为-1
+        self._node_parent = None  # 父节点编号，根节点为-1
+        self._node_size = None  # 子树中未被删除的点的个数
+        self._node_tombstones = None  # 子树中被删除的支撑点的个数
+        self._node_updates = None  # 子树上一次创建后插入与删除的次数
+        self._garbage_count = 0  # self._data中不再被任何节点使用的位置个数
+        self._garbage_node_count = 0  # 局部重建后不再使用的节点个数
 
-    def is_leaf(self):
+    def get_params(self):
         """
-        判断vp树是否是叶子节点
+        返回创建VP树使用的参数（不包括数据与距离函数），可以传给from_tree_arrays
         :return:
         """
-        return self._is_leaf
+        return {'data_type': self._data_type, 'tree_ways': self._tree_ways, 'leaf_capacity': self._leaf_capacity,
+                'selecting_vp_mode': self._selecting_vp_mode, 'vp_candidate_count': self._vp_candidate_count,
+                'vp_sample_count': self._vp_sample_count, 'n_jobs': self._n_jobs,
+                'parallel_min_size': self._parallel_min_size, 'pivot_levels': self._pivot_levels}
 
-    def get_leaf_data(self):
+    def get_tree_arrays(self):
+        """
+        返回扁平存放的树结构与数据数组，键为TREE_ARRAY_NAMES中的名称
+        插入或删除过数据后数组中有墓碑与不再使用的位置，需要先调用compact
+        :return:
+        """
+        if self._node_size is not None:
+            raise ValueError('the tree has been updated by insert or delete, call compact() first')
+        return {name: getattr(self, '_' + name) for name in TREE_ARRAY_NAMES}
+
+    def compact(self):
+        """
+        插入或删除过数据后，用未被删除的点重新创建整棵树，去掉墓碑与不再使用的位置，
+        重新选择支撑点，树的结构会改变，点的编号不变；没有插入或删除过数据时不做任何事
+        :return:
+        """
+        if self._node_size is not None:
+            self._rebuild_subtree(0, 0)
+
+    def save(self, path):
         """
-        如果vp树是叶子节点，返回叶子节点的数据
+        将VP树保存为带版本号的二进制索引文件
+        文件由魔数、版本号、json头与按INDEX_ALIGNMENT对齐的原始数组组成，可以直接内存映射加载
+        插入或删除过数据后需要先调用compact
+        :param path: 文件路径
         :return:
         """
-        if self._is_leaf:
-            return self._leaf_data
+        arrays = self.get_tree_arrays()
+        # object类型的字符串数组转换为定长的字符串数组，才能直接写入与内存映射
+        if arrays['data'].dtype == object:
+            arrays['data'] = arrays['data'].astype(str)
+        if isinstance(self._distance_fun, Metric):
+            distance_fun_name = '%s:%s' % (type(self._distance_fun).__module__, self._distance_fun.name)
+        else:
+            distance_fun_name = '%s:%s' % (self._distance_fun.__module__, self._distance_fun.__qualname__)
+        header = {'params': self.get_params(), 'distance_fun': distance_fun_name, 'arrays': dict()}
+        # 先计算每个数组在文件中的偏移，json头的长度会影响数组的起始位置，因此预留足够的头部空间
+        offset = 0
+        for name in TREE_ARRAY_NAMES:
+            array = np.ascontiguousarray(arrays[name])
+            arrays[name] = array
+            header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset += -(-array.nbytes // INDEX_ALIGNMENT) * INDEX_ALIGNMENT
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = -(-(len(INDEX_MAGIC) + 8 + len(header_bytes)) // INDEX_ALIGNMENT) * INDEX_ALIGNMENT
+
+        with open(path, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(struct.pack('<II', INDEX_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            for name in TREE_ARRAY_NAMES:
+                f.seek(data_start + header['arrays'][name]['offset'])
+                f.write(arrays[name].tobytes())
+
+    @classmethod
+    def load(cls, path, mmap=True, distance_fun=None):
+        """
+        加载save保存的VP树
+        :param path: 文件路径
+        :param mmap: 是否以只读内存映射的方式加载数组，为False时将数组读入内存
+        :param distance_fun: 距离计算函数，为None时根据文件中记录的函数名导入
+        :return:
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError('%s is not a vp tree index file' % path)
+            version, header_length = struct.unpack('<II', f.read(8))
+            if version != INDEX_VERSION:
+                raise ValueError('unsupported index version: %d' % version)
+            header = json.loads(f.read(header_length).decode('utf-8'))
+        data_start = -(-(len(INDEX_MAGIC) + 8 + header_length) // INDEX_ALIGNMENT) * INDEX_ALIGNMENT
+
+        if distance_fun is None:
+            module_name, fun_name = header['distance_fun'].split(':')
+            try:
+                distance_fun = getattr(importlib.import_module(module_name), fun_name)
+            except (ImportError, AttributeError):
+                raise ValueError('can not import distance function %s, please pass distance_fun'
+                                 % header['distance_fun'])
+
+        arrays = dict()
+        buffer = np.memmap(path, dtype=np.uint8, mode='r') if mmap else None
+        for name in TREE_ARRAY_NAMES:
+            spec = header['arrays'][name]
+            dtype = np.dtype(spec['dtype'])
+            count = int(np.prod(spec['shape']))
+            offset = data_start + spec['offset']
+            if mmap:
+                array = buffer[offset:offset + count * dtype.itemsize].view(dtype)
+            else:
+                array = np.fromfile(path, dtype=dtype, count=count, offset=offset)
+            arrays[name] = array.reshape(spec['shape'])
+        return cls.from_tree_arrays(arrays, distance_fun, **header['params'])
+
+    def get_childes(self, node=0):
+        """
+        返回vp树节点的所有孩子节点，孩子节点为VPTreeNode视图，可以像子树一样访问
+        :param node: 节点编号，默认为根节点
+        :return:
+        """
+        return [VPTreeNode(self, child) for child in self._child_nodes(node)]
+
+    def _child_nodes(self, node):
+        """
+        返回vp树节点的所有孩子节点编号
+        :param node: 节点编号
+        :return:
+        """
+        first_child = self._node_first_child[node]
+        return list(range(first_child, first_child + self._node_child_count[node]))
+
+    def is_leaf(self, node=0):
+        """
+        判断vp树节点是否是叶子节点
+        :param node: 节点编号，默认为根节点
+        :return:
+        """
+        return self._node_child_count[node] == 0
+
+    def get_leaf_data(self, node=0):
+        """
+        如果vp树节点是叶子节点，返回叶子节点的数据
+        :param node: 节点编号，默认为根节点
+        :return:
+        """
+        if self.is_leaf(node):
+            return self._data[self._node_start[node]:self._node_end[node]]
         else:
             return None
 
-    def get_vantage_point(self):
+    def get_vantage_point(self, node=0):
         """
-        返回vp树root的支撑点
+        返回vp树节点的支撑点
+        :param node: 节点编号，默认为根节点
         :return:
         """
-        return self._vantage_point
+        if self.is_leaf(node):
+            return None
+        return self._data[self._node_start[node]]
 
-    def get_cutoff_values(self):
+    def get_cutoff_values(self, node=0):
+        """
+        返回vp树节点的各个分组之间的中值，由相邻孩子的距离上下界计算得到
+        :param node: 节点编号，默认为根节点
+        :return:
+        """
+        childes = self._child_nodes(node)
+        if len(childes) == 0:
+            return []
+        if len(childes) == 1:
+            return [self._node_upper[childes[0]]]
+        return [(self._node_upper[childes[i]] + self._node_lower[childes[i + 1]])/2 for i in range(len(childes) - 1)]
+
+    def get_distance_bounds(self, node=0):
+        """
+        返回vp树节点中的点到父节点支撑点的最小距离与最大距离
+        :param node: 节点编号，默认为根节点
+        :return:
         """
-        返回vp树root的各个分组之间的中值
+        return self._node_lower[node], self._node_upper[node]
+
+    def get_node_count(self):
+        """
+        返回vp树的节点个数
         :return:
         """
-        return self._cutoff_values
+        return len(self._node_start) - self._garbage_node_count
 
     def get_tree_way(self):
         """
@@ -92,9 +334,25 @@ class VPTree:
         """
         return self._selecting_vp_mode
 
+    def get_vp_candidate_count(self):
+        """
+        返回max_std模式下每个节点的候选支撑点个数
+        :return:
+        """
+        return self._vp_candidate_count
+
+    def get_vp_sample_count(self):
+        """
+        返回max_std模式下计算距离标准差的采样点个数
+        :return:
+        """
+        return self._vp_sample_count
+
     def build_tree(self, data):
         """
-        根据data，递归地创建vp tree
+        根据data，创建扁平数组形式的vp tree
+        只在一个行号数组上原地进行置换，每个节点占据其中一段连续的区间，不复制数据子集
+        n_jobs大于1时，较大的子树交给进程池中的worker创建，再合并回同一棵树
         :param data:
         :return:
         """
@@ -102,34 +360,184 @@ class VPTree:
         if data is None or len(data) == 0:
             return None
 
-        # 数据比较少，直接放在一个叶子节点中
-        if isinstance(data, str):
-            self._is_leaf = True
-            self._leaf_data = data
-            return self
-        elif len(data) <= self._leaf_capacity:
-            self._is_leaf = True
-            self._leaf_data = data
-            return self
+        data = np.asarray(data)
+        # 字符串数据统一为一维数组，单个字符串也作为只有一个元素的数组
+        if self._data_type == 'string':
+            data = data.reshape(-1)
+
+        # perm记录重排后每个位置对应的原始行号，每个节点占据其中[start, end)的区间
+        perm = np.arange(len(data), dtype=np.int64)
+        # pivot_table的每一行与perm中的位置对应，记录该点到祖先支撑点的距离
+        pivot_table = np.zeros((len(data), self._pivot_levels), dtype=np.float64)
+        nodes = VPTree._empty_node_lists()
+        VPTree._append_node(nodes, 0, len(data))
+        if self._n_jobs > 1:
+            # 大于task_size的节点在主进程中划分，不小于parallel_min_size的子树交给worker创建
+            task_size = max(self._parallel_min_size, -(-len(data) // (4 * self._n_jobs)))
+            parallel_tasks = []
+            self._build_nodes(data, perm, pivot_table, nodes, 0, 0, parallel_tasks, task_size)
+            if len(parallel_tasks) > 0:
+                self._build_subtrees_in_parallel(data, perm, pivot_table, nodes, parallel_tasks)
+        else:
+            self._build_nodes(data, perm, pivot_table, nodes, 0, 0)
 
-        # 选择支撑点
-        vantage_point, vp_index = self.select_vantage_point(data, self._selecting_vp_mode)
-        self._vantage_point = vantage_point
+        self._data = data[perm]
+        self._ids = perm
+        self._pivot_table = pivot_table
+        self._filter_table = self._make_filter_table(self._data)
+        self._node_start = np.array(nodes['start'], dtype=np.int64)
+        self._node_end = np.array(nodes['end'], dtype=np.int64)
+        self._node_first_child = np.array(nodes['first_child'], dtype=np.int64)
+        self._node_child_count = np.array(nodes['child_count'], dtype=np.int64)
+        self._node_lower = np.array(nodes['lower'], dtype=np.float64)
+        self._node_upper = np.array(nodes['upper'], dtype=np.float64)
+        self._next_id = len(data)
+        self._reset_update_state()
+        return self
 
-        if self._data_type == 'string' and (isinstance(self._vantage_point, list) or isinstance(self._vantage_point, np.ndarray)):
-            self._vantage_point = self._vantage_point[0]
+    def _build_nodes(self, data, perm, pivot_table, nodes, root, root_depth, parallel_tasks=None, task_size=None):
+        """
+        在perm上原地创建以root为根的子树，新建的节点追加到nodes中
+        :param data: 数据集
+        :param perm: 重排后每个位置对应的原始行号
+        :param pivot_table: 与perm的位置对应的支撑点距离表，随perm一起置换
+        :param nodes: 节点列表
+        :param root: 子树根节点的编号
+        :param root_depth: 子树根节点的深度，根节点的深度为0
+        :param parallel_tasks: 不为None时，大小在[parallel_min_size, task_size]之间的子树不在这里创建，
+                               而是将(节点编号, 深度)记录到其中
+        :param task_size: 交给worker创建的子树的最大大小
+        :return:
+        """
+        # nodes_to_build 待创建节点栈，元素为(节点编号, 深度)
+        nodes_to_build = [(root, root_depth)]
+
+        while len(nodes_to_build) > 0:
+            node, depth = nodes_to_build.pop()
+            start = nodes['start'][node]
+            end = nodes['end'][node]
+
+            # 数据比较少，直接放在一个叶子节点中
+            if end - start <= self._leaf_capacity:
+                continue
+            if parallel_tasks is not None and self._parallel_min_size <= end - start <= task_size:
+                parallel_tasks.append((node, depth))
+                continue
+
+            # 选择支撑点，交换到节点区间的起始位置
+            indexes = perm[start:end]
+            _, vp_index = self.select_vantage_point(data, self._selecting_vp_mode, indexes)
+            indexes[0], indexes[vp_index] = indexes[vp_index], indexes[0]
+            vantage_point = data[indexes[0]]
+
+            # 根据每个点到支撑点的距离对其余数据进行划分，直接在perm上置换
+            rest = indexes[1:]
+            distances = self._distances_to_point(data, rest, vantage_point)
+            order, cutoff_indexes, child_bounds = self._partition_by_distances(distances)
+            rest[:] = rest[order]
+
+            # 深度为depth的支撑点的距离存放在第depth % pivot_levels列，每个点只保留最近的pivot_levels个祖先
+            if self._pivot_levels > 0:
+                pivot_rows = pivot_table[start:end]
+                pivot_rows[[0, vp_index]] = pivot_rows[[vp_index, 0]]
+                pivot_rows[1:] = pivot_rows[1:][order]
+                pivot_rows[1:, depth % self._pivot_levels] = distances[order]
+
+            # 为所有孩子分配连续的节点编号，孩子依次占据支撑点之后的区间
+            nodes['first_child'][node] = len(nodes['start'])
+            bounds = [0] + cutoff_indexes + [len(rest)]
+            nodes['child_count'][node] = len(bounds) - 1
+            for i in range(len(bounds) - 1):
+                nodes_to_build.append((len(nodes['start']), depth + 1))
+                VPTree._append_node(nodes, start + 1 + bounds[i], start + 1 + bounds[i + 1], *child_bounds[i])
+
+    def _build_subtrees_in_parallel(self, data, perm, pivot_table, nodes, parallel_tasks):
+        """
+        使用进程池创建parallel_tasks中的子树，并合并到nodes、perm与pivot_table中
+        数值数据通过共享内存传给worker，字符串数据在每个worker初始化时传入一次
+        :param data: 数据集
+        :param perm: 重排后每个位置对应的原始行号
+        :param pivot_table: 支撑点距离表
+        :param nodes: 节点列表
+        :param parallel_tasks: 需要在worker中创建的子树的(根节点编号, 深度)
+        :return:
+        """
+        shm = None
+        if self._data_type == 'num':
+            shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+            shared_data = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+            shared_data[:] = data
+            init_args = (self, None, shm.name, data.shape, data.dtype.str)
+        else:
+            init_args = (self, data, None, None, None)
+        try:
+            tasks = [(node, depth, perm[nodes['start'][node]:nodes['end'][node]],
+                      pivot_table[nodes['start'][node]:nodes['end'][node]]) for node, depth in parallel_tasks]
+            with multiprocessing.Pool(min(self._n_jobs, len(tasks)), initializer=_init_build_worker,
+                                      initargs=init_args) as pool:
+                for node, sub_perm, sub_pivot_table, sub_nodes in pool.imap_unordered(_build_subtree_in_worker,
+                                                                                      tasks):
+                    start = nodes['start'][node]
+                    perm[start:nodes['end'][node]] = sub_perm
+                    pivot_table[start:nodes['end'][node]] = sub_pivot_table
+                    VPTree._merge_sub_nodes(nodes, node, sub_nodes, start)
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
 
-        data = np.delete(data, vp_index, axis=0)
+    @staticmethod
+    def _merge_sub_nodes(nodes, node, sub_nodes, start):
+        """
+        将worker创建的子树合并到nodes中，子树的根节点对应nodes中的node
+        :param nodes: 节点列表
+        :param node: 子树根节点在nodes中的编号
+        :param sub_nodes: worker创建的子树的节点列表，节点位置从0开始
+        :param start: 子树在perm中的起始位置
+        :return:
+        """
+        # 子树中除根节点外的节点编号整体偏移到nodes的末尾
+        offset = len(nodes['start']) - 1
+        for i in range(len(sub_nodes['start'])):
+            first_child = sub_nodes['first_child'][i]
+            if first_child >= 0:
+                first_child += offset
+            if i == 0:
+                nodes['first_child'][node] = first_child
+                nodes['child_count'][node] = sub_nodes['child_count'][0]
+                continue
+            nodes['start'].append(sub_nodes['start'][i] + start)
+            nodes['end'].append(sub_nodes['end'][i] + start)
+            nodes['first_child'].append(first_child)
+            nodes['child_count'].append(sub_nodes['child_count'][i])
+            nodes['lower'].append(sub_nodes['lower'][i])
+            nodes['upper'].append(sub_nodes['upper'][i])
 
-        # 根据每个点到支撑点的距离对数据进行划分
-        distances = np.array([self._distance_fun(self._vantage_point, point) for point in data])
-        data_splited, cutoff_values = self.split_data_into_multi_ways(data, distances)
-        self._cutoff_values = cutoff_values
+    @staticmethod
+    def _empty_node_lists():
+        """
+        返回创建树时使用的空节点列表
+        :return:
+        """
+        return {'start': [], 'end': [], 'first_child': [], 'child_count': [], 'lower': [], 'upper': []}
 
-        # 对划分出来的每一份数据递归创建vp tree
-        for child in data_splited:
-            self._childes.append(VPTree(child, self._distance_fun, data_type=self._data_type, tree_ways=self._tree_ways,
-                                        leaf_capacity=self._leaf_capacity, selecting_vp_mode=self._selecting_vp_mode))
+    @staticmethod
+    def _append_node(nodes, start, end, lower=0.0, upper=float('inf')):
+        """
+        在节点列表末尾追加一个占据[start, end)区间的叶子节点
+        :param nodes: 节点列表
+        :param start: 节点的起始位置
+        :param end: 节点的结束位置
+        :param lower: 节点中的点到父节点支撑点的最小距离
+        :param upper: 节点中的点到父节点支撑点的最大距离
+        :return:
+        """
+        nodes['start'].append(start)
+        nodes['end'].append(end)
+        nodes['first_child'].append(-1)
+        nodes['child_count'].append(0)
+        nodes['lower'].append(lower)
+        nodes['upper'].append(upper)
 
     def split_data_into_multi_ways(self, data, distances):
         """
@@ -138,230 +546,1147 @@ class VPTree:
         :param distances: data中的每个点到支撑点的距离
         :return:
         """
-        # 先根据距离，对数据点进行排序
-        sorted_ind = np.argsort(distances)
-        sorted_distance = distances[sorted_ind]
-        sorted_data = data[sorted_ind]
+        order, cutoff_indexes, child_bounds = self._partition_by_distances(distances)
+        if len(child_bounds) == 1:
+            return np.split(data[order], cutoff_indexes), [child_bounds[0][1]]
+        # 相邻两个划分之间的中值
+        cutoff_values = [(child_bounds[i][1] + child_bounds[i + 1][0])/2 for i in range(len(child_bounds) - 1)]
+        return np.split(data[order], cutoff_indexes), cutoff_values
 
-        # 根据_tree_ways将数据划分成多份
-        partition_size = round(len(data)/self._tree_ways)
-        cutoff_indexes = [i*partition_size for i in range(1, self._tree_ways)]
+    def _partition_by_distances(self, distances):
+        """
+        根据距离确定self._tree_way份划分的边界
+        使用选择算法(argpartition)只把各个边界上的距离放到正确位置，而不对所有距离排序
+        :param distances: 每个点到支撑点的距离
+        :return: 划分后的点的顺序，划分边界在该顺序中的位置，每个划分中的点到支撑点的(最小距离, 最大距离)
+        """
+        count = len(distances)
+        # 根据_tree_ways将数据划分成多份，去除等于0或不小于count的边界，避免无效的数组切割
+        partition_size = round(count/self._tree_ways)
+        initial_indexes = sorted(set(i*partition_size for i in range(1, self._tree_ways)
+                                     if 0 < i*partition_size < count))
+        if len(initial_indexes) == 0:
+            # 如果没有有效的边界，则将所有数据作为第一个孩子
+            return np.arange(count), [], [(distances.min(), distances.max())]
 
-        # cutoff_values为不同划分之间的距离划分值
-        cutoff_values = []
+        # 让每个边界两侧的点处于排序后的位置，各个划分之间有序，划分内部无序
+        kth = sorted(set(initial_indexes) | set(ind - 1 for ind in initial_indexes))
+        order = np.argpartition(distances, kth)
+        partitioned = distances[order]
 
         # 检查相邻划分中，前一个划分的后面的数据点 是否与后一个划分的前面的数据点到优势点的距离相同
-        # 如果相同，将后一个划分的数据点并入前一个划分中
-        for i in range(len(cutoff_indexes)):
-            while cutoff_indexes[i] < len(data) and \
-                    abs(sorted_distance[cutoff_indexes[i]-1]-sorted_distance[cutoff_indexes[i]]) < 1e-6:
-                cutoff_indexes[i] += 1
-        cutoff_indexes = np.unique(cutoff_indexes)
-        # 去除cutoff_indexes中等于0或大于len(sorted_distance)的值，避免无效的数组切割
-        temp = []
-        for ind in cutoff_indexes:
-            if 0 < ind < len(sorted_distance):
-                temp.append(ind)
-        cutoff_indexes = temp
-        # 根据cutoff_indexes指定的分组的边界，计算cutoff_val，作为两个分组之间的中值
-        if len(cutoff_indexes) > 0:
-            for i in range(len(cutoff_indexes)):
-                cutoff_val = (sorted_distance[cutoff_indexes[i]-1] +
-                              sorted_distance[min(cutoff_indexes[i], len(sorted_distance)-1)])/2
-                cutoff_values.append(cutoff_val)
+        # 如果相同，将后一个划分中的这些数据点并入前一个划分中
+        cutoff_indexes = []
+        for ind in initial_indexes:
+            prev_ind = cutoff_indexes[-1] if len(cutoff_indexes) > 0 else 0
+            if ind <= prev_ind:
+                continue
+            left_max = partitioned[prev_ind:ind].max()
+            while ind < count:
+                tail = partitioned[ind:]
+                tie = tail - left_max < 1e-6
+                tie_count = int(np.count_nonzero(tie))
+                if tie_count == 0:
+                    break
+                # 稳定地把相同距离的点移到尾部的前面，不会打乱后面各个划分之间的顺序
+                order[ind:] = np.concatenate((order[ind:][tie], order[ind:][~tie]))
+                partitioned[ind:] = np.concatenate((tail[tie], tail[~tie]))
+                left_max = partitioned[ind:ind + tie_count].max()
+                ind += tie_count
+            if ind < count:
+                cutoff_indexes.append(ind)
+
+        # 根据cutoff_indexes指定的分组的边界，记录每个分组中的点到支撑点的最小距离与最大距离
+        bounds = [0] + cutoff_indexes + [count]
+        child_bounds = []
+        for i in range(len(bounds) - 1):
+            child_distances = partitioned[bounds[i]:bounds[i+1]]
+            child_bounds.append((child_distances.min(), child_distances.max()))
+        return order, cutoff_indexes, child_bounds
+
+    def insert(self, point):
+        """
+        向已经建好的VP树中插入一个点
+        从根节点开始根据点到支撑点的距离选择孩子，必要时扩大孩子的距离上下界，点加入到最终到达的叶子中，
+        叶子超过leaf_capacity或者子树不平衡时局部重建子树
+        :param point: 插入的数据点
+        :return: 插入的点的编号
+        """
+        if self._data_type == 'string':
+            if not isinstance(point, str):
+                raise ValueError('point should be a string')
+        else:
+            point = np.asarray(point)
+            if point.shape != self._data.shape[1:]:
+                raise ValueError('point should have the same shape as the data points')
+        self._prepare_updates()
+
+        # 从根节点向下找到插入的叶子，同时记录点到路径上的支撑点的距离
+        pivot_row = np.zeros(self._pivot_levels, dtype=np.float64)
+        node = 0
+        depth = 0
+        while self._node_child_count[node] > 0:
+            dis = self._metric.distance(point, self._data[self._node_start[node]])
+            if self._pivot_levels > 0:
+                pivot_row[depth % self._pivot_levels] = dis
+            # 选择距离区间包含dis的孩子，没有时选择距离区间离dis最近的孩子，并扩大它的距离区间
+            first_child = self._node_first_child[node]
+            childes = np.arange(first_child, first_child + self._node_child_count[node])
+            gaps = np.maximum(self._node_lower[childes] - dis, dis - self._node_upper[childes])
+            node = int(childes[np.argmin(gaps)])
+            self._node_lower[node] = min(self._node_lower[node], dis)
+            self._node_upper[node] = max(self._node_upper[node], dis)
+            depth += 1
+
+        # 叶子后面没有空闲的位置时，把叶子移动到数据数组的末尾
+        start = self._node_start[node]
+        end = self._node_end[node]
+        if end != len(self._data):
+            new_start = self._reserve(POSITION_ARRAY_NAMES, end - start + 1)
+            self._move_positions(start, end, new_start)
+            self._garbage_count += end - start
+            start, end = new_start, new_start + end - start
         else:
-            # 如果cutoff_indexes为空，则说明要将所有数据作为第一个孩子
-            cutoff_values.append(sorted_distance[-1])
-        # 对数组进行划分
-        childes = np.split(sorted_data, cutoff_indexes)
-        if len(childes[-1]) == 0:
-            childes = np.delete(childes, len(childes)-1, axis=0)
-        return childes, cutoff_values
+            self._reserve(POSITION_ARRAY_NAMES, 1)
+        point_id = self._next_id
+        self._next_id += 1
+        self._reserve(('id_positions',), 1)
+        self._data[end] = point
+        self._ids[end] = point_id
+        self._pivot_table[end] = pivot_row
+        self._filter_table[end] = self._make_filter_table([point])[0]
+        self._deleted[end] = False
+        self._position_node[end] = node
+        self._id_positions[point_id] = end
+        self._node_start[node] = start
+        self._node_end[node] = end + 1
+
+        for ancestor in self._node_path(node):
+            self._node_size[ancestor] += 1
+            self._node_updates[ancestor] += 1
+        self._rebalance(node)
+        return point_id
+
+    def delete(self, point_or_id):
+        """
+        从VP树中删除一个点
+        叶子中的点直接从叶子中移除，支撑点仍然用于划分孩子，只标记为已删除（墓碑），不再出现在搜索结果中，
+        被删除的支撑点过多或者子树不平衡时局部重建子树
+        :param point_or_id: 数据点，或者点的编号（原始数据中的行号，或者insert返回的编号）
+        :return: 是否删除了数据点
+        """
+        self._prepare_updates()
+        if isinstance(point_or_id, (int, np.integer)):
+            if not 0 <= point_or_id < len(self._id_positions):
+                return False
+            position = self._id_positions[point_or_id]
+        else:
+            position = self._find_position(point_or_id)
+        if position < 0:
+            return False
+
+        node = self._position_node[position]
+        self._id_positions[self._ids[position]] = -1
+        if self._node_child_count[node] > 0:
+            self._deleted[position] = True
+            for ancestor in self._node_path(node):
+                self._node_tombstones[ancestor] += 1
+        else:
+            # 用叶子中的最后一个点覆盖被删除的点
+            last = self._node_end[node] - 1
+            if position != last:
+                self._move_positions(last, last + 1, position)
+            self._node_end[node] = last
+            self._garbage_count += 1
+        for ancestor in self._node_path(node):
+            self._node_size[ancestor] -= 1
+            self._node_updates[ancestor] += 1
+        self._rebalance(node)
+        return True
+
+    def _prepare_updates(self):
+        """
+        第一次插入或删除之前，把树的数组复制到可扩容的缓冲区中（内存映射与共享内存上的只读数组也因此不会被修改），
+        并创建父节点、子树大小、每个位置所属的节点等插入删除需要的状态
+        此时树还没有被修改过，每棵子树占据一段连续的区间
+        :return:
+        """
+        if self._node_size is not None:
+            return
+        data = self._data
+        # 字符串数据使用object数组，插入更长的字符串时不会被截断
+        if self._data_type == 'string':
+            data = data.astype(object)
+        node_count = len(self._node_start)
+        if self._next_id is None:
+            self._next_id = int(self._ids.max()) + 1 if len(self._ids) > 0 else 0
+
+        internal = np.flatnonzero(self._node_child_count > 0)
+        leaves = np.flatnonzero(self._node_child_count == 0)
+        leaf_sizes = self._node_end[leaves] - self._node_start[leaves]
+        position_node = np.empty(len(data), dtype=np.int64)
+        position_node[self._node_start[internal]] = internal
+        position_node[VPTree._expand_ranges(self._node_start[leaves], leaf_sizes)] = np.repeat(leaves, leaf_sizes)
+        node_parent = np.full(node_count, -1, dtype=np.int64)
+        child_counts = self._node_child_count[internal]
+        node_parent[VPTree._expand_ranges(self._node_first_child[internal], child_counts)] = \
+            np.repeat(internal, child_counts)
+        id_positions = np.full(self._next_id, -1, dtype=np.int64)
+        id_positions[self._ids] = np.arange(len(self._ids))
+
+        arrays = {'data': data, 'ids': self._ids, 'pivot_table': self._pivot_table,
+                  'filter_table': self._filter_table, 'deleted': np.zeros(len(data), dtype=bool), 'position_node': position_node,
+                  'node_start': self._node_start, 'node_end': self._node_end,
+                  'node_first_child': self._node_first_child, 'node_child_count': self._node_child_count,
+                  'node_lower': self._node_lower, 'node_upper': self._node_upper, 'node_parent': node_parent,
+                  'node_size': self._node_end - self._node_start,
+                  'node_tombstones': np.zeros(node_count, dtype=np.int64),
+                  'node_updates': np.zeros(node_count, dtype=np.int64), 'id_positions': id_positions}
+        self._buffers = dict()
+        for name, array in arrays.items():
+            buffer = np.array(array)
+            self._buffers[name] = buffer
+            setattr(self, '_' + name, buffer[:len(buffer)])
+
+    def _reserve(self, names, count):
+        """
+        在names对应的数组末尾追加count个位置，缓冲区容量不足时按两倍扩容
+        :param names: 数组名称，这些数组的长度相同
+        :param count: 追加的位置个数
+        :return: 追加的第一个位置的下标
+        """
+        size = len(getattr(self, '_' + names[0]))
+        for name in names:
+            buffer = self._buffers[name]
+            if len(buffer) < size + count:
+                new_buffer = np.empty((max(2 * len(buffer), size + count),) + buffer.shape[1:], dtype=buffer.dtype)
+                new_buffer[:size] = buffer[:size]
+                buffer = new_buffer
+                self._buffers[name] = buffer
+            setattr(self, '_' + name, buffer[:size + count])
+        return size
+
+    def _move_positions(self, start, end, new_start):
+        """
+        把[start, end)位置上的点移动到new_start开始的位置，并更新这些点的编号到位置的映射
+        :param start: 起始位置
+        :param end: 结束位置（不包含）
+        :param new_start: 新的起始位置
+        :return:
+        """
+        new_end = new_start + end - start
+        for name in POSITION_ARRAY_NAMES:
+            array = getattr(self, '_' + name)
+            array[new_start:new_end] = array[start:end]
+        self._id_positions[self._ids[new_start:new_end]] = np.arange(new_start, new_end)
 
-    def sequential_search(self, data, query_point, query_range):
+    def _node_path(self, node):
+        """
+        返回从node到根节点路径上的所有节点
+        :param node: 节点编号
+        :return:
+        """
+        path = [node]
+        while self._node_parent[path[-1]] >= 0:
+            path.append(self._node_parent[path[-1]])
+        return path
+
+    def _needs_rebuild(self, node):
+        """
+        判断插入或删除之后，子树是否需要局部重建
+        叶子超过容量时需要分裂；被删除的支撑点过多时需要去掉墓碑；
+        上一次创建之后更新的次数达到子树大小的一半，且孩子之间大小悬殊时需要重新平衡
+        :param node: 节点编号
+        :return:
+        """
+        size = self._node_size[node]
+        if self._node_child_count[node] == 0:
+            return size > self._leaf_capacity
+        if self._node_tombstones[node] > REBUILD_TOMBSTONE_RATIO * (size + self._node_tombstones[node]):
+            return True
+        if 2 * self._node_updates[node] < size:
+            return False
+        first_child = self._node_first_child[node]
+        child_sizes = self._node_size[first_child:first_child + self._node_child_count[node]]
+        return child_sizes.max() > REBUILD_BALANCE_FACTOR * max(child_sizes.min(), 1)
+
+    def _rebalance(self, node):
+        """
+        插入或删除node中的点之后，局部重建路径上最高的需要重建的子树，
+        不再使用的位置或节点过多时重建整棵树
+        :param node: 发生插入或删除的节点
+        :return:
+        """
+        path = self._node_path(node)
+        for depth in range(len(path)):
+            ancestor = path[len(path) - 1 - depth]
+            if self._needs_rebuild(ancestor):
+                self._rebuild_subtree(ancestor, depth)
+                break
+        if self._node_size is not None and (2 * self._garbage_count > len(self._data) or
+                                            2 * self._garbage_node_count > len(self._node_start)):
+            self._rebuild_subtree(0, 0)
+
+    def _subtree_positions(self, node):
+        """
+        返回子树中所有点的位置，以及子树中除node以外的所有节点
+        :param node: 子树根节点
+        :return: 未被删除的点的位置，被删除的支撑点的位置，子树中的其余节点
+        """
+        alive = []
+        deleted = []
+        descendants = []
+        nodes_to_list = [node]
+        while len(nodes_to_list) > 0:
+            current = nodes_to_list.pop()
+            start = self._node_start[current]
+            if self._node_child_count[current] == 0:
+                alive.append(np.arange(start, self._node_end[current]))
+                continue
+            (deleted if self._deleted[start] else alive).append([start])
+            first_child = self._node_first_child[current]
+            childes = range(first_child, first_child + self._node_child_count[current])
+            descendants.extend(childes)
+            nodes_to_list.extend(childes)
+        return np.concatenate(alive).astype(np.int64), len(deleted), descendants
+
+    def _rebuild_subtree(self, node, depth):
+        """
+        使用子树中未被删除的点重新创建以node为根的子树，新的点与节点追加到数组的末尾
+        node为根节点时重新创建整棵树
+        :param node: 子树根节点
+        :param depth: 子树根节点的深度
+        :return:
+        """
+        positions, deleted_count, descendants = self._subtree_positions(node)
+        data = self._data[positions]
+        ids = self._ids[positions]
+        filter_table = self._filter_table[positions]
+        if node == 0:
+            next_id = self._next_id
+            if len(positions) > 0:
+                self.build_tree(data)
+                self._ids = ids[self._ids]
+            else:
+                # 所有点都被删除时，只保留一个空的叶子
+                self._data = data
+                self._ids = ids
+                self._pivot_table = np.zeros((0, self._pivot_levels), dtype=np.float64)
+                self._filter_table = filter_table
+                for name, value in (('start', 0), ('end', 0), ('first_child', -1), ('child_count', 0),
+                                    ('lower', 0.0), ('upper', float('inf'))):
+                    setattr(self, '_node_' + name, np.array([value], dtype=type(value)))
+                self._reset_update_state()
+            self._next_id = next_id
+            return
+
+        # 子树中的点在重建后的深度会变化，原来的支撑点距离表不再对应祖先，
+        # 重新计算到子树以上最近pivot_levels层祖先支撑点的距离，更深的层在建树时写入
+        pivot_table = np.zeros((len(positions), self._pivot_levels), dtype=np.float64)
+        perm = np.arange(len(positions), dtype=np.int64)
+        for ancestor_depth, ancestor in enumerate(reversed(self._node_path(node)[1:])):
+            if ancestor_depth >= depth - self._pivot_levels:
+                pivot_table[:, ancestor_depth % self._pivot_levels] = \
+                    self._distances_to_point(data, perm, self._data[self._node_start[ancestor]])
+        nodes = VPTree._empty_node_lists()
+        VPTree._append_node(nodes, 0, len(positions))
+        self._build_nodes(data, perm, pivot_table, nodes, 0, depth)
+
+        # 新的点追加到数据数组的末尾
+        start = self._reserve(POSITION_ARRAY_NAMES, len(positions))
+        end = start + len(positions)
+        self._data[start:end] = data[perm]
+        self._ids[start:end] = ids[perm]
+        self._pivot_table[start:end] = pivot_table
+        self._filter_table[start:end] = filter_table[perm]
+        self._deleted[start:end] = False
+        self._id_positions[self._ids[start:end]] = np.arange(start, end)
+        self._garbage_count += len(positions) + deleted_count
+
+        # 原来的孩子节点不再使用，置为空的叶子，新的节点追加到节点数组的末尾，子树根节点仍然使用node
+        for descendant in descendants:
+            self._node_start[descendant] = self._node_end[descendant] = 0
+            self._node_child_count[descendant] = 0
+            self._node_first_child[descendant] = -1
+        self._garbage_node_count += len(descendants)
+        new_nodes = [node] + list(range(len(self._node_start), len(self._node_start) + len(nodes['start']) - 1))
+        self._reserve(NODE_ARRAY_NAMES, len(nodes['start']) - 1)
+        for i, new_node in enumerate(new_nodes):
+            sub_first_child = nodes['first_child'][i]
+            self._node_start[new_node] = nodes['start'][i] + start
+            self._node_end[new_node] = nodes['end'][i] + start
+            self._node_child_count[new_node] = nodes['child_count'][i]
+            self._node_first_child[new_node] = new_nodes[sub_first_child] if sub_first_child >= 0 else -1
+            self._node_size[new_node] = nodes['end'][i] - nodes['start'][i]
+            self._node_tombstones[new_node] = 0
+            self._node_updates[new_node] = 0
+            if sub_first_child >= 0:
+                first_child = new_nodes[sub_first_child]
+                self._node_parent[first_child:first_child + nodes['child_count'][i]] = new_node
+                self._position_node[nodes['start'][i] + start] = new_node
+            else:
+                self._position_node[nodes['start'][i] + start:nodes['end'][i] + start] = new_node
+            if i > 0:
+                self._node_lower[new_node] = nodes['lower'][i]
+                self._node_upper[new_node] = nodes['upper'][i]
+        for ancestor in self._node_path(node)[1:]:
+            self._node_tombstones[ancestor] -= deleted_count
+
+    def _find_position(self, point):
+        """
+        在树中查找与point距离为0且未被删除的点的位置
+        :param point: 数据点
+        :return: 点的位置，找不到时为-1
+        """
+        nodes_to_list = [0]
+        while len(nodes_to_list) > 0:
+            node = nodes_to_list.pop()
+            start = self._node_start[node]
+            if self._node_child_count[node] == 0:
+                leaf_data = self._data[start:self._node_end[node]]
+                if self._block_distance_fun is not None:
+                    distances = self._block_distance_fun(leaf_data, point)
+                else:
+                    distances = np.array([self._metric.distance(point, x) for x in leaf_data])
+                matches = np.flatnonzero(distances == 0)
+                if len(matches) > 0:
+                    return start + int(matches[0])
+                continue
+            dis = self._metric.distance(point, self._data[start])
+            if dis == 0 and not self._deleted[start]:
+                return start
+            first_child = self._node_first_child[node]
+            for child in range(first_child, first_child + self._node_child_count[node]):
+                if self._node_lower[child] <= dis <= self._node_upper[child]:
+                    nodes_to_list.append(child)
+        return -1
+
+    def _is_deleted(self, position):
+        """
+        判断self._data中position位置上的支撑点是否已被删除
+        :param position: 支撑点的位置
+        :return:
+        """
+        return self._deleted is not None and self._deleted[position]
+
+    @staticmethod
+    def _expand_ranges(starts, counts):
+        """
+        返回多个区间[starts[i], starts[i] + counts[i])中的所有下标拼接而成的数组
+        :param starts: 区间的起始下标
+        :param counts: 区间的长度
+        :return:
+        """
+        offsets = np.cumsum(counts) - counts
+        return np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+
+    def sequential_search(self, data, query_point, query_range, use_filters=True):
         """
         对data中的数据进行顺序搜索
+        字符串数据先用长度差与字符直方图两个距离下界过滤，再用有界距离函数判断，
+        被过滤的点不计入cal_distance_times，而是计入filtered_times
+        树中的数据在建树时预先计算了字符直方图，这里的data需要在搜索前计算一次
         :param data: list数据，多个数据点
         :param query_point: 查询数据
         :param query_range: 与查询数据之间的最大距离
+        :param use_filters: 是否使用距离下界过滤与有界距离函数
         :return:
         """
+        filter_table = self._make_filter_table(data) if use_filters else None
+        indexes, distances, cal_distance_times, filtered_times = self._sequential_scan(data, query_point, query_range,
+                                                                                       use_filters, filter_table)
         result = dict()
-        result['neighbors'] = []
-        cal_distance_times = 0
-        if data is None or len(data) == 0:
-            return result
-        # 按顺序比较data中的每一个点到query_point的距离
-        for point in data:
-            dis = self._distance_fun(point, query_point)
-            cal_distance_times += 1
-            if dis <= query_range:
-                result['neighbors'].append({'object': point, 'distance': dis})
-
+        result['neighbors'] = [{'object': data[i], 'distance': dis} for i, dis in zip(indexes, distances)]
         result['cal_distance_times'] = cal_distance_times
+        result['filtered_times'] = filtered_times
         return result
 
-    def range_search(self, query_point, query_range):
+    def range_search(self, query_point, query_range, stats=None, return_ids=False, max_distance_times=None,
+                     epsilon=0):
         """
         在VP树种进行范围搜索
         :param query_point: 查询数据
         :param query_range: 与查询数据之间的最大距离
-        :return:
+        :param stats: SearchStats对象，不为None时记录搜索过程的统计信息
+        :param return_ids: 为True时返回近邻原始行号与距离的NumPy数组(ids, distances)，而不是neighbors列表
+        :param max_distance_times: 最多计算距离的次数，为None时不限制，设置后进行近似搜索
+        :param epsilon: 不为0时进行近似搜索，剪枝时使用缩小后的半径 query_range / (1 + epsilon)
+        :return: exact表示结果是否与精确搜索相同
         """
-        result = dict()
-        result['neighbors'] = []
-        result['cal_distance_times'] = 0
-        nodes_to_list = [self]
+        VPTree._check_approximate_params(max_distance_times, epsilon)
+        if max_distance_times is not None or epsilon > 0:
+            return self._range_search_approximate(query_point, query_range, max_distance_times, epsilon, return_ids,
+                                                  stats)
+        if stats is not None:
+            started = time.perf_counter()
+        positions = []
+        distances = []
+        cal_distance_times = 0
+        filtered_times = 0
+        # nodes_to_list 待搜索节点队列，元素为(节点编号, 深度, 查询点到祖先支撑点的距离)
+        nodes_to_list = deque([(0, 0, self._empty_pivot_path())])
 
         while len(nodes_to_list) > 0:
-            node = nodes_to_list.pop(0)
-
-            if node is None:
-                continue
+            node, depth, path = nodes_to_list.popleft()
+            start = self._node_start[node]
+            if stats is not None:
+                stats.visit_node(node, depth, self._node_child_count[node] == 0)
 
             # 如果是叶子节点，则进行顺序搜索
-            if node.is_leaf():
-                seq_result = self.sequential_search(node.get_leaf_data(), query_point, query_range)
-                result['neighbors'].extend(seq_result['neighbors'])
-                result['cal_distance_times'] += seq_result['cal_distance_times']
+            if self._node_child_count[node] == 0:
+                if stats is not None:
+                    leaf_started = time.perf_counter()
+                leaf_positions, leaf_distances, leaf_cal_times, leaf_filtered_times = \
+                    self._search_leaf(node, query_point, query_range, path)
+                if stats is not None:
+                    stats.scan_leaf(node, depth, leaf_cal_times, leaf_filtered_times,
+                                    time.perf_counter() - leaf_started)
+                if len(leaf_positions) > 0:
+                    positions.append(leaf_positions)
+                    distances.append(leaf_distances)
+                cal_distance_times += leaf_cal_times
+                filtered_times += leaf_filtered_times
                 continue
 
             # 如果不是叶子节点
-            node_vp = node.get_vantage_point()
-            node_cutoff_values = node.get_cutoff_values()
-            node_childes = node.get_childes()
+            node_vp = self._data[start]
+            first_child = self._node_first_child[node]
+            child_count = self._node_child_count[node]
             # 首先检查支撑点是否在查询范围内
-            dis = self._distance_fun(query_point, node_vp)
-            result['cal_distance_times'] += 1
-            if dis <= query_range:
-                result['neighbors'].append({'object': node_vp, 'distance': dis})
+            if stats is None:
+                dis = self._metric.distance(query_point, node_vp)
+            else:
+                dis = stats.distance(self._metric.distance, query_point, node_vp)
+            cal_distance_times += 1
+            if dis <= query_range and not self._is_deleted(start):
+                positions.append(np.array([start], dtype=np.int64))
+                distances.append(np.array([dis], dtype=np.float64))
+            child_path = self._extend_pivot_path(path, depth, dis)
             # 对该节点的所有孩子进行判断
-            # 根据三角不等式，判断是否要进入某一个分支中进行搜索
-            for i in range(len(node_childes)):
-                # 对于第一个与最后一个孩子只需要判断一个cutoff value
-                if i == 0:
-                    cutoff_val = node_cutoff_values[0]
-                    if dis - query_range <= cutoff_val:
-                        nodes_to_list.append(node_childes[i])
-                elif i == len(node_childes)-1:
-                    cutoff_val = node_cutoff_values[-1]
-                    if dis + query_range > cutoff_val:
-                        nodes_to_list.append(node_childes[i])
+            # 孩子中的点到支撑点的距离位于[lower, upper]之间，根据三角不等式，
+            # 只有当查询范围与该距离区间相交时才进入该分支中进行搜索
+            for child in range(first_child, first_child + child_count):
+                if self._node_lower[child] - query_range <= dis <= self._node_upper[child] + query_range:
+                    nodes_to_list.append((child, depth + 1, child_path))
+                elif stats is not None:
+                    stats.prune_node(child, depth + 1)
+        if stats is not None:
+            stats.finish_query(time.perf_counter() - started)
+        return self._make_result(positions, distances, cal_distance_times, filtered_times, return_ids)
+
+    def _range_search_approximate(self, query_point, query_range, max_distance_times, epsilon, return_ids, stats=None):
+        """
+        近似范围搜索，按查询点到节点中数据的距离下界从小到大访问节点
+        剪枝时使用缩小后的半径 query_range / (1 + epsilon)，距离计算次数达到max_distance_times时停止，
+        结果中的点都在查询范围内，但可能遗漏一部分点，exact表示结果是否与精确搜索相同
+        :param query_point: 查询数据
+        :param query_range: 与查询数据之间的最大距离
+        :param max_distance_times: 最多计算距离的次数，为None时不限制
+        :param epsilon: 剪枝半径的缩小比例
+        :param return_ids: 与range_search相同
+        :param stats: 与range_search相同，因为距离计算次数用完而没有访问的节点不计为剪枝
+        :return:
+        """
+        if stats is not None:
+            started = time.perf_counter()
+        prune_range = query_range / (1 + epsilon)
+        positions = []
+        distances = []
+        cal_distance_times = 0
+        filtered_times = 0
+        exact = True
+        counter = itertools.count()
+        # nodes_to_list 为小顶堆，元素为(查询点到该节点中数据的距离下界, 序号, 节点编号, 深度, 查询点到祖先支撑点的距离)
+        nodes_to_list = [(0.0, next(counter), 0, 0, self._empty_pivot_path())]
+
+        while len(nodes_to_list) > 0:
+            _, _, node, depth, path = heapq.heappop(nodes_to_list)
+            start = self._node_start[node]
+            remaining = float('inf') if max_distance_times is None else max_distance_times - cal_distance_times
+            if remaining < 1:
+                exact = False
+                break
+            if stats is not None:
+                stats.visit_node(node, depth, self._node_child_count[node] == 0)
+
+            # 如果是叶子节点，剩余的距离计算次数不够时只搜索叶子中的一部分点，然后停止
+            if self._node_child_count[node] == 0:
+                if stats is not None:
+                    leaf_started = time.perf_counter()
+                    leaf_filtered_times = filtered_times
+                candidates = np.arange(start, self._node_end[node])
+                if path is not None:
+                    candidates = candidates[self._pivot_lower_bounds(node, path) <= query_range]
+                    filtered_times += self._node_end[node] - start - len(candidates)
+                truncated = len(candidates) > remaining
+                if truncated:
+                    candidates = candidates[:remaining]
+                indexes, leaf_distances, leaf_cal_times, scan_filtered_times = \
+                    self._sequential_scan(self._data[candidates], query_point, query_range,
+                                          filter_table=self._filter_table[candidates])
+                positions.append(candidates[indexes])
+                distances.append(leaf_distances)
+                cal_distance_times += leaf_cal_times
+                filtered_times += scan_filtered_times
+                if stats is not None:
+                    stats.scan_leaf(node, depth, leaf_cal_times, filtered_times - leaf_filtered_times,
+                                    time.perf_counter() - leaf_started)
+                if truncated:
+                    exact = False
+                    break
+                continue
+
+            if stats is None:
+                dis = self._metric.distance(query_point, self._data[start])
+            else:
+                dis = stats.distance(self._metric.distance, query_point, self._data[start])
+            cal_distance_times += 1
+            if dis <= query_range and not self._is_deleted(start):
+                positions.append(np.array([start], dtype=np.int64))
+                distances.append(np.array([dis], dtype=np.float64))
+            child_path = self._extend_pivot_path(path, depth, dis)
+            first_child = self._node_first_child[node]
+            for child in range(first_child, first_child + self._node_child_count[node]):
+                child_bound = max(self._node_lower[child] - dis, dis - self._node_upper[child], 0)
+                if child_bound <= prune_range:
+                    heapq.heappush(nodes_to_list, (child_bound, next(counter), child, depth + 1, child_path))
+                    continue
+                if child_bound <= query_range:
+                    # 精确搜索会访问该孩子
+                    exact = False
+                if stats is not None:
+                    stats.prune_node(child, depth + 1)
+        if stats is not None:
+            stats.finish_query(time.perf_counter() - started)
+        return self._make_result(positions, distances, cal_distance_times, filtered_times, return_ids, exact)
+
+    def range_count(self, query_point, query_range, stats=None):
+        """
+        统计与查询点的距离不超过query_range的点数，不创建近邻结果
+        孩子中的点到支撑点的距离不超过upper，根据三角不等式 d(q, x) <= d(q, vp) + upper，
+        当 d(q, vp) + upper <= query_range 时整个孩子都在查询范围内，直接累加孩子中的点数而不访问其中的点
+        :param query_point: 查询数据
+        :param query_range: 与查询数据之间的最大距离
+        :param stats: SearchStats对象，不为None时记录搜索过程的统计信息，整个在查询范围内的孩子既不计为访问也不计为剪枝
+        :return: count为点数
+        """
+        return self._count_in_range(query_point, query_range, False, stats)
+
+    def range_any(self, query_point, query_range, stats=None):
+        """
+        判断是否存在与查询点的距离不超过query_range的点，找到第一个这样的点后立即返回
+        :param query_point: 查询数据
+        :param query_range: 与查询数据之间的最大距离
+        :param stats: 与range_count相同
+        :return: exists为是否存在
+        """
+        result = self._count_in_range(query_point, query_range, True, stats)
+        return {'exists': result['count'] > 0, 'cal_distance_times': result['cal_distance_times'],
+                'filtered_times': result['filtered_times']}
+
+    def _count_in_range(self, query_point, query_range, stop_at_first, stats=None):
+        """
+        range_count与range_any共用的深度优先遍历
+        :param query_point: 查询数据
+        :param query_range: 与查询数据之间的最大距离
+        :param stop_at_first: 是否在找到第一个点后立即结束
+        :param stats: 与range_count相同
+        :return:
+        """
+        if stats is not None:
+            started = time.perf_counter()
+        result = {'count': 0, 'cal_distance_times': 0, 'filtered_times': 0}
+        # nodes_to_list 待搜索节点栈，元素为(节点编号, 深度, 查询点到祖先支撑点的距离)
+        nodes_to_list = [(0, 0, self._empty_pivot_path())]
+
+        while len(nodes_to_list) > 0:
+            node, depth, path = nodes_to_list.pop()
+            start = self._node_start[node]
+            if stats is not None:
+                stats.visit_node(node, depth, self._node_child_count[node] == 0)
+
+            # 如果是叶子节点，则进行顺序搜索
+            if self._node_child_count[node] == 0:
+                if stats is not None:
+                    leaf_started = time.perf_counter()
+                leaf_positions, _, cal_distance_times, filtered_times = \
+                    self._search_leaf(node, query_point, query_range, path, stop_at_first)
+                if stats is not None:
+                    stats.scan_leaf(node, depth, cal_distance_times, filtered_times,
+                                    time.perf_counter() - leaf_started)
+                result['count'] += len(leaf_positions)
+                result['cal_distance_times'] += cal_distance_times
+                result['filtered_times'] += filtered_times
+            else:
+                if stats is None:
+                    dis = self._metric.distance(query_point, self._data[start])
                 else:
-                    cutoff_val_front = node_cutoff_values[i-1]
-                    cutoff_val_back = node_cutoff_values[i]
-                    if dis - query_range < cutoff_val_front and dis + query_range > cutoff_val_back:
-                        nodes_to_list.append(node_childes[i])
+                    dis = stats.distance(self._metric.distance, query_point, self._data[start])
+                result['cal_distance_times'] += 1
+                if dis <= query_range and not self._is_deleted(start):
+                    result['count'] += 1
+                child_path = self._extend_pivot_path(path, depth, dis)
+                first_child = self._node_first_child[node]
+                for child in range(first_child, first_child + self._node_child_count[node]):
+                    if dis + self._node_upper[child] <= query_range:
+                        # 孩子完全在查询范围内
+                        result['count'] += self._subtree_count(child)
+                    elif self._node_lower[child] - query_range <= dis <= self._node_upper[child] + query_range:
+                        nodes_to_list.append((child, depth + 1, child_path))
+                    elif stats is not None:
+                        stats.prune_node(child, depth + 1)
+            if stop_at_first and result['count'] > 0:
+                break
+        if stats is not None:
+            stats.finish_query(time.perf_counter() - started)
         return result
 
-    def brute_force_search(self, query_point, query_range):
+    def _subtree_count(self, node):
         """
-        在树中使用暴力法进行范围搜索
+        返回以node为根的子树中未被删除的点的个数
+        :param node: 节点编号
+        :return:
+        """
+        if self._node_size is not None:
+            return int(self._node_size[node])
+        # 没有插入或删除过数据时，每棵子树占据一段连续的区间
+        return int(self._node_end[node] - self._node_start[node])
+
+    def _search_leaf(self, node, query_point, query_range, path, stop_at_first=False):
+        """
+        在叶子节点中进行顺序搜索
+        保存了支撑点距离表时，先根据三角不等式 |d(q, p) - d(x, p)| <= d(q, x) 过滤数据点，被过滤的点计入filtered_times
+        :param node: 叶子节点编号
         :param query_point: 查询数据
         :param query_range: 与查询数据之间的最大距离
+        :param path: 查询点到祖先支撑点的距离，不保存支撑点距离表时为None
+        :param stop_at_first: 是否在找到第一个近邻后立即返回
+        :return: 近邻在self._data中的位置，近邻的距离，距离计算次数，被过滤的点数
+        """
+        start = self._node_start[node]
+        data = self._data[start:self._node_end[node]]
+        filter_table = self._filter_table[start:self._node_end[node]]
+        if path is None:
+            indexes, distances, cal_distance_times, filtered_times = \
+                self._sequential_scan(data, query_point, query_range, filter_table=filter_table,
+                                      stop_at_first=stop_at_first)
+            return indexes + start, distances, cal_distance_times, filtered_times
+        candidates = np.flatnonzero(self._pivot_lower_bounds(node, path) <= query_range)
+        indexes, distances, cal_distance_times, filtered_times = \
+            self._sequential_scan(data[candidates], query_point, query_range, filter_table=filter_table[candidates],
+                                  stop_at_first=stop_at_first)
+        return candidates[indexes] + start, distances, cal_distance_times, \
+            filtered_times + len(data) - len(candidates)
+
+    def _pivot_lower_bounds(self, node, path):
+        """
+        根据支撑点距离表计算查询点到叶子中每个点的距离下界
+        :param node: 叶子节点编号
+        :param path: 查询点到祖先支撑点的距离
         :return:
         """
-        result = dict()
-        result['neighbors'] = []
-        result['cal_distance_times'] = 0
-        # nodes_to_list 待搜索节点队列
-        nodes_to_list = [self]
+        pivot_rows = self._pivot_table[self._node_start[node]:self._node_end[node]]
+        return np.max(np.abs(pivot_rows - path), axis=1)
+
+    def _empty_pivot_path(self):
+        """
+        返回根节点处查询点到祖先支撑点的距离，不保存支撑点距离表时为None
+        没有祖先的列与支撑点距离表中对应的列都为0，不影响距离下界
+        :return:
+        """
+        if self._pivot_levels == 0:
+            return None
+        return np.zeros(self._pivot_levels, dtype=np.float64)
+
+    def _extend_pivot_path(self, path, depth, dis):
+        """
+        在查询点到祖先支撑点的距离中加入深度为depth的支撑点的距离，作为孩子节点的path
+        :param path: 查询点到祖先支撑点的距离
+        :param depth: 支撑点所在节点的深度
+        :param dis: 查询点到该支撑点的距离
+        :return:
+        """
+        if path is None:
+            return None
+        child_path = path.copy()
+        child_path[..., depth % self._pivot_levels] = dis
+        return child_path
+
+    def range_search_batch(self, queries, radii, return_ids=False, stats=None):
+        """
+        对多个查询同时进行范围搜索
+        只遍历一次树，每个节点只处理仍然可能有结果的查询，查询到支撑点的距离一次性批量计算
+        :param queries: 多个查询数据，数值数据为二维数组，每一行为一个查询
+        :param radii: 每个查询的查询半径，也可以是所有查询共用的一个数
+        :param return_ids: 与range_search相同
+        :param stats: SearchStats对象，不为None时记录搜索过程的统计信息，
+                      多个查询共同访问的节点只计一次，没有查询继续搜索的孩子计为剪枝，到支撑点的距离按查询个数计数
+        :return: 与queries一一对应的搜索结果列表，每个结果的格式与range_search相同
+        """
+        if stats is not None:
+            started = time.perf_counter()
+        queries = np.asarray(queries)
+        if self._data_type == 'string':
+            queries = queries.reshape(-1)
+        radii = np.asarray(radii, dtype=np.float64)
+        if radii.ndim == 0:
+            radii = np.full(len(queries), float(radii))
+        elif len(radii) != len(queries):
+            raise ValueError('radii should be a number or have the same length as queries')
+        # 每个查询的近邻位置数组与距离数组的列表
+        positions = [[] for _ in range(len(queries))]
+        distances = [[] for _ in range(len(queries))]
+        cal_distance_times = np.zeros(len(queries), dtype=np.int64)
+        filtered_times = np.zeros(len(queries), dtype=np.int64)
+        # nodes_to_list 待搜索节点栈，元素为(节点编号, 需要在该节点中继续搜索的查询下标, 深度,
+        # 每个活跃查询到祖先支撑点的距离)
+        paths = None
+        if self._pivot_levels > 0:
+            paths = np.zeros((len(queries), self._pivot_levels), dtype=np.float64)
+        nodes_to_list = [(0, np.arange(len(queries)), 0, paths)]
+
         while len(nodes_to_list) > 0:
-            node = nodes_to_list.pop(0)
+            node, active, depth, paths = nodes_to_list.pop()
+            start = self._node_start[node]
+            if stats is not None:
+                stats.visit_node(node, depth, self._node_child_count[node] == 0)
 
-            if node is None:
+            # 如果是叶子节点，则对所有活跃的查询进行顺序搜索
+            if self._node_child_count[node] == 0:
+                if stats is not None:
+                    leaf_started = time.perf_counter()
+                    leaf_cal_times = cal_distance_times[active].sum()
+                    leaf_filtered_times = filtered_times[active].sum()
+                self._batch_search_leaf(node, queries, radii, active, paths, positions, distances,
+                                        cal_distance_times, filtered_times)
+                if stats is not None:
+                    stats.scan_leaf(node, depth, int(cal_distance_times[active].sum() - leaf_cal_times),
+                                    int(filtered_times[active].sum() - leaf_filtered_times),
+                                    time.perf_counter() - leaf_started)
                 continue
 
+            # 如果不是叶子节点，一次计算所有活跃查询到支撑点的距离
+            node_vp = self._data[start]
+            first_child = self._node_first_child[node]
+            child_count = self._node_child_count[node]
+            active_radii = radii[active]
+            block_distance_fun = self._block_distance_fun if self._block_distance_fun is not None \
+                else self._metric.distances
+            if stats is None:
+                vp_distances = block_distance_fun(queries[active], node_vp)
+            else:
+                vp_distances = stats.distances(block_distance_fun, queries[active], node_vp)
+            cal_distance_times[active] += 1
+            if not self._is_deleted(start):
+                for i in np.flatnonzero(vp_distances <= active_radii):
+                    positions[active[i]].append(np.array([start], dtype=np.int64))
+                    distances[active[i]].append(vp_distances[i:i + 1])
+            child_paths = self._extend_pivot_path(paths, depth, vp_distances)
+            # 与range_search相同的剪枝条件，对每个孩子筛选出需要继续搜索的查询
+            for child in range(first_child, first_child + child_count):
+                mask = (vp_distances + active_radii >= self._node_lower[child]) & \
+                       (vp_distances - active_radii <= self._node_upper[child])
+                if mask.any():
+                    nodes_to_list.append((child, active[mask], depth + 1,
+                                          None if child_paths is None else child_paths[mask]))
+                elif stats is not None:
+                    stats.prune_node(child, depth + 1)
+
+        if stats is not None:
+            stats.finish_query(time.perf_counter() - started, len(queries))
+        return [self._make_result(positions[i], distances[i], cal_distance_times[i], filtered_times[i], return_ids)
+                for i in range(len(queries))]
+
+    def _batch_search_leaf(self, node, queries, radii, active, paths, positions, distances, cal_distance_times,
+                           filtered_times):
+        """
+        对多个查询在叶子节点中进行顺序搜索，搜索到的近邻的位置与距离加入到对应查询的列表中
+        :param node: 叶子节点编号
+        :param queries: 所有查询数据
+        :param radii: 所有查询的查询半径
+        :param active: 需要在叶子中搜索的查询下标
+        :param paths: 每个活跃查询到祖先支撑点的距离，不保存支撑点距离表时为None
+        :param positions: 所有查询的近邻位置数组的列表
+        :param distances: 所有查询的近邻距离数组的列表
+        :param cal_distance_times: 所有查询的距离计算次数
+        :param filtered_times: 所有查询被过滤的点数
+        :return:
+        """
+        start = self._node_start[node]
+        data = self._data[start:self._node_end[node]]
+        # 查询比数据点多时，逐个数据点批量计算它到所有活跃查询的距离
+        if paths is None and self._block_distance_fun is not None and len(active) > len(data):
+            active_queries = queries[active]
+            leaf_distances = np.empty((len(active), len(data)), dtype=np.float64)
+            for j, point in enumerate(data):
+                leaf_distances[:, j] = self._block_distance_fun(active_queries, point)
+            query_indexes, point_indexes = np.nonzero(leaf_distances <= radii[active][:, None])
+            for i in np.unique(query_indexes):
+                hits = point_indexes[query_indexes == i]
+                positions[active[i]].append(hits + start)
+                distances[active[i]].append(leaf_distances[i, hits])
+            cal_distance_times[active] += len(data)
+            return
+        # 否则逐个查询在整个叶子中进行顺序搜索
+        for j, i in enumerate(active):
+            leaf_positions, leaf_distances, leaf_cal_times, leaf_filtered_times = \
+                self._search_leaf(node, queries[i], radii[i], None if paths is None else paths[j])
+            if len(leaf_positions) > 0:
+                positions[i].append(leaf_positions)
+                distances[i].append(leaf_distances)
+            cal_distance_times[i] += leaf_cal_times
+            filtered_times[i] += leaf_filtered_times
+
+    def brute_force_search(self, query_point, query_range, return_ids=False):
+        """
+        在树中使用暴力法进行范围搜索
+        :param query_point: 查询数据
+        :param query_range: 与查询数据之间的最大距离
+        :param return_ids: 与range_search相同
+        :return:
+        """
+        positions = []
+        distances = []
+        cal_distance_times = 0
+        # 依次访问所有节点
+        for node in range(len(self._node_start)):
+            start = self._node_start[node]
+
             # 如果是叶子节点，则进行顺序搜索
-            if node.is_leaf():
-                seq_result = self.sequential_search(node.get_leaf_data(), query_point, query_range)
-                result['neighbors'].extend(seq_result['neighbors'])
-                result['cal_distance_times'] += seq_result['cal_distance_times']
+            if self._node_child_count[node] == 0:
+                indexes, leaf_distances, leaf_cal_times, _ = \
+                    self._sequential_scan(self._data[start:self._node_end[node]], query_point, query_range,
+                                          use_filters=False)
+                positions.append(indexes + start)
+                distances.append(leaf_distances)
+                cal_distance_times += leaf_cal_times
                 continue
 
-            # 如果不是叶子节点
-            node_vp = node.get_vantage_point()
-            node_childes = node.get_childes()
-            # 首先检查支撑点是否在查询范围内
-            dis = self._distance_fun(query_point, node_vp)
-            result['cal_distance_times'] += 1
-            if dis <= query_range:
-                result['neighbors'].append({'object': node_vp, 'distance': dis})
-            # 将所有孩子加到搜索队列中
-            nodes_to_list.extend(node_childes)
-        return result
+            # 如果不是叶子节点，检查支撑点是否在查询范围内
+            node_vp = self._data[start]
+            dis = self._metric.distance(query_point, node_vp)
+            cal_distance_times += 1
+            if dis <= query_range and not self._is_deleted(start):
+                positions.append(np.array([start], dtype=np.int64))
+                distances.append(np.array([dis], dtype=np.float64))
+        return self._make_result(positions, distances, cal_distance_times, 0, return_ids)
 
-    def select_vantage_point(self, data, selecting_mode):
+    def knn_search(self, query_point, k, stats=None, return_ids=False, max_distance_times=None, epsilon=0):
+        """
+        在VP树中进行k近邻搜索
+        优先访问距离下界最小的节点，并以当前第k近的距离作为不断收缩的搜索半径进行剪枝
+        :param query_point: 查询数据
+        :param k: 返回的近邻个数
+        :param stats: SearchStats对象，不为None时记录搜索过程的统计信息，
+                      进入队列后因为下界不小于第k近的距离而没有访问的节点也计为剪枝
+        :param return_ids: 与range_search相同
+        :param max_distance_times: 最多计算距离的次数，达到后停止搜索并返回当前最近的k个点，为None时不限制
+        :param epsilon: 下界乘以(1 + epsilon)后不小于第k近的距离的节点被剪枝，
+                        返回的第i近的距离不超过精确结果的(1 + epsilon)倍
+        :return: neighbors（或ids与distances）按距离从小到大排列，exact表示结果是否与精确搜索相同
+        """
+        if not isinstance(k, int) or k < 1:
+            raise ValueError('k should be a positive integer')
+        VPTree._check_approximate_params(max_distance_times, epsilon)
+        exact = True
+        if stats is not None:
+            started = time.perf_counter()
+        cal_distance_times = 0
+        filtered_times = 0
+        # 序号用于在距离相同时打破平局
+        counter = itertools.count()
+        # best 为大顶堆，保存当前最近的k个点，元素为(-distance, 序号, 点在self._data中的位置)
+        best = []
+        # nodes_to_list 为小顶堆，元素为(查询点到该节点中数据的距离下界, 序号, 节点编号, 深度, 查询点到祖先支撑点的距离)
+        nodes_to_list = [(0.0, next(counter), 0, 0, self._empty_pivot_path())]
+
+        while len(nodes_to_list) > 0:
+            lower_bound, _, node, depth, path = heapq.heappop(nodes_to_list)
+            # 当前搜索半径为第k近的距离，剩余节点的下界都不小于它时，搜索结束
+            if len(best) == k and lower_bound * (1 + epsilon) >= -best[0][0]:
+                if lower_bound < -best[0][0]:
+                    exact = False
+                if stats is not None:
+                    stats.prune_node(node, depth)
+                    for _, _, pruned_node, pruned_depth, _ in nodes_to_list:
+                        stats.prune_node(pruned_node, pruned_depth)
+                break
+            start = self._node_start[node]
+            if stats is not None:
+                stats.visit_node(node, depth, self._node_child_count[node] == 0)
+
+            remaining = float('inf') if max_distance_times is None else max_distance_times - cal_distance_times
+            if remaining < 1:
+                exact = False
+                break
+
+            # 如果是叶子节点，则进行顺序比较
+            if self._node_child_count[node] == 0:
+                if stats is not None:
+                    leaf_started = time.perf_counter()
+                    leaf_cal_times = cal_distance_times
+                    leaf_filtered_times = filtered_times
+                leaf_positions = np.arange(start, self._node_end[node])
+                # 只有比当前第k近更近的点才可能进入结果
+                radius = -best[0][0] if len(best) == k else float('inf')
+                if path is not None:
+                    candidates = np.flatnonzero(self._pivot_lower_bounds(node, path) < radius)
+                    filtered_times += len(leaf_positions) - len(candidates)
+                    leaf_positions = leaf_positions[candidates]
+                # 剩余的距离计算次数不够时只比较叶子中的一部分点
+                if len(leaf_positions) > remaining:
+                    leaf_positions = leaf_positions[:remaining]
+                    exact = False
+                cal_distance_times += len(leaf_positions)
+                if self._block_distance_fun is not None and self._metric.has_surrogate:
+                    values = self._metric.surrogate_distances(self._data[leaf_positions], query_point)
+                    candidates = np.flatnonzero(values <= self._metric.surrogate_bound(radius))
+                    leaf_distances = self._metric.from_surrogate(values[candidates])
+                    for i in np.argsort(values[candidates], kind='stable'):
+                        # 代理值从小到大处理，第k近的距离收缩后后面的点不再进入结果
+                        if len(best) == k and leaf_distances[i] >= -best[0][0]:
+                            break
+                        VPTree._push_knn_candidate(best, k, leaf_positions[candidates[i]], leaf_distances[i],
+                                                   next(counter))
+                elif self._block_distance_fun is not None:
+                    leaf_distances = self._block_distance_fun(self._data[leaf_positions], query_point)
+                    for i in np.flatnonzero(leaf_distances < radius):
+                        VPTree._push_knn_candidate(best, k, leaf_positions[i], leaf_distances[i], next(counter))
+                else:
+                    for position in leaf_positions:
+                        dis = self._metric.distance(self._data[position], query_point)
+                        VPTree._push_knn_candidate(best, k, position, dis, next(counter))
+                if stats is not None:
+                    stats.scan_leaf(node, depth, cal_distance_times - leaf_cal_times,
+                                    filtered_times - leaf_filtered_times, time.perf_counter() - leaf_started)
+                continue
+
+            # 如果不是叶子节点，首先比较支撑点
+            node_vp = self._data[start]
+            first_child = self._node_first_child[node]
+            child_count = self._node_child_count[node]
+            if stats is None:
+                dis = self._metric.distance(query_point, node_vp)
+            else:
+                dis = stats.distance(self._metric.distance, query_point, node_vp)
+            cal_distance_times += 1
+            if not self._is_deleted(start):
+                VPTree._push_knn_candidate(best, k, start, dis, next(counter))
+            child_path = self._extend_pivot_path(path, depth, dis)
+            # 孩子中的点到支撑点的距离位于[lower, upper]之间
+            # 根据三角不等式计算查询点到每个孩子中的点的距离下界
+            for child in range(first_child, first_child + child_count):
+                child_bound = max(self._node_lower[child] - dis, dis - self._node_upper[child], 0)
+                if len(best) < k or child_bound * (1 + epsilon) < -best[0][0]:
+                    heapq.heappush(nodes_to_list, (child_bound, next(counter), child, depth + 1, child_path))
+                    continue
+                if child_bound < -best[0][0]:
+                    exact = False
+                if stats is not None:
+                    stats.prune_node(child, depth + 1)
+
+        best = sorted(best, key=lambda item: (-item[0], item[1]))
+        positions = np.array([position for _, _, position in best], dtype=np.int64)
+        distances = np.array([-neg_dis for neg_dis, _, _ in best], dtype=np.float64)
+        if stats is not None:
+            stats.finish_query(time.perf_counter() - started)
+        return self._make_result([positions], [distances], cal_distance_times, filtered_times, return_ids, exact)
+
+    @staticmethod
+    def _check_approximate_params(max_distance_times, epsilon):
+        """
+        检查近似搜索的参数
+        :param max_distance_times: 最多计算距离的次数
+        :param epsilon: 剪枝半径的缩小比例
+        :return:
+        """
+        if max_distance_times is not None and (not isinstance(max_distance_times, int) or max_distance_times < 1):
+            raise ValueError('max_distance_times should be a positive integer or None')
+        if epsilon < 0:
+            raise ValueError('epsilon should be non-negative')
+
+    @staticmethod
+    def _push_knn_candidate(best, k, position, dis, order):
+        """
+        将候选点加入k近邻的大顶堆中，堆中元素超过k个时弹出最远的点
+        :param best: 保存当前k近邻的大顶堆
+        :param k: 近邻个数
+        :param position: 候选点在self._data中的位置
+        :param dis: 候选点到查询点的距离
+        :param order: 候选点的序号
+        :return:
+        """
+        if len(best) < k:
+            heapq.heappush(best, (-dis, order, position))
+        elif dis < -best[0][0]:
+            heapq.heapreplace(best, (-dis, order, position))
+
+    def select_vantage_point(self, data, selecting_mode, indexes=None):
         """
         支撑点选择方法
         :param data: 数据集
         :param selecting_mode: 选择模式, random or max_std
-        :return:
+        :param indexes: 参与选择的数据在data中的下标，为None时从整个data中选择
+        :return: 支撑点，以及支撑点在参与选择的数据中的位置
         """
         if selecting_mode != 'random' and selecting_mode != 'max_std':
             raise ValueError('selecting_method should be random or max_std, instead of :', selecting_mode)
 
         if selecting_mode == 'random':
             # data中的数据比较多的情况，选取支撑点
-            vp_index = random.randint(0, len(data) - 1)
-            vantage_point = data[vp_index]
-            return vantage_point, vp_index
+            if indexes is None:
+                vp_index = random.randint(0, len(data) - 1)
+                return data[vp_index], vp_index
+            vp_index = random.randint(0, len(indexes) - 1)
+            return data[indexes[vp_index]], vp_index
         else:
-            # 确定候选vp的数量
-            candidate_count = min(50, len(data))
-            sub_set_count = min(100, len(data)-1)
-            # 从数据集中随机采样获得候选vp
-            candidate_vp, candidate_vp_index = VPTree.random_sample(data, candidate_count)
-            max_std = -1
-            vantage_point = None
-            vp_index = -1
-            for i in range(len(candidate_vp)):
-                candidate = candidate_vp[i]
-                candidate_ind = candidate_vp_index[i]
-                # 对于每一个候选vp，从数据集中随机采样获得采样点
-                temp_data = np.delete(data, candidate_ind, axis=0)
-                temp_sub_set_data, _ = VPTree.random_sample(temp_data, sub_set_count)
-                # 计算每一个采样点与候选vp之间的距离
-                distances = [self._distance_fun(candidate, point) for point in temp_sub_set_data]
-                # 计算距离的标准差
-                std = np.std(distances)
-                # 选择标准差最大的候选vp
-                if std > max_std:
-                    max_std = std
-                    vantage_point = candidate
-                    vp_index = candidate_ind
-            return vantage_point, vp_index
+            if indexes is None:
+                indexes = np.arange(len(data))
+            # 从数据集中随机采样获得候选vp，以及所有候选vp共用的一组采样点
+            candidate_positions = np.array(random.sample(range(len(indexes)),
+                                                         min(self._vp_candidate_count, len(indexes))))
+            sample_positions = np.array(random.sample(range(len(indexes)),
+                                                      min(self._vp_sample_count, len(indexes))))
+            sample_points = data[indexes[sample_positions]]
+            # 计算候选vp与采样点之间的距离矩阵，每一行对应一个候选vp
+            distances = np.empty((len(candidate_positions), len(sample_positions)), dtype=np.float64)
+            for i, position in enumerate(candidate_positions):
+                candidate = data[indexes[position]]
+                if self._block_distance_fun is not None:
+                    distances[i] = self._block_distance_fun(sample_points, candidate)
+                else:
+                    distances[i] = [self._metric.distance(candidate, point) for point in sample_points]
+            # 候选vp自身不参与它的标准差的计算，计算每一行距离的标准差
+            is_self = candidate_positions[:, None] == sample_positions[None, :]
+            stds = np.ma.masked_array(distances, mask=is_self).std(axis=1).filled(-1)
+            # 选择标准差最大的候选vp
+            vp_index = int(candidate_positions[np.argmax(stds)])
+            return data[indexes[vp_index]], vp_index
 
-    def get_tree_height(self):
+    def get_tree_height(self, node=0):
         """
-        计算VP树的高度
+        计算VP树（或以node为根的子树）的高度
+        :param node: 节点编号，默认为根节点
         :return:
         """
-        if self is None:
-            return 0
-        if self._is_leaf:
-            return 1
-        childes_height = []
-        for child in self._childes:
-            childes_height.append(child.get_tree_height())
-        height = max(childes_height)+1
-        return height
+        # 孩子的节点编号总是大于父节点，按编号顺序即可逐层计算子树中每个节点的深度，子树以外的节点深度为0
+        depths = np.zeros(len(self._node_start), dtype=np.int64)
+        depths[node] = 1
+        for parent in range(node, len(self._node_start)):
+            if depths[parent] > 0:
+                first_child = self._node_first_child[parent]
+                depths[first_child:first_child + self._node_child_count[parent]] = depths[parent] + 1
+        return int(depths.max())
 
     def get_data_count_of_tree(self):
         """
         计算vp树中存放的元素个数
         :return:
         """
-        if self is None:
-            return 0
-        if self._is_leaf:
-            return len(self.get_leaf_data())
-        data_count = []
-        for child in self._childes:
-            data_count.append(child.get_data_count_of_tree())
-        # +1表示支撑点
-        count = sum(data_count)+1
-        return count
+        if self._node_size is not None:
+            return int(self._node_size[0])
+        # 没有插入或删除过数据时，根节点的区间覆盖所有的支撑点与叶子数据
+        return int(self._node_end[0] - self._node_start[0])
 
     @staticmethod
     def random_sample(population, k):
@@ -377,3 +1702,138 @@ class VPTree:
         sample_index = np.random.choice(sample_index, k, replace=False)
         sample = population[sample_index]
         return sample, sample_index
+
+
+class VPTreeNode:
+    """
+    VPTree中一个节点的轻量视图，get_childes返回的孩子节点
+    树扁平存放后节点不再是VPTree对象，视图保留了以子树方式访问节点的接口，所有数据仍由所属的VPTree保存
+    """
+    def __init__(self, tree, node):
+        """
+        构造函数
+        :param tree: 节点所属的VPTree
+        :param node: 节点编号
+        """
+        self._tree = tree
+        self._node = node
+
+    def get_node_id(self):
+        """
+        返回节点编号，可以传给VPTree中带node参数的方法
+        :return:
+        """
+        return self._node
+
+    def get_childes(self):
+        """
+        返回节点的所有孩子节点
+        :return:
+        """
+        return self._tree.get_childes(self._node)
+
+    def is_leaf(self):
+        """
+        判断节点是否是叶子节点
+        :return:
+        """
+        return self._tree.is_leaf(self._node)
+
+    def get_leaf_data(self):
+        """
+        如果节点是叶子节点，返回叶子节点的数据
+        :return:
+        """
+        return self._tree.get_leaf_data(self._node)
+
+    def get_vantage_point(self):
+        """
+        返回节点的支撑点
+        :return:
+        """
+        return self._tree.get_vantage_point(self._node)
+
+    def get_cutoff_values(self):
+        """
+        返回节点的各个分组之间的中值
+        :return:
+        """
+        return self._tree.get_cutoff_values(self._node)
+
+    def get_distance_bounds(self):
+        """
+        返回节点中的点到父节点支撑点的最小距离与最大距离
+        :return:
+        """
+        return self._tree.get_distance_bounds(self._node)
+
+    def get_tree_height(self):
+        """
+        返回以该节点为根的子树的高度
+        :return:
+        """
+        return self._tree.get_tree_height(self._node)
+
+    def get_tree_way(self):
+        """
+        返回vp树的分枝数
+        :return:
+        """
+        return self._tree.get_tree_way()
+
+    def get_leaf_capacity(self):
+        """
+        返回vp树叶子节点的容量
+        :return:
+        """
+        return self._tree.get_leaf_capacity()
+
+    def get_selecting_vp_mode(self):
+        """
+        返回vp树选择支撑点的模式
+        :return:
+        """
+        return self._tree.get_selecting_vp_mode()
+
+
+# worker进程中创建子树使用的树配置与数据，由_init_build_worker设置
+_worker_tree = None
+_worker_data = None
+_worker_shm = None
+
+
+def _init_build_worker(tree, data, shm_name, shape, dtype):
+    """
+    建树worker进程的初始化函数
+    :param tree: 尚未建树的VPTree，提供建树的参数与距离函数
+    :param data: 字符串数据，数值数据时为None
+    :param shm_name: 存放数值数据的共享内存名称
+    :param shape: 数值数据的形状
+    :param dtype: 数值数据的类型
+    :return:
+    """
+    global _worker_tree, _worker_data, _worker_shm
+    # fork出来的worker会继承相同的随机状态，重新设置随机种子
+    random.seed()
+    np.random.seed()
+    _worker_tree = tree
+    if shm_name is not None:
+        _worker_shm = shared_memory.SharedMemory(name=shm_name)
+        _worker_data = np.ndarray(shape, dtype=np.dtype(dtype), buffer=_worker_shm.buf)
+    else:
+        _worker_data = data
+
+
+def _build_subtree_in_worker(task):
+    """
+    在worker进程中创建一棵子树
+    :param task: (子树根节点编号, 子树根节点的深度, 子树包含的数据的原始行号, 子树的支撑点距离表)
+    :return: 子树根节点编号，重排后的原始行号，重排后的支撑点距离表，子树的节点列表
+    """
+    node, depth, sub_perm, sub_pivot_table = task
+    sub_perm = np.array(sub_perm)
+    sub_pivot_table = np.array(sub_pivot_table)
+    sub_nodes = VPTree._empty_node_lists()
+    VPTree._append_node(sub_nodes, 0, len(sub_perm))
+    _worker_tree._build_nodes(_worker_data, sub_perm, sub_pivot_table, sub_nodes, 0, depth)
+    return node, sub_perm, sub_pivot_table, sub_nodes